@@ -97,19 +97,85 @@ SOPORTE PARA IA GENERATIVA:
 Incluye prompt específico para crear JSON completos a partir de documentos con RA y CE.
 """
 
-import requests
 import re
 import json
-from bs4 import BeautifulSoup
-from tqdm import tqdm
 import urllib.parse
 import time
 import os
 import argparse
 import sys
-import pydoc
-import getpass
 import platform
+import functools
+import threading
+import contextlib
+import subprocess
+import tracemalloc
+import io
+import ast
+import math
+import csv
+import zipfile
+import array
+import shutil
+import hashlib
+import zlib
+import copy
+import types
+import typing
+from xml.etree import ElementTree
+
+# --- IMPORTACIONES DIFERIDAS ---
+# requests, bs4 y compañía suponen la mayor parte del arranque y la GUI no los necesita
+# hasta la primera acción de red, así que se importan la primera vez que se usan.
+
+def _importar(nombre):
+    """Importaciones pesadas, escritas como sentencias import para que PyInstaller las detecte."""
+    if nombre == "requests":
+        import requests as objeto
+    elif nombre == "BeautifulSoup":
+        from bs4 import BeautifulSoup as objeto
+    elif nombre == "tqdm":
+        from tqdm import tqdm as objeto
+    elif nombre == "pydoc":
+        import pydoc as objeto
+    elif nombre == "getpass":
+        import getpass as objeto
+    elif nombre == "sqlite3":
+        import sqlite3 as objeto
+    elif nombre == "cProfile":
+        import cProfile as objeto
+    elif nombre == "pstats":
+        import pstats as objeto
+    else:
+        raise ImportError(nombre)
+    return objeto
+
+class ImportacionDiferida:
+    """Sustituto de un módulo (o clase/función) que lo importa en el primer acceso."""
+
+    def __init__(self, nombre):
+        self._nombre = nombre
+        self._objeto = None
+
+    def _cargar(self):
+        if self._objeto is None:
+            self._objeto = _importar(self._nombre)
+        return self._objeto
+
+    def __getattr__(self, atributo):
+        return getattr(self._cargar(), atributo)
+
+    def __call__(self, *args, **kwargs):
+        return self._cargar()(*args, **kwargs)
+
+requests = ImportacionDiferida("requests")
+BeautifulSoup = ImportacionDiferida("BeautifulSoup")
+tqdm = ImportacionDiferida("tqdm")
+pydoc = ImportacionDiferida("pydoc")
+getpass = ImportacionDiferida("getpass")
+sqlite3 = ImportacionDiferida("sqlite3")
+cProfile = ImportacionDiferida("cProfile")
+pstats = ImportacionDiferida("pstats")
 
 # --- CONSTANTES ---
 VERSION = "1.8.0"
@@ -133,16 +199,413 @@ def limpiar_id(id_raw):
             return id_str[len(p):]
     return id_str
 
+# --- MÉTRICAS ---
+
+# Límites (en segundos) de los cubos del histograma de latencias
+BUCKETS_LATENCIA = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def clasificar_operacion(metodo, path, info=None):
+    """
+    Etiqueta una petición según la operación de Moodle que realiza.
+    Devuelve: login, tree-fetch, create, modify, formula, delete u other.
+    """
+    path = path or ""
+    if "login/" in path or path.rstrip('/').endswith("/my") or path.startswith("my/"):
+        return "login"
+    if "grade/import/" in path:
+        return "import"
+    if "grade/export/" in path:
+        return "export"
+    if metodo == "GET" and any(p in path for p in ("calculation.php", "grade/edit/tree/item.php", "grade/edit/tree/category.php")):
+        # Abrir un formulario de edición no cambia nada en el curso
+        return "other"
+    if "calculation.php" in path:
+        return "formula"
+    if "grade/edit/tree/index.php" in path:
+        return "delete" if "action=delete" in path else "tree-fetch"
+    if "grade/edit/tree/item.php" in path or "grade/edit/tree/category.php" in path:
+        return "modify"
+    if metodo == "AJAX" and info == "core_form_dynamic_form":
+        return "create"
+    return "other"
+
+class MetricasPeticiones:
+    """Acumula latencias, bytes, reintentos, errores y esperas por tipo de operación."""
+
+    def __init__(self):
+        self.peticiones_totales = 0  # no se reinicia: sirve para contar las de un trabajo en curso
+        self.reiniciar()
+
+    def reiniciar(self):
+        """Descarta lo acumulado y empieza a medir un nuevo flujo."""
+        self.inicio = time.time()
+        self.operaciones = {}
+        self.espera_total = 0.0
+
+    def _entrada(self, operacion):
+        return self.operaciones.setdefault(operacion, {
+            "peticiones": 0,
+            "errores": 0,
+            "reintentos": 0,
+            "aciertos_cache": 0,
+            "bytes_enviados": 0,
+            "bytes_recibidos": 0,
+            "latencias": []
+        })
+
+    def registrar(self, operacion, duracion, bytes_enviados=0, bytes_recibidos=0, error=False):
+        """Registra una petición terminada (con éxito o no)."""
+        entrada = self._entrada(operacion)
+        entrada["peticiones"] += 1
+        self.peticiones_totales += 1
+        entrada["latencias"].append(duracion)
+        entrada["bytes_enviados"] += bytes_enviados
+        entrada["bytes_recibidos"] += bytes_recibidos
+        if error:
+            entrada["errores"] += 1
+
+    def registrar_error(self, operacion):
+        """Marca como fallida una petición ya registrada (p. ej. error dentro de la respuesta AJAX)."""
+        self._entrada(operacion)["errores"] += 1
+
+    def registrar_reintento(self, operacion):
+        self._entrada(operacion)["reintentos"] += 1
+
+    def registrar_acierto_cache(self, operacion):
+        """Cuenta una petición servida desde la caché local (no llega a Aules)."""
+        self._entrada(operacion)["aciertos_cache"] += 1
+
+    def registrar_espera(self, segundos):
+        self.espera_total += segundos
+
+    @staticmethod
+    def percentil(valores, p):
+        """Percentil por el método del rango más cercano (valores no vacíos)."""
+        ordenados = sorted(valores)
+        indice = max(0, min(len(ordenados) - 1, int(round(p / 100.0 * len(ordenados))) - 1))
+        return ordenados[indice]
+
+    def resumen(self):
+        """Devuelve un diccionario serializable con el estado de las métricas."""
+        operaciones = {}
+        for nombre, e in sorted(self.operaciones.items()):
+            lat = e["latencias"]
+            operaciones[nombre] = {
+                "peticiones": e["peticiones"],
+                "errores": e["errores"],
+                "reintentos": e["reintentos"],
+                "aciertos_cache": e["aciertos_cache"],
+                "bytes_enviados": e["bytes_enviados"],
+                "bytes_recibidos": e["bytes_recibidos"],
+                "tiempo_total": round(sum(lat), 4),
+                "p50": round(self.percentil(lat, 50), 4) if lat else 0.0,
+                "p95": round(self.percentil(lat, 95), 4) if lat else 0.0,
+                "max": round(max(lat), 4) if lat else 0.0,
+                "histograma": {str(b): sum(1 for x in lat if x <= b) for b in BUCKETS_LATENCIA}
+            }
+        return {
+            "inicio": self.inicio,
+            "duracion_total": round(time.time() - self.inicio, 4),
+            "espera_total": round(self.espera_total, 4),
+            "tiempo_red": round(sum(o["tiempo_total"] for o in operaciones.values()), 4),
+            "operaciones": operaciones
+        }
+
+    def tabla(self, titulo=""):
+        """Genera la tabla de resumen en texto plano."""
+        datos = self.resumen()
+        cabecera = f"{'Operación':<11} {'Pet.':>5} {'Err.':>5} {'Reint.':>6} {'KB rec.':>9} {'Total s':>8} {'p50 s':>7} {'p95 s':>7} {'Máx s':>7}"
+        lineas = [f"RESUMEN DE PETICIONES {titulo}".rstrip(), cabecera, "-" * len(cabecera)]
+        for nombre, o in datos["operaciones"].items():
+            lineas.append(
+                f"{nombre:<11} {o['peticiones']:>5} {o['errores']:>5} {o['reintentos']:>6} "
+                f"{o['bytes_recibidos'] / 1024:>9.1f} {o['tiempo_total']:>8.2f} {o['p50']:>7.2f} {o['p95']:>7.2f} {o['max']:>7.2f}"
+            )
+        lineas.append("-" * len(cabecera))
+        lineas.append(
+            f"Duración: {datos['duracion_total']:.2f}s | Red: {datos['tiempo_red']:.2f}s | "
+            f"Esperas: {datos['espera_total']:.2f}s"
+        )
+        return "\n".join(lineas)
+
+    def a_prometheus(self, flujo=""):
+        """Serializa las métricas en el formato de texto de Prometheus (textfile collector)."""
+        datos = self.resumen()
+        etiqueta_flujo = f'flujo="{flujo}",' if flujo else ""
+        lineas = [
+            "# HELP aules_peticiones_total Peticiones HTTP realizadas por operación.",
+            "# TYPE aules_peticiones_total counter"
+        ]
+        for nombre, o in datos["operaciones"].items():
+            lineas.append(f'aules_peticiones_total{{{etiqueta_flujo}operacion="{nombre}"}} {o["peticiones"]}')
+        for metrica, clave, ayuda in (
+            ("aules_errores_total", "errores", "Peticiones fallidas por operación."),
+            ("aules_reintentos_total", "reintentos", "Reintentos por operación."),
+            ("aules_cache_aciertos_total", "aciertos_cache", "Peticiones servidas desde la caché local."),
+            ("aules_bytes_recibidos_total", "bytes_recibidos", "Bytes recibidos por operación."),
+            ("aules_bytes_enviados_total", "bytes_enviados", "Bytes enviados por operación."),
+        ):
+            lineas.append(f"# HELP {metrica} {ayuda}")
+            lineas.append(f"# TYPE {metrica} counter")
+            for nombre, o in datos["operaciones"].items():
+                lineas.append(f'{metrica}{{{etiqueta_flujo}operacion="{nombre}"}} {o[clave]}')
+        lineas.append("# HELP aules_peticion_duracion_segundos Latencia de las peticiones por operación.")
+        lineas.append("# TYPE aules_peticion_duracion_segundos histogram")
+        for nombre, o in datos["operaciones"].items():
+            for limite, cuenta in o["histograma"].items():
+                lineas.append(f'aules_peticion_duracion_segundos_bucket{{{etiqueta_flujo}operacion="{nombre}",le="{limite}"}} {cuenta}')
+            lineas.append(f'aules_peticion_duracion_segundos_bucket{{{etiqueta_flujo}operacion="{nombre}",le="+Inf"}} {o["peticiones"]}')
+            lineas.append(f'aules_peticion_duracion_segundos_sum{{{etiqueta_flujo}operacion="{nombre}"}} {o["tiempo_total"]}')
+            lineas.append(f'aules_peticion_duracion_segundos_count{{{etiqueta_flujo}operacion="{nombre}"}} {o["peticiones"]}')
+        lineas.append("# HELP aules_espera_segundos Tiempo dormido esperando a que Moodle procese cambios.")
+        lineas.append("# TYPE aules_espera_segundos gauge")
+        lineas.append(f'aules_espera_segundos{{{etiqueta_flujo.rstrip(",")}}} {datos["espera_total"]}')
+        return "\n".join(lineas) + "\n"
+
+    def exportar(self, directorio, flujo):
+        """Escribe metricas_<flujo>.json y metricas_<flujo>.prom en el directorio indicado."""
+        os.makedirs(directorio, exist_ok=True)
+        json_path = os.path.join(directorio, f"metricas_{flujo}.json")
+        prom_path = os.path.join(directorio, f"metricas_{flujo}.prom")
+        datos = self.resumen()
+        datos["flujo"] = flujo
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(datos, f, indent=2, ensure_ascii=False)
+        with open(prom_path, 'w', encoding='utf-8') as f:
+            f.write(self.a_prometheus(flujo))
+        return json_path, prom_path
+
+# --- PERFILADO (cProfile + tracemalloc) ---
+
+# Módulos cuyo tiempo propio se agrupa en el desglose del informe de perfilado
+GRUPOS_PERFIL = {
+    "red": ("socket.py", "ssl.py", "_socket", "_ssl", "urllib3", "http/client.py", "requests"),
+    "parseo": ("bs4", "html/parser.py", "soupsieve"),
+    "tk": ("tkinter", "customtkinter", "_tkinter"),
+    "espera": ("time.sleep",),
+}
+
+class Perfilador:
+    """Perfila un tramo de ejecución con cProfile y muestrea la memoria con tracemalloc."""
+
+    def __init__(self, nombre, top=30):
+        self.nombre = nombre
+        self.top = top
+        self.perfil = cProfile.Profile()
+        self.perfiles_extra = {}
+        self._tracemalloc_propio = False
+        self.inicio = None
+        self.duracion = 0.0
+
+    def iniciar(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            self._tracemalloc_propio = True
+        self.inicio = time.perf_counter()
+        self.perfil.enable()
+
+    def detener(self):
+        self.perfil.disable()
+        self.duracion = time.perf_counter() - self.inicio
+        self.snapshot = tracemalloc.take_snapshot()
+        self.memoria_actual, self.memoria_pico = tracemalloc.get_traced_memory()
+        if self._tracemalloc_propio:
+            tracemalloc.stop()
+
+    def agregar_perfil(self, etiqueta, perfil):
+        """Añade al informe otro cProfile.Profile (p. ej. el del hilo principal de Tk)."""
+        self.perfiles_extra[etiqueta] = perfil
+
+    @staticmethod
+    def desglose(estadisticas):
+        """Suma el tiempo propio por grupo (red, parseo, tk, espera, resto)."""
+        totales = {grupo: 0.0 for grupo in GRUPOS_PERFIL}
+        totales["resto"] = 0.0
+        for (fichero, _, funcion), (_, _, tiempo_propio, _, _) in estadisticas.stats.items():
+            # Las funciones nativas (recv, sleep...) aparecen con fichero "~" y el módulo en el nombre
+            ubicacion = fichero.replace("\\", "/") + ":" + funcion
+            grupo = next((g for g, patrones in GRUPOS_PERFIL.items() if any(p in ubicacion for p in patrones)), "resto")
+            totales[grupo] += tiempo_propio
+        return totales
+
+    def _seccion_perfil(self, titulo, perfil):
+        salida = io.StringIO()
+        estadisticas = pstats.Stats(perfil, stream=salida)
+        desglose = self.desglose(estadisticas)
+        salida.write(f"=== {titulo} ===\n")
+        salida.write("Desglose de tiempo propio: " + ", ".join(f"{g}={t:.2f}s" for g, t in desglose.items()) + "\n\n")
+        salida.write("--- Funciones por tiempo acumulado ---\n")
+        estadisticas.sort_stats("cumulative").print_stats(self.top)
+        salida.write("--- Funciones por tiempo propio ---\n")
+        estadisticas.sort_stats("tottime").print_stats(self.top)
+        return salida.getvalue()
+
+    def informe(self, directorio=None):
+        """Escribe perfil_<nombre>_<fecha>.txt (y el .prof de cProfile) y devuelve la ruta del .txt."""
+        directorio = directorio or get_directorio_informes()
+        os.makedirs(directorio, exist_ok=True)
+        base = os.path.join(directorio, f"perfil_{self.nombre}_{time.strftime('%Y%m%d_%H%M%S')}")
+        self.perfil.dump_stats(base + ".prof")
+
+        partes = [
+            f"PERFIL: {self.nombre}",
+            f"Duración: {self.duracion:.2f}s | Memoria actual: {self.memoria_actual / 1024:.1f} KB | Pico: {self.memoria_pico / 1024:.1f} KB",
+            "",
+            self._seccion_perfil("Hilo de la acción", self.perfil)
+        ]
+        for etiqueta, perfil in self.perfiles_extra.items():
+            partes.append(self._seccion_perfil(etiqueta, perfil))
+        partes.append(f"=== Memoria: top {self.top} líneas (tracemalloc) ===")
+        for estadistica in self.snapshot.statistics("lineno")[:self.top]:
+            partes.append(str(estadistica))
+
+        ruta = base + ".txt"
+        with open(ruta, 'w', encoding='utf-8') as f:
+            f.write("\n".join(partes) + "\n")
+        return ruta
+
+def perfilar(nombre, fn, *args, **kwargs):
+    """Ejecuta fn(*args, **kwargs) bajo el perfilador. Devuelve (resultado, ruta_del_informe)."""
+    perfilador = Perfilador(nombre)
+    perfilador.iniciar()
+    try:
+        resultado = fn(*args, **kwargs)
+    finally:
+        perfilador.detener()
+    return resultado, perfilador.informe()
+
+# --- TRAZAS (Chrome trace-event) ---
+
+class Trazador:
+    """
+    Registra spans anidados y los exporta en formato Chrome trace-event JSON,
+    abrible en chrome://tracing o https://ui.perfetto.dev.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.eventos = []
+        self.origen = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._siguiente_id = 0
+
+    def _pila(self):
+        if not hasattr(self._local, "pila"):
+            self._local.pila = []
+        return self._local.pila
+
+    @contextlib.contextmanager
+    def span(self, nombre, categoria="paso", **args):
+        """Abre un span; su padre es el span abierto más reciente en el mismo hilo."""
+        pila = self._pila()
+        with self._lock:
+            self._siguiente_id += 1
+            span_id = self._siguiente_id
+        args["span_id"] = span_id
+        if pila:
+            args["parent_id"] = pila[-1]
+        pila.append(span_id)
+        inicio = time.perf_counter()
+        try:
+            yield args
+        finally:
+            fin = time.perf_counter()
+            pila.pop()
+            evento = {
+                "name": nombre,
+                "cat": categoria,
+                "ph": "X",
+                "ts": round((inicio - self.origen) * 1e6, 1),
+                "dur": round((fin - inicio) * 1e6, 1),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args
+            }
+            with self._lock:
+                self.eventos.append(evento)
+
+    def exportar(self):
+        """Escribe todos los eventos registrados hasta ahora en self.ruta."""
+        directorio = os.path.dirname(os.path.abspath(self.ruta))
+        os.makedirs(directorio, exist_ok=True)
+        with self._lock:
+            eventos = sorted(self.eventos, key=lambda e: e["ts"])
+        with open(self.ruta, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": eventos, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        return self.ruta
+
+# Un trazador por fichero de salida, compartido por todos los clientes del proceso
+_TRAZADORES = {}
+
+def obtener_trazador(ruta=None):
+    """Devuelve el trazador de la ruta indicada (o de AULES_TRACE); None si la traza está desactivada."""
+    ruta = ruta or os.environ.get("AULES_TRACE")
+    if not ruta:
+        return None
+    ruta = os.path.abspath(ruta)
+    if ruta not in _TRAZADORES:
+        _TRAZADORES[ruta] = Trazador(ruta)
+    return _TRAZADORES[ruta]
+
+def flujo_instrumentado(nombre, instantaneas=False, huella=None):
+    """
+    Decorador para los flujos de trabajo: al terminar, muestra y exporta las métricas del cliente.
+    Con instantaneas=True (flujos que modifican el curso de su primer argumento) guarda además la
+    estructura del curso en el historial antes y después del flujo.
+    'huella' (flujos que escriben la estructura) recibe los argumentos del flujo y devuelve
+    (course_id, categoria_padre, configuración aplicada entera o None): si el flujo termina sin
+    errores se guarda la huella de esa configuración y, si no, se olvida la que hubiera.
+    """
+    def decorador(fn):
+        @functools.wraps(fn)
+        def envoltura(client, *args, **kwargs):
+            course_id = args[0] if instantaneas and args and INSTANTANEAS_AUTOMATICAS else None
+            if course_id is not None:
+                # Lectura real de Aules: recoge también lo que se haya cambiado a mano
+                _instantanea_automatica(client, course_id, f"antes de {nombre}")
+            derivado, errores = _cliente_con_errores(client) if huella else (client, None)
+            try:
+                with client.span(nombre, "flujo"):
+                    resultado = fn(derivado, *args, **kwargs)
+            except BaseException:
+                if huella:
+                    curso, categoria_padre, _ = huella(*args, **kwargs)
+                    recordar_huella_aplicada(client, curso, categoria_padre, None)
+                raise
+            else:
+                if huella:
+                    curso, categoria_padre, data = huella(*args, **kwargs)
+                    arbol = arbol_huellas(data) if data is not None and not errores else None
+                    recordar_huella_aplicada(client, curso, categoria_padre, arbol)
+                return resultado
+            finally:
+                if course_id is not None:
+                    _instantanea_automatica(client, course_id, f"después de {nombre}", forzar=False)
+                client.informe_metricas(nombre)
+        return envoltura
+    return decorador
+
+class OperacionCancelada(Exception):
+    """El usuario ha pedido detener el flujo; se lanza entre operaciones, nunca a mitad de una."""
+
 class AulesClient:
     """Cliente para la interacción con la plataforma Aules."""
     
-    def __init__(self, base_url, log_callback=None, progress_callback=None):
+    def __init__(self, base_url, log_callback=None, progress_callback=None, traza=None, cache_estructuras=None, cache_respuestas=None):
         self.base_url = base_url.rstrip('/')
         self.session = requests.Session()
         self.sesskey = None
         self.username = None
         self.log_callback = log_callback
         self.progress_callback = progress_callback
+        self.metricas = MetricasPeticiones()
+        self.trazador = obtener_trazador(traza)
+        self.cache_estructuras = cache_estructuras if cache_estructuras is not None else crear_cache_estructuras()
+        self.cache_respuestas = cache_respuestas if cache_respuestas is not None else crear_cache_respuestas()
+        self._html_analizado = {}
+        # Por hilo: evento de cancelación y peticiones hechas (ver GestorTrabajos)
+        self._local = threading.local()
 
     def _log(self, message, level="info"):
         """Centraliza los logs enviándolos al callback o a print."""
@@ -157,6 +620,116 @@ class AulesClient:
         if self.progress_callback:
             self.progress_callback(value, message)
 
+    def _peticion(self, metodo, url, operacion, **kwargs):
+        """Ejecuta la petición HTTP midiendo latencia y bytes. Propaga las excepciones."""
+        self._local.peticiones = self.peticiones_hilo() + 1
+        cuerpo = kwargs.get("data") if kwargs.get("data") is not None else kwargs.get("json")
+        if cuerpo is None:
+            enviados = 0
+        elif isinstance(cuerpo, (str, bytes)):
+            enviados = len(cuerpo)
+        else:
+            enviados = len(urllib.parse.urlencode(cuerpo, doseq=True)) if isinstance(cuerpo, dict) else len(json.dumps(cuerpo))
+        with self.span(f"{metodo} {operacion}", "http", url=urllib.parse.urlsplit(url).path) as span:
+            inicio = time.perf_counter()
+            try:
+                r = self.session.request(metodo, url, **kwargs)
+            except Exception:
+                self.metricas.registrar(operacion, time.perf_counter() - inicio, enviados, 0, error=True)
+                raise
+            # En streaming el cuerpo aún no se ha leído: se contabiliza el tamaño anunciado
+            recibidos = int(r.headers.get("Content-Length", 0)) if kwargs.get("stream") else len(r.content)
+            self.metricas.registrar(operacion, time.perf_counter() - inicio, enviados, recibidos, error=r.status_code >= 400)
+            span["status"] = r.status_code
+            span["bytes"] = recibidos
+        if operacion in OPERACIONES_ESCRITURA:
+            self._invalidar_caches(curso_de_peticion(url, cuerpo))
+        return r
+
+    def _invalidar_caches(self, curso):
+        """Descarta lo que las cachés locales saben del curso tras una petición que lo modifica."""
+        if not curso:
+            return
+        if self.cache_respuestas is not None:
+            self.cache_respuestas.invalidar(curso)
+        if self.cache_estructuras is not None:
+            try:
+                self.cache_estructuras.invalidar(self.base_url, curso)
+            except sqlite3.Error as e:
+                self._log(f"No se pudo invalidar la caché de estructuras: {e}", "error")
+
+    def peticiones_hilo(self):
+        """Peticiones HTTP hechas desde el hilo actual."""
+        return getattr(self._local, "peticiones", 0)
+
+    def asignar_cancelacion(self, evento):
+        """Asocia un threading.Event de cancelación a los flujos que se ejecuten en este hilo."""
+        self._local.cancelacion = evento
+
+    def comprobar_cancelacion(self):
+        """Lanza OperacionCancelada si se ha pedido detener el trabajo de este hilo."""
+        evento = getattr(self._local, "cancelacion", None)
+        if evento is not None and evento.is_set():
+            raise OperacionCancelada()
+
+    def span(self, nombre, categoria="paso", **args):
+        """Span de traza (sin efecto si la traza está desactivada)."""
+        if self.trazador is None:
+            return contextlib.nullcontext(args)
+        return self.trazador.span(nombre, categoria, **args)
+
+    def derivar(self, log_callback=None, progress_callback=None, metricas=None):
+        """
+        Cliente para otro hilo que comparte la sesión, la sesskey, las métricas y las cachés de este
+        (una sola autenticación), con sus propios callbacks y su propio estado por hilo. Con
+        'metricas' (un MetricasPeticiones nuevo) el informe del flujo solo cuenta sus peticiones.
+        """
+        hijo = copy.copy(self)
+        hijo.log_callback = log_callback or self.log_callback
+        hijo.progress_callback = progress_callback
+        if metricas is not None:
+            hijo.metricas = metricas
+        hijo._html_analizado = {}
+        hijo._local = threading.local()
+        return hijo
+
+    def parsear_html(self, html):
+        """
+        Analiza una página HTML con BeautifulSoup registrando el tiempo de análisis en la traza.
+        Si la misma página (mismo contenido) ya se analizó hace poco, devuelve ese árbol.
+        """
+        huella = hashlib.sha256(html.encode("utf-8")).hexdigest()
+        if huella in self._html_analizado:
+            return self._html_analizado[huella]
+        with self.span("parse html", "parse", bytes=len(html)):
+            soup = BeautifulSoup(html, "html.parser")
+        if len(self._html_analizado) >= 4:
+            self._html_analizado.pop(next(iter(self._html_analizado)))
+        self._html_analizado[huella] = soup
+        return soup
+
+    def esperar(self, segundos):
+        """Pausa para dar tiempo a Moodle a procesar un cambio (contabilizada en las métricas)."""
+        with self.span("esperar", "espera", segundos=segundos):
+            time.sleep(segundos)
+        self.metricas.registrar_espera(segundos)
+
+    def informe_metricas(self, flujo):
+        """Muestra la tabla de resumen del flujo, exporta JSON/Prometheus y reinicia las métricas."""
+        for linea in self.metricas.tabla(f"({flujo})").split("\n"):
+            self._log(linea)
+        try:
+            json_path, prom_path = self.metricas.exportar(get_directorio_informes(), flujo)
+            self._log(f"Métricas guardadas en {json_path} y {prom_path}")
+        except Exception as e:
+            self._log(f"No se pudieron guardar las métricas: {e}", "error")
+        self.metricas.reiniciar()
+        if self.trazador is not None:
+            try:
+                self._log(f"Traza guardada en {self.trazador.exportar()}")
+            except Exception as e:
+                self._log(f"No se pudo guardar la traza: {e}", "error")
+
     def login(self, username, password):
         """Inicia sesión en Aules y extrae la sesskey."""
         self.username = username
@@ -164,7 +737,7 @@ class AulesClient:
 
         # Verificar si ya estamos logueados
         try:
-            r = self.session.get(f"{self.base_url}/my/")
+            r = self.get("my/", operacion="login")
             if 'logout' in r.text.lower():
                 self._log("Sesión ya activa detectada.")
                 self._extraer_sesskey(r.text)
@@ -175,7 +748,7 @@ class AulesClient:
 
         # Proceso de login normal
         try:
-            r = self.session.get(f"{self.base_url}/login/index.php")
+            r = self.get("login/index.php")
             token_match = re.search(r'name="logintoken" value="(\w{32})"', r.text)
             if not token_match:
                 self._log("Error: No se pudo encontrar el token de login", "error")
@@ -188,7 +761,7 @@ class AulesClient:
                 'logintoken': token_match.group(1)
             }
             
-            r = self.session.post(f"{self.base_url}/login/index.php", data=payload)
+            r = self.post("login/index.php", data=payload)
             self._extraer_sesskey(r.text)
 
             if self.sesskey:
@@ -207,25 +780,48 @@ class AulesClient:
         if match:
             self.sesskey = match.group(1)
 
-    def post_ajax(self, info, payload_list):
+    def post_ajax(self, info, payload_list, operacion=None):
         """Realiza una petición AJAX al servicio de Moodle."""
         url = f"{self.base_url}/lib/ajax/service.php?sesskey={self.sesskey}&info={info}"
+        operacion = operacion or clasificar_operacion("AJAX", "lib/ajax/service.php", info)
         try:
-            r = self.session.post(url, json=payload_list)
-            return r.json()
+            r = self._peticion("POST", url, operacion, json=payload_list)
+            respuesta = r.json()
+            if isinstance(respuesta, list) and respuesta and isinstance(respuesta[0], dict) and respuesta[0].get("error"):
+                self.metricas.registrar_error(operacion)
+            return respuesta
         except Exception as e:
             self._log(f"Error en petición AJAX: {e}", "error")
             return None
 
-    def get(self, path, params=None):
-        """Petición GET simplificada."""
+    def get(self, path, params=None, operacion=None, stream=False, cache=True):
+        """
+        Petición GET simplificada. Las páginas de solo lectura (OPERACIONES_CACHEABLES) se sirven
+        desde la caché de respuestas mientras no caduquen; cache=False obliga a pedirlas de nuevo.
+        """
         url = f"{self.base_url}/{path.lstrip('/')}"
-        return self.session.get(url, params=params)
-
-    def post(self, path, data=None, headers=None):
-        """Petición POST simplificada."""
+        operacion = operacion or clasificar_operacion("GET", path)
+        curso = curso_de_peticion(url) if operacion in OPERACIONES_CACHEABLES and not params and not stream else None
+        if curso and self.cache_respuestas is not None:
+            entrada = self.cache_respuestas.obtener(curso, url) if cache else None
+            if entrada:
+                with self.span(f"GET {operacion} (caché)", "cache", url=urllib.parse.urlsplit(url).path):
+                    self.metricas.registrar_acierto_cache(operacion)
+                    return respuesta_desde_cache(entrada)
+            r = self._peticion("GET", url, operacion)
+            if r.status_code == 200:
+                try:
+                    self.cache_respuestas.guardar(curso, url, r)
+                except OSError as e:
+                    self._log(f"No se pudo guardar la respuesta en caché: {e}", "error")
+            return r
+        return self._peticion("GET", url, operacion, params=params, stream=stream)
+
+    def post(self, path, data=None, headers=None, operacion=None, stream=False, files=None):
+        """Petición POST simplificada ('files' envía multipart, como en requests)."""
         url = f"{self.base_url}/{path.lstrip('/')}"
-        return self.session.post(url, data=data, headers=headers)
+        return self._peticion("POST", url, operacion or clasificar_operacion("POST", path), data=data, headers=headers,
+                              stream=stream, files=files)
 
 # Detectar si estamos en modo AppImage
 def is_appimage():
@@ -425,40 +1021,10 @@ Por favor, genera el JSON completo con todos los RA y CE encontrados en el docum
     print("\n" + "*"*80)
     input("\nCopia este prompt y guardalo para usarlo mas tarde. Presiona Enter para continuar...")
 
-def get_json_path():
-    """Obtiene la ruta correcta del archivo JSON para AppImage y modo normal"""
-    posibles_rutas = []
-
-    # 1. Directorio del AppImage/ejecutable (prioridad máxima)
-    if getattr(sys, 'frozen', False):
-        appimage_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
-        posibles_rutas.append(os.path.join(appimage_dir, 'datos_aules.json'))
-        print(f"Buscando en directorio AppImage: {appimage_dir}")
-
-    # 2. Directorio home del usuario
-    home_dir = os.path.expanduser("~")
-    posibles_rutas.append(os.path.join(home_dir, 'datos_aules.json'))
-
-    # 3. Directorio actual de trabajo
-    posibles_rutas.append(os.path.join(os.getcwd(), 'datos_aules.json'))
-
-    # 4. Directorio del script (modo desarrollo)
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    posibles_rutas.append(os.path.join(script_dir, 'datos_aules.json'))
-
-    # Buscar en todas las rutas posibles
-    for ruta in posibles_rutas:
-        if os.path.exists(ruta):
-            print(f"JSON encontrado en: {ruta}")
-            return ruta
-
-    # Si no se encuentra, devolver la ruta del directorio AppImage para creación
-    if getattr(sys, 'frozen', False):
-        return os.path.join(appimage_dir, 'datos_aules.json')
-    else:
-        return os.path.join(os.getcwd(), 'datos_aules.json')
+_RUTA_JSON = None
+_RUTA_JSON_FIJA = False
 
-def get_json_path():
+def _resolver_json_path():
     """Determina la ruta del archivo datos_aules.json con prioridad local y fallback robusto."""
     nombre_archivo = "datos_aules.json"
     
@@ -502,48 +1068,507 @@ def get_json_path():
     except:
         return local_path
 
-def cargar_datos_json():
-    """Carga los datos del archivo JSON en la ruta inteligente."""
+def get_json_path():
+    """
+    Ruta de datos_aules.json. Se resuelve una sola vez por proceso; solo se vuelve a buscar
+    si el archivo resuelto todavía no existe (p. ej. en el primer arranque).
+    """
+    global _RUTA_JSON
+    if not _RUTA_JSON_FIJA and (_RUTA_JSON is None or not os.path.exists(_RUTA_JSON)):
+        _RUTA_JSON = _resolver_json_path()
+    return _RUTA_JSON
+
+def fijar_json_path(ruta):
+    """Usa 'ruta' como datos_aules.json durante todo el proceso (--config), exista o no."""
+    global _RUTA_JSON, _RUTA_JSON_FIJA
+    _RUTA_JSON, _RUTA_JSON_FIJA = os.path.abspath(ruta), True
+
+def get_directorio_informes():
+    """Directorio donde se escriben métricas e informes (junto a datos_aules.json o AULES_INFORMES_DIR)."""
+    if os.environ.get("AULES_INFORMES_DIR"):
+        return os.environ["AULES_INFORMES_DIR"]
+    return os.path.join(os.path.dirname(get_json_path()), "informes")
+
+# --- CONFIGURACIÓN VALIDADA ---
+
+CLAVES_OBLIGATORIAS = ("base_url", "username", "password", "course_id")
+
+# Códigos de agregación en los que aggregationcoef actúa como peso relativo
+AGREGACIONES_CON_PESO = (10,)
+
+class ErrorConfiguracion(ValueError):
+    """datos_aules.json no cumple el esquema. 'errores' contiene un mensaje por problema."""
+
+    def __init__(self, errores):
+        super().__init__("; ".join(errores))
+        self.errores = list(errores)
+
+class ElementoConfig(typing.NamedTuple):
+    """CE de una categoría hija (un nombre suelto en el JSON equivale a solo 'nombre')."""
+    nombre: str
+    idnumber: str = ""
+    aggregationcoef: float = 1.0
+    formula: typing.Optional[str] = None
+
+class CategoriaConfig(typing.NamedTuple):
+    """Categoría hija (RA) con sus CE."""
+    nombre: str
+    aggregationcoef: float
+    elementos: typing.Tuple[ElementoConfig, ...]
+
+class ConfiguracionAules(typing.NamedTuple):
+    """
+    Vista tipada e inmutable de datos_aules.json ya validada. Los flujos siguen recibiendo el
+    diccionario original: como_dict() devuelve una copia que se puede modificar libremente.
+    """
+    ruta: str
+    base_url: str
+    username: str
+    password: str
+    course_id: int
+    categoria_padre: str
+    categorias_hijas: typing.Tuple[CategoriaConfig, ...]
+    configuracion_global: types.MappingProxyType
+    avisos: typing.Tuple[str, ...]
+    json_original: str
+    multicurso: bool = False  # sección de un archivo multicurso (no se puede guardar por encima)
+
+    def como_dict(self):
+        return json.loads(self.json_original)
+
+def _es_numero(valor):
+    return isinstance(valor, (int, float)) and not isinstance(valor, bool)
+
+def validar_configuracion(data, ruta=""):
+    """
+    Comprueba el esquema completo de datos_aules.json y construye una ConfiguracionAules.
+    Lanza ErrorConfiguracion con todos los problemas encontrados a la vez.
+    """
+    errores, avisos = [], []
+    if not isinstance(data, dict):
+        raise ErrorConfiguracion(["El JSON debe ser un objeto"])
+
+    for clave in CLAVES_OBLIGATORIAS:
+        if clave not in data:
+            errores.append(f"Falta la clave obligatoria '{clave}'")
+    for clave in ("base_url", "username", "password"):
+        if clave in data and not isinstance(data[clave], str):
+            errores.append(f"'{clave}' debe ser un texto")
+    course_id = data.get("course_id")
+    if "course_id" in data and not (isinstance(course_id, int) and not isinstance(course_id, bool)
+                                    or isinstance(course_id, str) and course_id.strip().isdigit()):
+        errores.append("'course_id' debe ser un número entero")
+
+    config_global = data.get("configuracion_global", {})
+    if not isinstance(config_global, dict):
+        errores.append("'configuracion_global' debe ser un objeto")
+        config_global = {}
+    for clave in ("grademax", "gradepass"):
+        if clave in config_global and not _es_numero(config_global[clave]):
+            errores.append(f"'configuracion_global.{clave}' debe ser numérico")
+    if "aggregation" in config_global and not (isinstance(config_global["aggregation"], int)
+                                               and not isinstance(config_global["aggregation"], bool)):
+        errores.append("'configuracion_global.aggregation' debe ser un código entero de Moodle")
+    for clave in ("aggregateonlygraded", "ce_as_category"):
+        # Archivos antiguos usan 0/1: se aceptan como hasta ahora (valor de verdad de Python)
+        if clave in config_global and not isinstance(config_global[clave], bool):
+            avisos.append(f"'configuracion_global.{clave}' debería ser true o false; "
+                          f"se interpreta {config_global[clave]!r} como {str(bool(config_global[clave])).lower()}")
+    if (_es_numero(config_global.get("grademax")) and _es_numero(config_global.get("gradepass"))
+            and config_global["gradepass"] > config_global["grademax"]):
+        avisos.append("'gradepass' es mayor que 'grademax': nadie podrá aprobar")
+    con_peso = config_global.get("aggregation") in AGREGACIONES_CON_PESO
+
+    categoria_padre = data.get("categoria_padre", "")
+    if not isinstance(categoria_padre, str):
+        errores.append("'categoria_padre' debe ser un texto")
+        categoria_padre = ""
+    categorias_hijas = data.get("categorias_hijas", [])
+    if not isinstance(categorias_hijas, list):
+        errores.append("'categorias_hijas' debe ser una lista")
+        categorias_hijas = []
+
+    idnumbers = {}
+    categorias = []
+    for i, categoria_hija in enumerate(categorias_hijas):
+        donde = f"categorias_hijas[{i}]"
+        if not isinstance(categoria_hija, dict) or not isinstance(categoria_hija.get("nombre"), str):
+            errores.append(f"{donde} debe ser un objeto con 'nombre' de texto")
+            continue
+        donde = f"RA '{categoria_hija['nombre']}'"
+        coef_hija = categoria_hija.get("aggregationcoef", 0.0)
+        if not _es_numero(coef_hija) or coef_hija < 0:
+            errores.append(f"{donde}: 'aggregationcoef' debe ser un número no negativo")
+            coef_hija = 0.0
+        lista = categoria_hija.get("elementos", [])
+        if not isinstance(lista, list):
+            errores.append(f"{donde}: 'elementos' debe ser una lista")
+            lista = []
+        elementos = []
+        for elemento_info in lista:
+            if isinstance(elemento_info, str):
+                elementos.append(ElementoConfig(elemento_info))
+                continue
+            if not isinstance(elemento_info, dict) or not isinstance(elemento_info.get("nombre"), str):
+                errores.append(f"{donde}: cada CE debe ser un texto o un objeto con 'nombre'")
+                continue
+            nombre, formula, idnumber, coef = _normalizar_elemento(elemento_info)
+            if not isinstance(idnumber, str):
+                errores.append(f"CE '{nombre}': 'idnumber' debe ser un texto")
+                idnumber = ""
+            if formula is not None and not isinstance(formula, str):
+                errores.append(f"CE '{nombre}': 'formula' debe ser un texto")
+                formula = None
+            if not _es_numero(coef) or coef < 0:
+                errores.append(f"CE '{nombre}': 'aggregationcoef' debe ser un número no negativo")
+                coef = 1.0
+            if idnumber:
+                if idnumber in idnumbers:
+                    # Moodle rechazará el segundo, pero el archivo se sigue pudiendo cargar y corregir
+                    avisos.append(f"idnumber duplicado '{idnumber}' en '{idnumbers[idnumber]}' y '{nombre}'")
+                idnumbers.setdefault(idnumber, nombre)
+            elementos.append(ElementoConfig(nombre, idnumber, float(coef), formula))
+        if con_peso and elementos and sum(e.aggregationcoef for e in elementos) == 0:
+            avisos.append(f"{donde}: todos los CE tienen peso 0 en una media ponderada")
+        categorias.append(CategoriaConfig(categoria_hija["nombre"], float(coef_hija), tuple(elementos)))
+    if con_peso and categorias and sum(c.aggregationcoef for c in categorias) == 0:
+        avisos.append("Todas las RA tienen peso 0 en una media ponderada (aggregationcoef por defecto 0.0)")
+
+    if errores:
+        raise ErrorConfiguracion(errores)
+    return ConfiguracionAules(
+        ruta=ruta,
+        base_url=data["base_url"],
+        username=data["username"],
+        password=data["password"],
+        course_id=int(course_id),
+        categoria_padre=categoria_padre,
+        categorias_hijas=tuple(categorias),
+        configuracion_global=types.MappingProxyType(dict(config_global)),
+        avisos=tuple(avisos),
+        json_original=json.dumps(data, ensure_ascii=False)
+    )
+
+# Última configuración leída: (ruta, (mtime_ns, tamaño), ConfiguracionAules)
+_CACHE_CONFIG = None
+_CERROJO_CONFIG = threading.Lock()
+
+def cargar_configuracion():
+    """
+    Lee y valida datos_aules.json una sola vez mientras el archivo no cambie (mtime y tamaño).
+    Devuelve None si el archivo no existe; lanza ErrorConfiguracion si no es válido.
+    Se lee con el lector incremental, así que también acepta un archivo multicurso: se validan
+    todas las secciones y se devuelve la primera (marcada con multicurso=True).
+    """
+    global _CACHE_CONFIG
     json_path = get_json_path()
-    
-    if not os.path.exists(json_path):
+    try:
+        estado = os.stat(json_path)
+    except OSError:
         # En el primer arranque, esto es normal.
         return None
+    firma = (estado.st_mtime_ns, estado.st_size)
+    with _CERROJO_CONFIG:
+        if _CACHE_CONFIG and _CACHE_CONFIG[0] == json_path and _CACHE_CONFIG[1] == firma:
+            return _CACHE_CONFIG[2]
+        configs = iterar_configuraciones(json_path)
+        config = next(configs, None)
+        if config is None:
+            raise ErrorConfiguracion(["El archivo multicurso no tiene ningún curso"])
+        if config.multicurso:
+            total = 1 + sum(1 for _ in configs)
+            config = config._replace(avisos=config.avisos + (
+                f"Archivo multicurso con {total} cursos: se usa el primero (curso {config.course_id})",))
+        _CACHE_CONFIG = (json_path, firma, config)
+        return config
 
+def cargar_datos_json():
+    """
+    Carga los datos del archivo JSON en la ruta inteligente (copia modificable del diccionario).
+    Devuelve None solo si el archivo no existe; si existe pero no es válido lanza ErrorConfiguracion,
+    para que nadie lo confunda con un primer arranque y lo sobrescriba.
+    """
     try:
-        with open(json_path, 'r', encoding='utf-8') as file:
-            data = json.load(file)
-            
-            # Verificar claves básicas para asegurar integridad
-            required = ["base_url", "username", "password", "course_id"]
-            if all(k in data for k in required):
-                return data
-            return None
-    except Exception as e:
-        print(f"Error al cargar JSON: {e}")
-        return None
+        config = cargar_configuracion()
+    except (OSError, UnicodeDecodeError) as e:
+        raise ErrorConfiguracion([f"No se pudo leer {get_json_path()}: {e}"])
+    return config.como_dict() if config else None
 
 def guardar_datos_json(data):
     """Guarda los datos en el archivo JSON (local o Documentos)."""
+    global _CACHE_CONFIG
     json_path = get_json_path()
     try:
+        if os.path.exists(json_path) and es_archivo_multicurso(json_path):
+            # Escribir una sola sección borraría el resto de cursos del archivo
+            print(f"Error al guardar JSON: {json_path} es un archivo multicurso; edítalo a mano")
+            return False
         with open(json_path, 'w', encoding='utf-8') as file:
             json.dump(data, file, indent=2, ensure_ascii=False)
+        with _CERROJO_CONFIG:
+            _CACHE_CONFIG = None
         return True
     except Exception as e:
         print(f"Error al guardar JSON: {e}")
         return False
 
-def obtener_elementos_curso(client, course_id):
+def editar_nodo_configuracion(data, clave, campo, valor):
+    """
+    Cambia un campo de un nodo de la configuración (diccionario). 'clave' identifica el nodo por
+    nombre: ("padre",), ("ra", nombre_ra) o ("ce", nombre_ra, nombre_ce). Un CE escrito como texto
+    suelto pasa a objeto al darle más campos; una fórmula vacía se quita. Devuelve False si no está.
+    """
+    if clave[0] == "padre":
+        data["categoria_padre"] = valor
+        return True
+    ra = next((ra for ra in data.get("categorias_hijas", []) if ra["nombre"] == clave[1]), None)
+    if ra is None:
+        return False
+    if clave[0] == "ra":
+        nodo = ra
+    else:
+        elementos = ra.get("elementos", [])
+        indice = next((i for i, e in enumerate(elementos) if _normalizar_elemento(e)[0] == clave[2]), None)
+        if indice is None:
+            return False
+        nodo = elementos[indice]
+        if isinstance(nodo, str):
+            if campo == "nombre":
+                elementos[indice] = valor
+                return True
+            nodo = elementos[indice] = {"nombre": nodo}
+    if campo == "formula" and not valor:
+        nodo.pop("formula", None)
+    else:
+        nodo[campo] = valor
+    return True
+
+def guardar_ediciones_json(ediciones):
+    """
+    Guarda en datos_aules.json solo los nodos editados: relee el archivo del disco, aplica cada
+    edición (clave, campo, valor) de editar_nodo_configuracion y lo escribe. Lo demás queda como
+    esté en el disco, aunque se haya cambiado fuera del editor después de cargarlo.
+    Devuelve (datos guardados, claves que ya no están en el archivo) o (None, []) si no se pudo.
+    """
+    json_path = get_json_path()
+    try:
+        with open(json_path, 'r', encoding='utf-8') as file:
+            data = json.load(file)
+    except (OSError, ValueError) as e:
+        print(f"Error al leer JSON: {e}")
+        return None, []
+    perdidas = [clave for clave, campo, valor in ediciones if not editar_nodo_configuracion(data, clave, campo, valor)]
+    if not guardar_datos_json(data):
+        return None, []
+    return data, perdidas
+
+# --- CONFIGURACIÓN MULTICURSO (LECTURA INCREMENTAL) ---
+
+class LectorJSONIncremental:
+    """
+    Lee un JSON grande por trozos sin cargarlo entero: el búfer solo contiene el valor que se
+    está decodificando, así que la memoria depende del tamaño de cada sección, no del archivo.
+    """
+
+    TROZO = 64 * 1024
+
+    def __init__(self, archivo):
+        self.archivo = archivo
+        self.bufer = ""
+        self.pos = 0
+        self.fin = False
+        self.decodificador = json.JSONDecoder()
+
+    def _llenar(self):
+        """Añade un trozo al búfer descartando lo ya consumido. False si no queda nada por leer."""
+        if self.fin:
+            return False
+        trozo = self.archivo.read(self.TROZO)
+        self.bufer = self.bufer[self.pos:] + trozo
+        self.pos = 0
+        self.fin = not trozo
+        return bool(trozo)
+
+    def siguiente_caracter(self):
+        """Salta espacios y devuelve el siguiente carácter significativo sin consumirlo ('' al final)."""
+        while True:
+            while self.pos < len(self.bufer) and self.bufer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.bufer) or not self._llenar():
+                return self.bufer[self.pos:self.pos + 1]
+
+    def consumir(self, esperados):
+        """Consume el siguiente carácter significativo, que debe estar en 'esperados'."""
+        caracter = self.siguiente_caracter()
+        if not caracter or caracter not in esperados:
+            raise ErrorConfiguracion([f"JSON mal formado: se esperaba {' o '.join(esperados)} y se encontró '{caracter}'"])
+        self.pos += 1
+        return caracter
+
+    # Caracteres que importan al buscar el final de un objeto, lista o texto
+    PATRON_ESTRUCTURA = re.compile(r'[\\"\[\]{}]')
+    PATRON_FIN_ESCALAR = re.compile(r'[,\]}\s]')
+
+    def _fin_valor(self, estado):
+        """
+        Avanza la búsqueda del final del valor que empieza en self.pos por lo que haya llegado al
+        búfer. 'estado' = [explorado, profundidad, en_texto] se conserva entre trozos, así que cada
+        carácter se examina una sola vez. True si el valor ya está completo en el búfer.
+        """
+        texto, inicio = self.bufer, self.pos
+        i = inicio + estado[0]
+        if texto[inicio:inicio + 1] not in ('{', '[', '"'):
+            m = self.PATRON_FIN_ESCALAR.search(texto, max(i, inicio + 1))
+            estado[0] = (m.start() if m else len(texto)) - inicio
+            return m is not None
+        profundidad, en_texto = estado[1], estado[2]
+        completo = False
+        while True:
+            m = self.PATRON_ESTRUCTURA.search(texto, i)
+            if not m:
+                i = len(texto)
+                break
+            c, i = m.group(), m.end()
+            if c == "\\":
+                if i >= len(texto):
+                    # La barra es el último carácter: se vuelve a mirar cuando llegue el siguiente
+                    i -= 1
+                    break
+                i += 1
+            elif c == '"':
+                en_texto = not en_texto
+                if not en_texto and profundidad == 0:
+                    completo = True
+                    break
+            elif not en_texto:
+                profundidad += 1 if c in "{[" else -1
+                if profundidad == 0:
+                    completo = True
+                    break
+        estado[:] = [i - inicio, profundidad, en_texto]
+        return completo
+
+    def valor(self):
+        """
+        Decodifica el siguiente valor JSON completo, leyendo más trozos si hace falta. Primero se
+        localiza su final sin volver a examinar lo ya leído y después se decodifica una sola vez.
+        """
+        self.siguiente_caracter()
+        estado = [0, 0, False]
+        while not self._fin_valor(estado) and self._llenar():
+            pass
+        try:
+            valor, final = self.decodificador.raw_decode(self.bufer, self.pos)
+        except json.JSONDecodeError as e:
+            raise ErrorConfiguracion([f"JSON mal formado: {e}"])
+        self.pos = final
+        return valor
+
+def iterar_secciones_json(ruta, clave_lista="cursos"):
+    """
+    Recorre un JSON con forma {claves comunes..., "cursos": [sección, ...]} y produce
+    (comunes, sección) de una en una. Las claves comunes deben ir antes de la lista.
+    Un archivo sin la lista se trata como una única sección, con comunes=None.
+    """
+    with open(ruta, 'r', encoding='utf-8') as archivo:
+        lector = LectorJSONIncremental(archivo)
+        comunes, hubo_lista = {}, False
+        lector.consumir("{")
+        if lector.siguiente_caracter() == "}":
+            lector.consumir("}")
+        else:
+            while True:
+                clave = lector.valor()
+                lector.consumir(":")
+                if clave == clave_lista:
+                    hubo_lista = True
+                    lector.consumir("[")
+                    if lector.siguiente_caracter() == "]":
+                        lector.consumir("]")
+                    else:
+                        while True:
+                            yield comunes, lector.valor()
+                            if lector.consumir(",]") == "]":
+                                break
+                elif hubo_lista:
+                    raise ErrorConfiguracion([f"La clave común '{clave}' debe ir antes de '{clave_lista}'"])
+                else:
+                    comunes[clave] = lector.valor()
+                if lector.consumir(",}") == "}":
+                    break
+        if not hubo_lista:
+            yield None, comunes
+
+def es_archivo_multicurso(ruta, clave_lista="cursos"):
+    """True si el JSON tiene la lista de secciones de iterar_secciones_json (solo lee hasta encontrarla)."""
+    try:
+        with open(ruta, 'r', encoding='utf-8') as archivo:
+            lector = LectorJSONIncremental(archivo)
+            lector.consumir("{")
+            while lector.siguiente_caracter() not in ("}", ""):
+                if lector.valor() == clave_lista:
+                    return True
+                lector.consumir(":")
+                lector.valor()
+                if lector.consumir(",}") == "}":
+                    break
+    except ErrorConfiguracion:
+        pass
+    return False
+
+def iterar_configuraciones(ruta):
+    """
+    Produce una ConfiguracionAules validada por cada curso/módulo de un archivo multicurso
+    (marcadas con multicurso=True) o la única de un archivo simple. Cada sección hereda las claves
+    comunes (base_url, credenciales...) y puede sobrescribirlas; 'configuracion_global' se combina
+    clave a clave.
+    """
+    for i, (comunes, seccion) in enumerate(iterar_secciones_json(ruta)):
+        if not isinstance(seccion, dict):
+            raise ErrorConfiguracion([f"cursos[{i}] debe ser un objeto"])
+        data = {**(comunes or {}), **seccion}
+        if isinstance((comunes or {}).get("configuracion_global"), dict) and isinstance(seccion.get("configuracion_global"), dict):
+            data["configuracion_global"] = {**comunes["configuracion_global"], **seccion["configuracion_global"]}
+        try:
+            config = validar_configuracion(data, ruta)
+        except ErrorConfiguracion as e:
+            nombre = seccion.get("nombre") or seccion.get("course_id", i)
+            raise ErrorConfiguracion([f"curso '{nombre}': {error}" for error in e.errores])
+        yield config if comunes is None else config._replace(multicurso=True)
+
+# Nombre del análisis de la página del árbol en la caché de respuestas (cambia si cambia el formato)
+ANALISIS_ELEMENTOS = "elementos_v2"
+
+def _ajustes_fila(row):
+    """
+    Datos que la página del árbol ya muestra en una fila: el peso (campo weight_<id> en modo edición)
+    y si el elemento es calculado (icono de la calculadora). Solo incluye lo que aparece.
+    """
+    ajustes = {}
+    peso = row.find("input", attrs={"name": re.compile(r"^weight_\d+$")})
+    if peso is not None and peso.get("value", "").strip():
+        ajustes["peso"] = _numero_formulario(peso["value"])
+    if row.find(class_="fa-calculator") or row.find("img", src=re.compile(r"i/calc")):
+        ajustes["calculada"] = True
+    return ajustes
+
+def obtener_elementos_curso(client, course_id, cache=True):
     """Obtiene todos los elementos de calificación del curso con análisis mejorado."""
     client._log("Obteniendo elementos del curso...")
-    r = client.get(f"grade/edit/tree/index.php?id={course_id}")
+    r = client.get(f"grade/edit/tree/index.php?id={course_id}", cache=cache)
     
     if r.status_code != 200:
         client._log(f"Error al acceder al curso: {r.status_code}", "error")
         return []
+
+    # Página idéntica a una ya analizada: se reutiliza el resultado guardado
+    huella = hashlib.sha256(r.content).hexdigest()
+    if client.cache_respuestas is not None:
+        previos = client.cache_respuestas.analisis(huella, ANALISIS_ELEMENTOS)
+        if previos is not None:
+            return previos
     
-    soup = BeautifulSoup(r.text, "html.parser")
+    soup = client.parsear_html(r.text)
     elementos = []
     
     # Encontrar todas las filas de la tabla de calificaciones
@@ -592,7 +1617,8 @@ def obtener_elementos_curso(client, course_id):
                     "id": category_id,  # Mantener ID completo (cg183428)
                     "nombre": name,
                     "nivel": nivel,
-                    "categoria_padre_id": parent_category_id if parent_category_id else ''
+                    "categoria_padre_id": parent_category_id if parent_category_id else '',
+                    **_ajustes_fila(row)
                 })
                 
             elif 'item' in row.get('class', []):
@@ -634,13 +1660,325 @@ def obtener_elementos_curso(client, course_id):
                     "id": item_id,  # ID completo (ig1281062)
                     "id_numerico": item_id_numeric,  # ID numérico por si acaso
                     "nombre": name,
-                    "categoria_id": parent_category_id if parent_category_id else ''
+                    "categoria_id": parent_category_id if parent_category_id else '',
+                    **_ajustes_fila(row)
                 })
                 
         except Exception as e:
-            print(f"Advertencia: Error al procesar fila: {e}")
+            client._log(f"Error al procesar una fila del árbol de calificación: {e}", "error")
             continue
-    
+
+    # Solo si la página marca los elementos calculados se sabe cuáles NO tienen fórmula
+    if any("calculada" in e for e in elementos):
+        for e in elementos:
+            e.setdefault("calculada", False)
+
+    if client.cache_respuestas is not None:
+        try:
+            client.cache_respuestas.guardar_analisis(huella, ANALISIS_ELEMENTOS, elementos)
+        except OSError:
+            pass
+    return elementos
+
+# --- CACHÉ EN DISCO DE RESPUESTAS HTTP ---
+
+# Segundos que se reutiliza una página de solo lectura (árbol de calificaciones) sin volver a pedirla
+TTL_CACHE_RESPUESTAS = int(os.environ.get("AULES_HTTP_CACHE_TTL", "120"))
+
+# Operaciones GET de solo lectura que se pueden servir desde la caché
+OPERACIONES_CACHEABLES = ("tree-fetch",)
+
+# La sesskey de las páginas guardadas (enlaces, campos ocultos, M.cfg) no llega al disco
+PATRON_SESSKEY = re.compile(r"""sesskey["']?\s*[=:]\s*["']?(\w+)|name=["']sesskey["'][^>]*?value=["'](\w+)""")
+
+def quitar_sesskey(texto):
+    """'texto' con cada sesskey que aparece en él sustituida por 'SESSKEY'."""
+    for valores in set(PATRON_SESSKEY.findall(texto)):
+        for valor in filter(None, valores):
+            texto = texto.replace(valor, "SESSKEY")
+    return texto
+
+class CacheRespuestas:
+    """
+    Caché en disco de páginas de solo lectura, compartida entre ejecuciones. Cada respuesta se guarda
+    en <directorio>/<curso>/<sha1(url)>.json; los resultados de analizar una página se guardan aparte,
+    indexados por el SHA-256 de su contenido, para no volver a analizar una página idéntica.
+    Son páginas autenticadas: se guardan sin la sesskey y solo las puede leer el usuario
+    (directorios 0o700, archivos 0o600).
+    """
+
+    MAX_ANALISIS = 64
+
+    def __init__(self, directorio=None, ttl=None):
+        self.directorio = directorio or os.path.join(get_directorio_cache(), "http")
+        self.ttl = TTL_CACHE_RESPUESTAS if ttl is None else ttl
+        self._crear_directorio(self.directorio)
+        self._crear_directorio(os.path.join(self.directorio, "analisis"))
+
+    @staticmethod
+    def _crear_directorio(ruta):
+        os.makedirs(ruta, mode=0o700, exist_ok=True)
+        os.chmod(ruta, 0o700)  # makedirs no cambia un directorio que ya existía
+
+    @staticmethod
+    def _escribir(ruta, valor):
+        """Escribe 'valor' como JSON en un archivo que solo puede leer el usuario."""
+        with os.fdopen(os.open(ruta, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8') as f:
+            json.dump(valor, f, ensure_ascii=False)
+
+    def _ruta(self, curso, url):
+        return os.path.join(self.directorio, f"curso_{curso}", hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def obtener(self, curso, url):
+        """Respuesta guardada ({url, status, texto, huella, guardado}) o None si no existe o ha caducado."""
+        try:
+            with open(self._ruta(curso, url), encoding="utf-8") as f:
+                entrada = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entrada.get("url") != url or time.time() - entrada.get("guardado", 0) > self.ttl:
+            return None
+        return entrada
+
+    def guardar(self, curso, url, r):
+        """Guarda una respuesta 200 recién recibida."""
+        ruta = self._ruta(curso, url)
+        self._crear_directorio(os.path.dirname(ruta))
+        entrada = {"url": url, "status": r.status_code, "guardado": time.time(),
+                   "huella": hashlib.sha256(r.content).hexdigest(), "texto": quitar_sesskey(r.text)}
+        temporal = ruta + ".tmp"
+        self._escribir(temporal, entrada)
+        os.replace(temporal, ruta)
+
+    def invalidar(self, curso):
+        """Descarta todas las respuestas guardadas del curso."""
+        shutil.rmtree(os.path.join(self.directorio, f"curso_{curso}"), ignore_errors=True)
+
+    def analisis(self, huella, clave):
+        """Resultado guardado de analizar la página con esa huella, o None."""
+        try:
+            with open(os.path.join(self.directorio, "analisis", f"{huella}_{clave}.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def guardar_analisis(self, huella, clave, valor):
+        """Guarda el resultado de analizar una página, conservando solo los MAX_ANALISIS más recientes."""
+        directorio = os.path.join(self.directorio, "analisis")
+        self._escribir(os.path.join(directorio, f"{huella}_{clave}.json"), valor)
+        ficheros = sorted((os.path.join(directorio, n) for n in os.listdir(directorio)), key=os.path.getmtime)
+        for ruta in ficheros[:-self.MAX_ANALISIS]:
+            os.remove(ruta)
+
+def crear_cache_respuestas():
+    """Caché de respuestas por defecto del cliente; None si no se puede usar el directorio."""
+    try:
+        return CacheRespuestas()
+    except OSError:
+        return None
+
+def respuesta_desde_cache(entrada):
+    """Reconstruye un requests.Response a partir de una entrada de CacheRespuestas."""
+    r = requests.Response()
+    r.status_code = entrada["status"]
+    r.url = entrada["url"]
+    r.encoding = "utf-8"
+    r._content = entrada["texto"].encode("utf-8")
+    r.headers["X-Aules-Cache"] = "hit"
+    return r
+
+# --- CACHÉ LOCAL DE ESTRUCTURAS (SQLite) ---
+
+# Segundos que una estructura leída de Aules se considera vigente
+TTL_CACHE_ESTRUCTURAS = int(os.environ.get("AULES_CACHE_TTL", "300"))
+
+# Operaciones que modifican el curso y dejan obsoleta su estructura en caché
+OPERACIONES_ESCRITURA = ("create", "modify", "formula", "delete", "import")
+
+def get_directorio_cache():
+    """Directorio de las cachés locales (junto a datos_aules.json o AULES_CACHE_DIR)."""
+    if os.environ.get("AULES_CACHE_DIR"):
+        return os.environ["AULES_CACHE_DIR"]
+    return os.path.join(os.path.dirname(get_json_path()), "cache")
+
+def curso_de_peticion(url, datos=None):
+    """Deduce el curso al que afecta una petición (courseid/gpr_courseid en URL, formulario o payload AJAX)."""
+    if isinstance(datos, dict):
+        for clave in ("courseid", "gpr_courseid"):
+            if datos.get(clave):
+                return str(datos[clave])
+        if "grade/import/" in url and datos.get("id"):
+            return str(datos["id"])
+    texto = url
+    if datos is not None:
+        texto += " " + (datos if isinstance(datos, str) else json.dumps(datos, default=str))
+    m = re.search(r'(?:courseid|gpr_courseid)"?\s*[=:]\s*"?(\d+)', texto)
+    if not m and "grade/" in url:
+        m = re.search(r'[?&]id=(\d+)', url)
+    return m.group(1) if m else None
+
+class CacheEstructuras:
+    """
+    Caché SQLite de la estructura de calificación de cada curso (nodos, IDs, idnumber, pesos y fórmulas).
+    La tabla 'nodos' se reemplaza entera en cada lectura de Aules; 'propiedades' guarda lo que el propio
+    script ha escrito (idnumber, aggregationcoef, fórmula), que la página del árbol no muestra.
+    """
+
+    def __init__(self, ruta=None, ttl=None):
+        self.ruta = ruta or os.path.join(get_directorio_cache(), "estructuras.sqlite")
+        self.ttl = TTL_CACHE_ESTRUCTURAS if ttl is None else ttl
+        os.makedirs(os.path.dirname(os.path.abspath(self.ruta)), exist_ok=True)
+        with self._conectar() as conexion:
+            conexion.executescript("""
+                CREATE TABLE IF NOT EXISTS cursos (
+                    base_url TEXT, course_id TEXT, actualizado REAL, vigente INTEGER,
+                    PRIMARY KEY (base_url, course_id));
+                CREATE TABLE IF NOT EXISTS nodos (
+                    base_url TEXT, course_id TEXT, orden INTEGER, id TEXT, tipo TEXT, nombre TEXT,
+                    nivel INTEGER, padre_id TEXT, id_numerico TEXT, actualizado REAL,
+                    PRIMARY KEY (base_url, course_id, id));
+                CREATE TABLE IF NOT EXISTS propiedades (
+                    base_url TEXT, course_id TEXT, id TEXT, idnumber TEXT, aggregationcoef REAL,
+                    formula TEXT, actualizado REAL,
+                    PRIMARY KEY (base_url, course_id, id));
+                CREATE TABLE IF NOT EXISTS huellas (
+                    base_url TEXT, course_id TEXT, categoria_padre TEXT, huella TEXT, arbol TEXT,
+                    actualizado REAL, PRIMARY KEY (base_url, course_id, categoria_padre));
+            """)
+
+    def _conectar(self):
+        # Una conexión por operación: la GUI usa la caché desde varios hilos
+        conexion = sqlite3.connect(self.ruta, timeout=10)
+        conexion.row_factory = sqlite3.Row
+        return contextlib.closing(conexion)
+
+    def obtener(self, base_url, course_id):
+        """Elementos en caché con el formato de obtener_elementos_curso, o None si no hay o están obsoletos."""
+        with self._conectar() as conexion:
+            curso = conexion.execute("SELECT actualizado, vigente FROM cursos WHERE base_url=? AND course_id=?",
+                                     (base_url, str(course_id))).fetchone()
+            if not curso or not curso["vigente"] or time.time() - curso["actualizado"] > self.ttl:
+                return None
+            filas = conexion.execute(
+                "SELECT n.*, p.idnumber, p.aggregationcoef, p.formula FROM nodos n "
+                "LEFT JOIN propiedades p ON p.base_url=n.base_url AND p.course_id=n.course_id AND p.id=n.id "
+                "WHERE n.base_url=? AND n.course_id=? ORDER BY n.orden", (base_url, str(course_id))).fetchall()
+        elementos = []
+        for fila in filas:
+            if fila["tipo"] == "category":
+                elemento = {"tipo": "category", "id": fila["id"], "nombre": fila["nombre"],
+                            "nivel": fila["nivel"], "categoria_padre_id": fila["padre_id"]}
+            else:
+                elemento = {"tipo": "item", "id": fila["id"], "id_numerico": fila["id_numerico"],
+                            "nombre": fila["nombre"], "categoria_id": fila["padre_id"]}
+            for clave in ("idnumber", "aggregationcoef", "formula"):
+                if fila[clave] is not None:
+                    elemento[clave] = fila[clave]
+            elementos.append(elemento)
+        return elementos
+
+    def guardar(self, base_url, course_id, elementos):
+        """Reemplaza los nodos del curso por una lectura recién hecha en Aules."""
+        ahora = time.time()
+        course_id = str(course_id)
+        with self._conectar() as conexion, conexion:
+            conexion.execute("DELETE FROM nodos WHERE base_url=? AND course_id=?", (base_url, course_id))
+            conexion.executemany(
+                "INSERT OR REPLACE INTO nodos VALUES (?,?,?,?,?,?,?,?,?,?)",
+                [(base_url, course_id, i, e["id"], e["tipo"], e["nombre"], e.get("nivel", 0),
+                  e.get("categoria_padre_id", e.get("categoria_id", "")), e.get("id_numerico", ""), ahora)
+                 for i, e in enumerate(elementos)])
+            # Las propiedades de nodos que ya no existen se descartan
+            conexion.execute("DELETE FROM propiedades WHERE base_url=? AND course_id=? AND id NOT IN "
+                             "(SELECT id FROM nodos WHERE base_url=? AND course_id=?)",
+                             (base_url, course_id, base_url, course_id))
+            conexion.execute("INSERT OR REPLACE INTO cursos VALUES (?,?,?,1)", (base_url, course_id, ahora))
+
+    def anotar(self, base_url, course_id, elemento_id, **campos):
+        """Recuerda idnumber / aggregationcoef / formula escritos por el script para un nodo ('cg…' / 'ig…')."""
+        campos = {k: v for k, v in campos.items() if k in ("idnumber", "aggregationcoef", "formula")}
+        if not campos:
+            return
+        with self._conectar() as conexion, conexion:
+            conexion.execute("INSERT OR IGNORE INTO propiedades (base_url, course_id, id) VALUES (?,?,?)",
+                             (base_url, str(course_id), str(elemento_id)))
+            asignaciones = ", ".join(f"{k}=?" for k in campos)
+            conexion.execute(f"UPDATE propiedades SET {asignaciones}, actualizado=? WHERE base_url=? AND course_id=? AND id=?",
+                             list(campos.values()) + [time.time(), base_url, str(course_id), str(elemento_id)])
+
+    def propiedades(self, base_url, course_id):
+        """{id: {idnumber, aggregationcoef, formula}} anotados para el curso, aunque su estructura esté obsoleta."""
+        with self._conectar() as conexion:
+            filas = conexion.execute("SELECT id, idnumber, aggregationcoef, formula FROM propiedades "
+                                     "WHERE base_url=? AND course_id=?", (base_url, str(course_id))).fetchall()
+        return {fila["id"]: {clave: fila[clave] for clave in ("idnumber", "aggregationcoef", "formula") if fila[clave] is not None}
+                for fila in filas}
+
+    def huella_aplicada(self, base_url, course_id, categoria_padre):
+        """Árbol de huellas (arbol_huellas) de la última configuración aplicada entera al curso, o None."""
+        with self._conectar() as conexion:
+            fila = conexion.execute("SELECT arbol FROM huellas WHERE base_url=? AND course_id=? AND categoria_padre=?",
+                                    (base_url, str(course_id), categoria_padre)).fetchone()
+        return json.loads(fila["arbol"]) if fila else None
+
+    def recordar_huella(self, base_url, course_id, categoria_padre, arbol):
+        """
+        Guarda el árbol de huellas aplicado al curso; con arbol=None lo olvida (p. ej. tras eliminar la
+        estructura) y, si además categoria_padre es None, olvida las de todas sus categorías padre.
+        """
+        with self._conectar() as conexion, conexion:
+            if arbol is None and categoria_padre is None:
+                conexion.execute("DELETE FROM huellas WHERE base_url=? AND course_id=?", (base_url, str(course_id)))
+            elif arbol is None:
+                conexion.execute("DELETE FROM huellas WHERE base_url=? AND course_id=? AND categoria_padre=?",
+                                 (base_url, str(course_id), categoria_padre))
+            else:
+                conexion.execute("INSERT OR REPLACE INTO huellas VALUES (?,?,?,?,?,?)",
+                                 (base_url, str(course_id), categoria_padre, arbol["huella"],
+                                  json.dumps(arbol, ensure_ascii=False), time.time()))
+
+    def invalidar(self, base_url, course_id):
+        """Marca la estructura del curso como obsoleta (se volverá a leer en el siguiente uso)."""
+        with self._conectar() as conexion, conexion:
+            conexion.execute("UPDATE cursos SET vigente=0 WHERE base_url=? AND course_id=?", (base_url, str(course_id)))
+
+def crear_cache_estructuras():
+    """Caché por defecto del cliente; None si no se puede abrir (el script funciona igual sin ella)."""
+    try:
+        return CacheEstructuras()
+    except (sqlite3.Error, OSError):
+        return None
+
+def anotar_en_cache(client, course_id, elemento_id, **campos):
+    """Anota en la caché las propiedades escritas en Aules (sin efecto si no hay caché)."""
+    if client.cache_estructuras is None:
+        return
+    try:
+        client.cache_estructuras.anotar(client.base_url, course_id, elemento_id, **campos)
+    except sqlite3.Error as e:
+        client._log(f"No se pudo anotar en la caché de estructuras: {e}", "error")
+
+def obtener_estructura_curso(client, course_id, forzar=False):
+    """
+    Estructura del curso desde la caché local si está vigente; si no (o con forzar=True),
+    la lee de Aules con obtener_elementos_curso y actualiza la caché.
+    """
+    cache = client.cache_estructuras
+    if cache is not None and not forzar:
+        try:
+            elementos = cache.obtener(client.base_url, course_id)
+        except sqlite3.Error as e:
+            client._log(f"Caché de estructuras no disponible: {e}", "error")
+            elementos = None
+        if elementos:
+            client._log(f"Usando estructura del curso en caché ({len(elementos)} elementos).")
+            return elementos
+    elementos = obtener_elementos_curso(client, course_id, cache=not forzar)
+    if cache is not None and elementos:
+        try:
+            cache.guardar(client.base_url, course_id, elementos)
+        except sqlite3.Error as e:
+            client._log(f"No se pudo actualizar la caché de estructuras: {e}", "error")
     return elementos
 
 def eliminar_elemento(client, course_id, elemento, verificar_eliminacion):
@@ -673,13 +2011,13 @@ def eliminar_elemento(client, course_id, elemento, verificar_eliminacion):
                 ]
                 for pattern in error_patterns:
                     if pattern in r.text.lower():
-                        print(f"✗ Error real detectado al eliminar {elemento['nombre']}")
+                        client._log(f"✗ Error real detectado al eliminar {elemento['nombre']}", "error")
                         return False
                 
                 # Si no encontramos errores específicos, asumimos que fue exitoso
                 return True
         else:
-            print(f"✗ Error HTTP {r.status_code} al eliminar {elemento['nombre']}")
+            client._log(f"✗ Error HTTP {r.status_code} al eliminar {elemento['nombre']}", "error")
             return False
             
     except Exception as e:
@@ -715,48 +2053,265 @@ def encontrar_elementos_por_categoria(elementos, categoria_id):
     
     return elementos_relacionados
 
-def get_categoria_payload(client, course_id, name, parent_id=0, config_global=None):
-    if config_global is None:
-        config_global = {"aggregation": 0, "aggregateonlygraded": 1, "grademax": 100, "gradepass": 50}
-
-    parent_id_num = limpiar_id(parent_id)
-    parent_field = f"&parentcategory={parent_id_num}" if parent_id_num else ""
-
-    formdata = (
-        f"id=0&courseid={course_id}&category=-1&gpr_type=edit&gpr_plugin=tree&gpr_courseid={course_id}&sesskey={client.sesskey}"
+def _diferencias_formula(elemento, formula):
+    """Motivos por los que la fórmula de un CE en Aules no coincide con la esperada ('' = sin fórmula)."""
+    actual = elemento.get("formula")
+    if actual is not None and elemento.get("calculada") is not None and bool(actual.strip()) != elemento["calculada"]:
+        actual = None  # el árbol contradice a la caché: la anotación está obsoleta
+    if actual is not None:
+        if "".join(actual.split()) != "".join(formula.split()):
+            return [f"fórmula '{actual}' en vez de '{formula}'" if formula and actual else
+                    "no tiene la fórmula del JSON" if formula else "tiene una fórmula que el JSON no define"]
+        return []
+    # Sin fórmula conocida, el árbol solo dice si el elemento es calculado
+    if elemento.get("calculada") is False and formula:
+        return ["no tiene la fórmula del JSON"]
+    if elemento.get("calculada") and not formula:
+        return ["tiene una fórmula que el JSON no define"]
+    return []
+
+def comparar_estructura(elementos, categoria_padre, categorias_hijas, config_global=None):
+    """
+    Compara la estructura de Aules (obtener_elementos_curso) con la del JSON bajo la categoría padre.
+    Devuelve {"estados": {id: (estado, motivo)}, "faltan": [(nombre, tipo, nombre_padre)],
+    "sin_verificar": {id: [campos]}} donde el estado es "ok", "sobra" (está en Aules pero no en el
+    JSON) o "difiere" (tipo, categoría, peso del árbol o, si se conocen, idnumber/peso/fórmula
+    distintos); "faltan" son los nodos del JSON que no están en Aules y "sin_verificar", el idnumber
+    o la fórmula esperados de los nodos en los que no se conoce el valor de Aules.
+    """
+    config_global = config_global or {}
+    tipo_ce = "category" if config_global.get("ce_as_category", False) else "item"
+    # El peso que muestra el árbol solo es aggregationcoef en las agregaciones ponderadas
+    peso_arbol = config_global.get("aggregation") in AGREGACIONES_CON_PESO
+    # nombre -> (tipo, nombre del padre, idnumber, aggregationcoef, fórmula) esperados
+    esperados = {categoria_padre: ("category", None, None, None, None)}
+    for categoria_hija in categorias_hijas:
+        esperados[categoria_hija["nombre"]] = ("category", categoria_padre, None, categoria_hija.get("aggregationcoef", 0.0), None)
+        for elemento_info in categoria_hija.get("elementos", []):
+            nombre, formula, idnumber, coef = _normalizar_elemento(elemento_info)
+            esperados[nombre] = (tipo_ce, categoria_hija["nombre"], idnumber, coef, formula or "")
+
+    estados, encontrados, sin_verificar = {}, set(), {}
+    padre = encontrar_categoria_por_nombre(elementos, categoria_padre)
+    if padre:
+        nombres_categoria = {e["id"]: e["nombre"] for e in elementos if e["tipo"] == "category"}
+        for e in [padre] + encontrar_elementos_por_categoria(elementos, padre["id"]):
+            nombre = categoria_padre if e is padre else e["nombre"]
+            if nombre not in esperados:
+                estados[e["id"]] = ("sobra", "no está en el JSON")
+                continue
+            encontrados.add(nombre)
+            tipo, nombre_padre, idnumber, coef, formula = esperados[nombre]
+            padre_real = nombres_categoria.get(e.get("categoria_padre_id") if e["tipo"] == "category" else e.get("categoria_id"))
+            motivos = []
+            if e["tipo"] != tipo:
+                motivos.append(f"es {e['tipo']} y se esperaba {tipo}")
+            if nombre_padre and padre_real != nombre_padre:
+                motivos.append(f"está en '{padre_real}' y no en '{nombre_padre}'")
+            if idnumber and e.get("idnumber") not in (None, idnumber):
+                motivos.append(f"idnumber '{e['idnumber']}' en vez de '{idnumber}'")
+            peso = e["peso"] if peso_arbol and e.get("peso") is not None else e.get("aggregationcoef")
+            if coef is not None and peso is not None and float(peso) != float(coef):
+                motivos.append(f"peso {peso} en vez de {coef}")
+            if formula is not None:
+                motivos += _diferencias_formula(e, formula)
+            estados[e["id"]] = ("difiere", "; ".join(motivos)) if motivos else ("ok", "")
+            campos = []
+            if idnumber and e.get("idnumber") is None:
+                campos.append("idnumber")
+            # El icono del árbol dice si hay fórmula, no cuál
+            if formula is not None and e.get("formula") is None and (e.get("calculada") is None or formula and e["calculada"]):
+                campos.append("fórmula")
+            if campos:
+                sin_verificar[e["id"]] = campos
+
+    faltan = [(nombre, tipo, nombre_padre) for nombre, (tipo, nombre_padre, _, _, _) in esperados.items()
+              if nombre not in encontrados]
+    return {"estados": estados, "faltan": faltan, "sin_verificar": sin_verificar}
+
+# --- PLANTILLAS DE PETICIÓN Y PLANES PRECOMPILADOS ---
+
+# Una misma plantilla de módulo genera los mismos formularios en todos los cursos salvo por el
+# curso, la sesskey y los IDs que asigna Moodle. Esos valores quedan como huecos {"$": nombre}
+# y se rellenan por curso; el resto del texto se construye una sola vez.
+VERSION_PLAN = 1
+
+FORM_CREAR_CATEGORIA = "core_grades\\form\\add_category"
+FORM_CREAR_ITEM = "core_grades\\form\\add_item"
+
+CONFIG_CREAR_POR_DEFECTO = {"aggregation": 0, "aggregateonlygraded": 1, "grademax": 100, "gradepass": 50}
+
+def hueco(nombre):
+    return {"$": nombre}
+
+def _segmentos(*partes):
+    """Plantilla de texto: lista de literales y huecos, con los literales contiguos ya unidos."""
+    segmentos = []
+    for parte in partes:
+        if isinstance(parte, str) and segmentos and isinstance(segmentos[-1], str):
+            segmentos[-1] += parte
+        elif parte != "":
+            segmentos.append(parte)
+    return segmentos
+
+def rellenar_plantilla(plantilla, valores):
+    """Sustituye los huecos de una plantilla de texto (lista de segmentos) o de formulario (dict)."""
+    if isinstance(plantilla, list):
+        return "".join(s if isinstance(s, str) else str(valores[s["$"]]) for s in plantilla)
+    return {k: valores[v["$"]] if isinstance(v, dict) else v for k, v in plantilla.items()}
+
+def payload_formulario_dinamico(formdata, formulario):
+    """Lista de llamadas para post_ajax con un único core_form_dynamic_form."""
+    return [{"index": 0, "methodname": "core_form_dynamic_form", "args": {"formdata": formdata, "form": formulario}}]
+
+def plantilla_crear_categoria(name, config_global=None, con_padre=True):
+    config_global = config_global or CONFIG_CREAR_POR_DEFECTO
+    return _segmentos(
+        "id=0&courseid=", hueco("course_id"), "&category=-1&gpr_type=edit&gpr_plugin=tree&gpr_courseid=", hueco("course_id"),
+        "&sesskey=", hueco("sesskey"),
         f"&_qf__core_grades_form_add_category=1&fullname={urllib.parse.quote(name)}&aggregation={config_global.get('aggregation', 0)}"
         f"&aggregateonlygraded={1 if config_global.get('aggregateonlygraded', True) else 0}&droplow=0&grade_item_gradetype=1"
         f"&grade_item_grademax={config_global.get('grademax', 100)}&grade_item_grademin=0&grade_item_gradepass={config_global.get('gradepass', 50)}"
-        f"&grade_item_weightoverride=0{parent_field}"
+        "&grade_item_weightoverride=0",
+        *(("&parentcategory=", hueco("parent")) if con_padre else ())
     )
 
-    return json.dumps([{
-        "index": 0,
-        "methodname": "core_form_dynamic_form",
-        "args": {"formdata": formdata, "form": "core_grades\\form\\add_category"}
-    }])
+def plantilla_crear_item(name, config_global=None, idnumber=""):
+    config_global = config_global or {"grademax": 100, "gradepass": 50}
+    id_field = f"&idnumber={urllib.parse.quote(idnumber)}" if idnumber else ""
+    return _segmentos(
+        "id=0&courseid=", hueco("course_id"), "&itemid=-1&itemtype=manual&gpr_type=edit&gpr_plugin=tree&gpr_courseid=", hueco("course_id"),
+        "&sesskey=", hueco("sesskey"),
+        f"&_qf__core_grades_form_add_item=1&itemname={urllib.parse.quote(name)}{id_field}"
+        f"&gradetype=1&grademax={config_global.get('grademax', 100)}&grademin=0.00&gradepass={config_global.get('gradepass', 50)}"
+        "&hidden=0&locked=0&parentcategory=", hueco("parent")
+    )
 
+def plantilla_modificar_item(item_nombre, config_global, item_idnumber="", aggregationcoef=1.0):
+    return {
+        "id": hueco("id"),
+        "courseid": hueco("course_id"),
+        "itemtype": "manual",
+        "gpr_type": "edit",
+        "gpr_plugin": "tree",
+        "gpr_courseid": hueco("course_id"),
+        "sesskey": hueco("sesskey"),
+        "_qf__edit_item_form": "1",
+        "mform_isexpanded_id_general": "1",
+        "itemname": item_nombre,
+        "iteminfo": "",
+        "idnumber": item_idnumber,
+        "gradetype": "1",
+        "grademax": config_global.get("grademax", 10),
+        "grademin": "0",
+        "gradepass": config_global.get("gradepass", 5),
+        "display": "0",
+        "decimals": "-1",
+        "hidden": "0",
+        "locked": "0",
+        "aggregationcoef": aggregationcoef,
+        "submitbutton": "Guarda+els+canvis"
+    }
 
-def get_item_payload(client, course_id, name, parent_id, config_global=None, idnumber=""):
-    if config_global is None:
-        config_global = {"grademax": 100, "gradepass": 50}
+def plantilla_modificar_categoria(categoria_nombre, config_global, aggregationcoef=0.0, idnumber=""):
+    return {
+        "id": hueco("id"),
+        "courseid": hueco("course_id"),
+        "gpr_type": "edit",
+        "gpr_plugin": "tree",
+        "gpr_courseid": hueco("course_id"),
+        "sesskey": hueco("sesskey"),
+        "_qf__edit_category_form": "1",
+        "fullname": categoria_nombre,
+        "aggregation": config_global.get("aggregation", 0),
+        "aggregateonlygraded": 1 if config_global.get("aggregateonlygraded", True) else 0,
+        "grade_item_grademax": config_global.get("grademax", 100),
+        "grade_item_idnumber": idnumber,
+        "grade_item_gradepass": config_global.get("gradepass", 50),
+        "grade_item_aggregationcoef": aggregationcoef,
+        "submitbutton": "Guarda+els+canvis"
+    }
+
+def plantilla_formula(formula):
+    return {
+        "id": hueco("id"),
+        "courseid": hueco("course_id"),
+        "section": "calculation",
+        "gpr_type": "edit",
+        "gpr_plugin": "tree",
+        "gpr_courseid": hueco("course_id"),
+        "sesskey": hueco("sesskey"),
+        "_qf__edit_calculation_form": "1",
+        "calculation": formula,
+        "submitbutton": "Guarda+els+canvis"
+    }
 
+def get_categoria_payload(client, course_id, name, parent_id=0, config_global=None):
+    """Llamada AJAX lista para post_ajax que crea una categoría."""
     parent_id_num = limpiar_id(parent_id)
-    id_field = f"&idnumber={urllib.parse.quote(idnumber)}" if idnumber else ""
+    plantilla = plantilla_crear_categoria(name, config_global, bool(parent_id_num))
+    valores = {"course_id": course_id, "sesskey": client.sesskey, "parent": parent_id_num}
+    return payload_formulario_dinamico(rellenar_plantilla(plantilla, valores), FORM_CREAR_CATEGORIA)
 
-    formdata = (
-        f"id=0&courseid={course_id}&itemid=-1&itemtype=manual&gpr_type=edit&gpr_plugin=tree&gpr_courseid={course_id}"
-        f"&sesskey={client.sesskey}&_qf__core_grades_form_add_item=1&itemname={urllib.parse.quote(name)}{id_field}"
-        f"&gradetype=1&grademax={config_global.get('grademax', 100)}&grademin=0.00&gradepass={config_global.get('gradepass', 50)}"
-        f"&hidden=0&locked=0&parentcategory={parent_id_num}"
-    )
+def get_item_payload(client, course_id, name, parent_id, config_global=None, idnumber=""):
+    """Llamada AJAX lista para post_ajax que crea un item manual."""
+    plantilla = plantilla_crear_item(name, config_global, idnumber)
+    valores = {"course_id": course_id, "sesskey": client.sesskey, "parent": limpiar_id(parent_id)}
+    return payload_formulario_dinamico(rellenar_plantilla(plantilla, valores), FORM_CREAR_ITEM)
+
+def huella_plan(categoria_padre, categorias_hijas, config_global):
+    """SHA-256 del contenido que determina un plan compilado."""
+    contenido = json.dumps([VERSION_PLAN, categoria_padre, categorias_hijas, config_global or {}],
+                           sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+def compilar_plan(categoria_padre, categorias_hijas, config_global=None):
+    """
+    Compila la estructura en un plan serializable (solo listas, dicts y texto): un paso por
+    categoría o item, en orden de creación, con sus plantillas de creación, modificación y fórmula.
+    'padre' es el índice del paso padre; sus IDs, el curso y la sesskey quedan como huecos.
+    Incluye el análisis de fórmulas, que fija el orden en que se aplican al final.
+    """
+    config_crear = config_global if config_global is not None else CONFIG_CREAR_POR_DEFECTO
+    ce_as_category = config_crear.get("ce_as_category", False)
 
-    return json.dumps([{
-        "index": 0,
-        "methodname": "core_form_dynamic_form",
-        "args": {"formdata": formdata, "form": "core_grades\\form\\add_item"}
-    }])
+    def paso(tipo, nombre, nivel, padre, grupo, coef, idnumber="", formula=None):
+        if tipo == "category":
+            crear = plantilla_crear_categoria(nombre, config_crear, padre is not None)
+            modificar = plantilla_modificar_categoria(nombre, config_crear, coef, idnumber)
+        else:
+            crear = plantilla_crear_item(nombre, config_crear, idnumber)
+            modificar = plantilla_modificar_item(nombre, config_crear, idnumber, coef)
+        return {"tipo": tipo, "nombre": nombre, "nivel": nivel, "padre": padre, "grupo": grupo,
+                "idnumber": idnumber, "aggregationcoef": coef, "formula": formula,
+                "crear": crear, "modificar": modificar}
 
+    pasos = [paso("category", categoria_padre, 0, None, None, 0.0)]
+    for i, categoria_hija in enumerate(categorias_hijas):
+        indice_hija = len(pasos)
+        pasos.append(paso("category", categoria_hija["nombre"], 1, 0, i, categoria_hija.get("aggregationcoef", 0.0)))
+        for elemento_info in categoria_hija["elementos"]:
+            e_nombre, e_formula, e_idnum, e_coef = _normalizar_elemento(elemento_info)
+            pasos.append(paso("category" if ce_as_category else "item", e_nombre, 2, indice_hija, i,
+                              e_coef, e_idnum, e_formula))
+    return {"version": VERSION_PLAN, "huella": huella_plan(categoria_padre, categorias_hijas, config_global),
+            "categoria_padre": categoria_padre, "total_grupos": len(categorias_hijas),
+            "analisis": analizar_formulas(categorias_hijas), "pasos": pasos}
+
+# Planes compilados en este proceso, por huella de contenido
+_PLANES_COMPILADOS = {}
+MAX_PLANES_COMPILADOS = 32
+
+def obtener_plan_compilado(categoria_padre, categorias_hijas, config_global=None):
+    """Plan de compilar_plan, reutilizado mientras la estructura y la configuración no cambien."""
+    huella = huella_plan(categoria_padre, categorias_hijas, config_global)
+    plan = _PLANES_COMPILADOS.get(huella)
+    if plan is None:
+        plan = compilar_plan(categoria_padre, categorias_hijas, config_global)
+        if len(_PLANES_COMPILADOS) >= MAX_PLANES_COMPILADOS:
+            _PLANES_COMPILADOS.pop(next(iter(_PLANES_COMPILADOS)), None)
+        _PLANES_COMPILADOS[huella] = plan
+    return plan
 
 def obtener_id_categoria(client, course_id, nombre_categoria):
     """Función auxiliar para obtener el ID de una categoría por su nombre"""
@@ -769,7 +2324,7 @@ def obtener_id_categoria(client, course_id, nombre_categoria):
         }
     }]
     
-    r = client.post_ajax("core_form_dynamic_form", payload)
+    r = client.post_ajax("core_form_dynamic_form", payload, operacion="tree-fetch")
     if not r: return 0
     
     pattern = r'<option value="(\d+)"[\s\n]*>([^<]+)</option>'
@@ -785,8 +2340,8 @@ def obtener_id_item(client, course_id, nombre_item):
     try:
         r = client.get(f"grade/edit/tree/index.php?id={course_id}")
         if r.status_code != 200: return None
-        
-        soup = BeautifulSoup(r.text, "html.parser")
+    
+        soup = client.parsear_html(r.text)
         trs = soup.find_all("tr", class_="item")
         
         for tr in trs:
@@ -801,38 +2356,16 @@ def obtener_id_item(client, course_id, nombre_item):
         print(f"Error en obtener_id_item: {e}")
         return None
 
-def modificar_gradepass_item(client, course_id, item_id, item_nombre, config_global, item_idnumber="", aggregationcoef=1.0):
+def modificar_gradepass_item(client, course_id, item_id, item_nombre, config_global, item_idnumber="", aggregationcoef=1.0, plantilla=None):
     """Modifica el campo gradepass, idnumber y aggregationcoef de un item específico"""
     client._log(f"Modificando item: {item_nombre}")
     item_id_num = limpiar_id(item_id)
-
-    formdata = {
-        "id": item_id_num,
-        "courseid": course_id,
-        "itemtype": "manual",
-        "gpr_type": "edit",
-        "gpr_plugin": "tree",
-        "gpr_courseid": course_id,
-        "sesskey": client.sesskey,
-        "_qf__edit_item_form": "1",
-        "mform_isexpanded_id_general": "1",
-        "itemname": item_nombre,
-        "iteminfo": "",
-        "idnumber": item_idnumber,
-        "gradetype": "1",
-        "grademax": config_global.get("grademax", 10),
-        "grademin": "0",
-        "gradepass": config_global.get("gradepass", 5),
-        "display": "0",
-        "decimals": "-1",
-        "hidden": "0",
-        "locked": "0",
-        "aggregationcoef": aggregationcoef,
-        "submitbutton": "Guarda+els+canvis"
-    }
+    plantilla = plantilla or plantilla_modificar_item(item_nombre, config_global, item_idnumber, aggregationcoef)
+    formdata = rellenar_plantilla(plantilla, {"id": item_id_num, "course_id": course_id, "sesskey": client.sesskey})
 
     r = client.post("grade/edit/tree/item.php", data=formdata)
     if r.status_code == 200:
+        anotar_en_cache(client, course_id, f"ig{item_id_num}", idnumber=item_idnumber, aggregationcoef=aggregationcoef)
         client._log(f"Item '{item_nombre}' modificado.")
         return True
     return False
@@ -840,176 +2373,268 @@ def modificar_gradepass_item(client, course_id, item_id, item_nombre, config_glo
 def modificar_formula_item(client, course_id, item_id, item_nombre, formula):
     """Modifica la fórmula de cálculo de un item específico"""
     item_id_num = limpiar_id(item_id)
-    formdata = {
-        "id": item_id_num,
-        "courseid": course_id,
-        "section": "calculation",
-        "gpr_type": "edit",
-        "gpr_plugin": "tree",
-        "gpr_courseid": course_id,
-        "sesskey": client.sesskey,
-        "_qf__edit_calculation_form": "1",
-        "calculation": formula,
-        "submitbutton": "Guarda+els+canvis"
-    }
+    formdata = rellenar_plantilla(plantilla_formula(formula), {"id": item_id_num, "course_id": course_id, "sesskey": client.sesskey})
     client.post("grade/edit/tree/calculation.php", data=formdata)
+    anotar_en_cache(client, course_id, f"ig{item_id_num}", formula=formula)
     client._log(f"Fórmula de '{item_nombre}' actualizada.")
     return True
 
 def modificar_formula_categoria(client, course_id, categoria_id, categoria_nombre, formula):
     """Modifica la fórmula de cálculo de una categoría específica"""
     cat_id_num = limpiar_id(categoria_id)
-    formdata = {
-        "id": cat_id_num,
-        "courseid": course_id,
-        "section": "calculation",
-        "gpr_type": "edit",
-        "gpr_plugin": "tree",
-        "gpr_courseid": course_id,
-        "sesskey": client.sesskey,
-        "_qf__edit_calculation_form": "1",
-        "calculation": formula,
-        "submitbutton": "Guarda+els+canvis"
-    }
+    formdata = rellenar_plantilla(plantilla_formula(formula), {"id": cat_id_num, "course_id": course_id, "sesskey": client.sesskey})
     client.post("grade/edit/tree/calculation.php", data=formdata)
+    anotar_en_cache(client, course_id, f"cg{cat_id_num}", formula=formula)
     client._log(f"Fórmula de categoría '{categoria_nombre}' actualizada.")
     return True
 
-def modificar_gradepass_categoria(client, course_id, categoria_id, categoria_nombre, config_global, aggregationcoef=0.0, idnumber=""):
+def modificar_gradepass_categoria(client, course_id, categoria_id, categoria_nombre, config_global, aggregationcoef=0.0, idnumber="", plantilla=None):
     """Modifica el campo gradepass, aggregationcoef e idnumber de una categoría específica"""
     cat_id_num = limpiar_id(categoria_id)
-    formdata = {
-        "id": cat_id_num,
-        "courseid": course_id,
-        "gpr_type": "edit",
-        "gpr_plugin": "tree",
-        "gpr_courseid": course_id,
-        "sesskey": client.sesskey,
-        "_qf__edit_category_form": "1",
-        "fullname": categoria_nombre,
-        "aggregation": config_global.get("aggregation", 0),
-        "aggregateonlygraded": 1 if config_global.get("aggregateonlygraded", True) else 0,
-        "grade_item_grademax": config_global.get("grademax", 100),
-        "grade_item_idnumber": idnumber,
-        "grade_item_gradepass": config_global.get("gradepass", 50),
-        "grade_item_aggregationcoef": aggregationcoef,
-        "submitbutton": "Guarda+els+canvis"
-    }
+    plantilla = plantilla or plantilla_modificar_categoria(categoria_nombre, config_global, aggregationcoef, idnumber)
+    formdata = rellenar_plantilla(plantilla, {"id": cat_id_num, "course_id": course_id, "sesskey": client.sesskey})
 
     r = client.post("grade/edit/tree/category.php", data=formdata)
     if r.status_code == 200:
+        anotar_en_cache(client, course_id, f"cg{cat_id_num}", idnumber=idnumber, aggregationcoef=aggregationcoef)
         client._log(f"Categoría '{categoria_nombre}' modificada.")
         return True
     return False
 
-def insertar_categorias_y_items(client, course_id, categoria_padre, categorias_hijas, config_global=None):
-    # Configuración por defecto
-    if config_global is None:
-        config_global = {"aggregation": 0, "aggregateonlygraded": 1, "grademax": 100, "gradepass": 50}
+# --- FÓRMULAS: ANÁLISIS DE DEPENDENCIAS ---
 
-    # Primero insertar la categoría padre
-    client._log(f"Insertando categoría padre: {categoria_padre}")
-    payload = get_categoria_payload(client, course_id, categoria_padre, config_global=config_global)
-    client.post_ajax("core_form_dynamic_form", json.loads(payload))
+PATRON_REFERENCIA = re.compile(r"\[\[([^\[\]]+)\]\]")
 
-    # Obtener el ID de la categoría padre
-    padre_id = obtener_id_categoria_completo(client, course_id, categoria_padre)
-    if not padre_id: return
+def extraer_referencias(formula):
+    """Devuelve los idnumber referenciados en una fórmula de Moodle (=[[ID1]]*0.5+[[ID2]]*0.5)."""
+    return PATRON_REFERENCIA.findall(formula or "")
 
-    modificar_gradepass_categoria(client, course_id, padre_id, categoria_padre, config_global)
+def analizar_formulas(categorias_hijas):
+    """
+    Analiza sin conexión las fórmulas de los CE de la configuración.
+    Devuelve un diccionario con:
+      - orden: nombres de los CE con fórmula, dependencias antes que dependientes
+      - ciclos: listas de nombres que forman dependencias circulares (no se aplicarán)
+      - faltantes: {nombre: [idnumber no definidos en el JSON]} (deben existir ya en el curso)
+    """
+    formulas = {}
+    nombre_por_idnumber = {}
+    for categoria_hija in categorias_hijas:
+        for elemento_info in categoria_hija.get("elementos", []):
+            nombre, formula, idnumber, _ = _normalizar_elemento(elemento_info)
+            if idnumber:
+                nombre_por_idnumber[idnumber] = nombre
+            if formula:
+                formulas[nombre] = formula
+
+    dependencias = {}
+    faltantes = {}
+    for nombre, formula in formulas.items():
+        referencias = extraer_referencias(formula)
+        dependencias[nombre] = [nombre_por_idnumber[r] for r in referencias
+                                if r in nombre_por_idnumber and nombre_por_idnumber[r] in formulas]
+        sin_definir = [r for r in referencias if r not in nombre_por_idnumber]
+        if sin_definir:
+            faltantes[nombre] = sin_definir
+
+    # Recorrido en profundidad: el post-orden da el orden topológico y las aristas de retorno los ciclos
+    estado = {}
+    orden = []
+    ciclos = []
+    en_ciclo = set()
+
+    def visitar(nombre, camino):
+        estado[nombre] = "visitando"
+        camino.append(nombre)
+        for dependencia in dependencias[nombre]:
+            if estado.get(dependencia) == "visitando":
+                ciclo = camino[camino.index(dependencia):]
+                ciclos.append(ciclo)
+                en_ciclo.update(ciclo)
+            elif dependencia not in estado:
+                visitar(dependencia, camino)
+        camino.pop()
+        estado[nombre] = "hecho"
+        orden.append(nombre)
+
+    for nombre in formulas:
+        if nombre not in estado:
+            visitar(nombre, [])
+
+    return {
+        "orden": [n for n in orden if n not in en_ciclo],
+        "ciclos": ciclos,
+        "faltantes": faltantes
+    }
 
-    # Luego insertar las categorías hijas y sus elementos
-    total_hijas = len(categorias_hijas)
-    for i, categoria_hija in enumerate(categorias_hijas):
-        nombre_hija = categoria_hija["nombre"]
-        coef_hija = categoria_hija.get("aggregationcoef", 0.0)
-        
-        progress = (i / total_hijas) * 100
-        client._update_progress(progress, f"Procesando {nombre_hija}...")
+def avisos_formulas(analisis):
+    """Mensajes legibles con los problemas detectados por analizar_formulas."""
+    avisos = []
+    for ciclo in analisis["ciclos"]:
+        avisos.append("Dependencia circular entre fórmulas (no se aplicarán): " + " -> ".join(ciclo + [ciclo[0]]))
+    for nombre, referencias in analisis["faltantes"].items():
+        avisos.append(f"La fórmula de '{nombre}' hace referencia a idnumber no definidos en el JSON: {', '.join(referencias)} (deben existir ya en el curso)")
+    return avisos
+
+def registrar_analisis_formulas(client, categorias_hijas, analisis=None):
+    """Analiza las fórmulas antes de cualquier petición (o reutiliza 'analisis') y muestra los avisos en el log."""
+    if analisis is None:
+        with client.span("analizar fórmulas", "parse"):
+            analisis = analizar_formulas(categorias_hijas)
+    for aviso in avisos_formulas(analisis):
+        client._log(aviso, "error" if aviso.startswith("Dependencia circular") else "info")
+    return analisis
+
+def aplicar_formulas_diferidas(client, course_id, pendientes, analisis):
+    """
+    Aplica en un único lote final las fórmulas recogidas durante la creación, en orden topológico.
+    pendientes: lista de (nombre, id, formula, es_categoria).
+    """
+    if not pendientes:
+        return
+    posicion = {nombre: i for i, nombre in enumerate(analisis["orden"])}
+    aplicables = [p for p in pendientes if p[0] in posicion]
+    aplicables.sort(key=lambda p: posicion[p[0]])
+    client._log(f"Aplicando {len(aplicables)} fórmulas en orden de dependencias...")
+    with client.span("aplicar fórmulas", "paso", total=len(aplicables)):
+        for nombre, elemento_id, formula, es_categoria in aplicables:
+            if es_categoria:
+                modificar_formula_categoria(client, course_id, elemento_id, nombre, formula)
+            else:
+                modificar_formula_item(client, course_id, elemento_id, nombre, formula)
 
-        client.post_ajax("core_form_dynamic_form", json.loads(get_categoria_payload(client, course_id, nombre_hija, padre_id, config_global)))
-        hija_id = obtener_id_categoria_completo(client, course_id, nombre_hija)
-        if not hija_id: continue
+def _huella_estructura_completa(course_id, categoria_padre, categorias_hijas, config_global=None):
+    """Argumento 'huella' de flujo_instrumentado para los flujos que aplican la estructura entera."""
+    return course_id, categoria_padre, {"categoria_padre": categoria_padre, "categorias_hijas": categorias_hijas,
+                                        "configuracion_global": config_global}
 
-        modificar_gradepass_categoria(client, course_id, hija_id, nombre_hija, config_global, coef_hija)
+def _huella_estructura_parcial(course_id, categoria_padre, *args, **kwargs):
+    """Argumento 'huella' de los flujos que solo retocan lo que ya existe: la huella guardada se olvida."""
+    return course_id, categoria_padre, None
 
-        elementos = categoria_hija["elementos"]
-        total_elementos = len(elementos)
-        ce_as_category = config_global.get("ce_as_category", False)
+def _huella_curso_sin_padre(course_id, *args, **kwargs):
+    """
+    Argumento 'huella' de los flujos que retocan el curso sin recibir la categoría padre: con
+    categoria_padre=None, recordar_huella borra las huellas de todas las categorías padre del curso.
+    """
+    return course_id, None, None
 
-        for j, elemento_info in enumerate(elementos):
-            if isinstance(elemento_info, dict):
-                e_nombre, e_formula, e_idnum, e_coef = elemento_info["nombre"], elemento_info.get("formula"), elemento_info.get("idnumber", ""), elemento_info.get("aggregationcoef", 1.0)
-            else:
-                e_nombre, e_formula, e_idnum, e_coef = elemento_info, None, "", 1.0
+@flujo_instrumentado("crear", instantaneas=True, huella=_huella_estructura_completa)
+def insertar_categorias_y_items(client, course_id, categoria_padre, categorias_hijas, config_global=None):
+    # Configuración por defecto
+    if config_global is None:
+        config_global = CONFIG_CREAR_POR_DEFECTO
 
-            if ce_as_category:
-                client._log(f"Insertando CE como categoría: {e_nombre}")
-                client.post_ajax("core_form_dynamic_form", json.loads(get_categoria_payload(client, course_id, e_nombre, hija_id, config_global)))
-                time.sleep(1)
-                ce_id = obtener_id_categoria_completo(client, course_id, e_nombre)
-                if ce_id:
-                    modificar_gradepass_categoria(client, course_id, ce_id, e_nombre, config_global, e_coef, e_idnum)
-                    if e_formula:
-                        modificar_formula_categoria(client, course_id, ce_id, e_nombre, e_formula)
-            else:
-                client._log(f"Insertando CE como item: {e_nombre}")
-                client.post_ajax("core_form_dynamic_form", json.loads(get_item_payload(client, course_id, e_nombre, hija_id, config_global, e_idnum)))
-                time.sleep(1)
-                item_id = obtener_id_item_completo(client, course_id, e_nombre)
-                if item_id:
-                    modificar_gradepass_item(client, course_id, item_id, e_nombre, config_global, e_idnum, e_coef)
-                    if e_formula:
-                        modificar_formula_item(client, course_id, item_id, e_nombre, e_formula)
+    # Las fórmulas se validan ahora (al compilar) y se aplican al final, cuando ya existen todos los idnumber
+    with client.span("compilar plan", "parse"):
+        plan = obtener_plan_compilado(categoria_padre, categorias_hijas, config_global)
+    registrar_analisis_formulas(client, categorias_hijas, plan["analisis"])
+    ejecutar_plan_compilado(client, course_id, plan)
 
-    
+def ejecutar_plan_compilado(client, course_id, plan):
+    """
+    Crea en el curso la estructura de un plan de compilar_plan: rellena los huecos con el curso,
+    la sesskey y los IDs que va devolviendo Moodle. Los pasos cuyo padre no se pudo crear se omiten.
+    """
+    formulas_pendientes = []
+    ids = [None] * len(plan["pasos"])
+    total_grupos = plan["total_grupos"]
+
+    for indice, paso in enumerate(plan["pasos"]):
+        nombre, nivel = paso["nombre"], paso["nivel"]
+        if nivel > 0:
+            client.comprobar_cancelacion()
+        padre_id = ids[paso["padre"]] if paso["padre"] is not None else ""
+        if paso["padre"] is not None and not padre_id:
+            continue
+        if nivel == 0:
+            client._log(f"Insertando categoría padre: {nombre}")
+        elif nivel == 1:
+            client._update_progress((paso["grupo"] / total_grupos) * 100, f"Procesando {nombre}...")
+        elif paso["tipo"] == "category":
+            client._log(f"Insertando CE como categoría: {nombre}")
+        else:
+            client._log(f"Insertando CE como item: {nombre}")
+
+        valores = {"course_id": course_id, "sesskey": client.sesskey, "parent": limpiar_id(padre_id)}
+        formulario = FORM_CREAR_CATEGORIA if paso["tipo"] == "category" else FORM_CREAR_ITEM
+        with client.span(f"crear {nombre}"):
+            client.post_ajax("core_form_dynamic_form",
+                             payload_formulario_dinamico(rellenar_plantilla(paso["crear"], valores), formulario))
+            if nivel == 2:
+                client.esperar(1)
+            if paso["tipo"] == "category":
+                elemento_id = obtener_id_categoria_completo(client, course_id, nombre)
+                if elemento_id:
+                    modificar_gradepass_categoria(client, course_id, elemento_id, nombre, None, paso["aggregationcoef"],
+                                                  paso["idnumber"], plantilla=paso["modificar"])
+            else:
+                elemento_id = obtener_id_item_completo(client, course_id, nombre)
+                if elemento_id:
+                    modificar_gradepass_item(client, course_id, elemento_id, nombre, None, paso["idnumber"],
+                                             paso["aggregationcoef"], plantilla=paso["modificar"])
+        if not elemento_id:
+            client._log(f"No se encontró '{nombre}' en Aules después de crearlo.", "error")
+            if nivel == 0:
+                return
+        ids[indice] = elemento_id
+        if elemento_id and paso["formula"]:
+            formulas_pendientes.append((nombre, elemento_id, paso["formula"], paso["tipo"] == "category"))
+
+    client.comprobar_cancelacion()
+    aplicar_formulas_diferidas(client, course_id, formulas_pendientes, plan["analisis"])
     client._update_progress(100, "Estructura creada correctamente.")
 
 def obtener_id_categoria_completo(client, course_id, nombre_categoria):
     """Obtiene el ID completo (cg######) de una categoría por su nombre"""
-    for intento in range(3):
-        try:
-            client._log(f"Buscando categoría: '{nombre_categoria}' (Intento {intento + 1})")
-            time.sleep(2 if intento == 0 else 1)
-            
-            r = client.get(f"grade/edit/tree/index.php?id={course_id}")
-            if r.status_code != 200: continue
-            
-            soup = BeautifulSoup(r.text, "html.parser")
-            rows = soup.find_all("tr", class_="category") or soup.find_all("tr", attrs={"data-category": True})
+    with client.span(f"buscar id {nombre_categoria}", "busqueda"):
+        for intento in range(3):
+            try:
+                client._log(f"Buscando categoría: '{nombre_categoria}' (Intento {intento + 1})")
+                if intento > 0:
+                    client.metricas.registrar_reintento("tree-fetch")
+                client.esperar(2 if intento == 0 else 1)
+        
+                r = client.get(f"grade/edit/tree/index.php?id={course_id}", cache=intento == 0)
+                if r.status_code != 200: continue
+        
+                soup = client.parsear_html(r.text)
+                rows = soup.find_all("tr", class_="category") or soup.find_all("tr", attrs={"data-category": True})
+        
+                for row in rows:
+                    name_cell = row.find("td", class_="column-name")
+                    if not name_cell: continue
             
-            for row in rows:
-                name_cell = row.find("td", class_="column-name")
-                if not name_cell: continue
-                
-                cat_name = name_cell.get_text(strip=True)
-                if nombre_categoria.lower() in cat_name.lower():
-                    cat_id = row.get("id", "").replace("grade-item-", "") or row.get("data-category")
-                    if cat_id: return cat_id
-        except Exception as e:
-            client._log(f"Error: {e}", "error")
+                    cat_name = name_cell.get_text(strip=True)
+                    if nombre_categoria.lower() in cat_name.lower():
+                        cat_id = row.get("id", "").replace("grade-item-", "") or row.get("data-category")
+                        if cat_id: return cat_id
+            except Exception as e:
+                client._log(f"Error: {e}", "error")
     return None
     
 def obtener_id_item_completo(client, course_id, nombre_item):
     """Obtiene el ID completo (ig######) de un item por su nombre"""
     try:
-        r = client.get(f"grade/edit/tree/index.php?id={course_id}")
-        if r.status_code != 200: return None
-        
-        soup = BeautifulSoup(r.text, "html.parser")
-        items = soup.find_all("tr", class_="item")
+        with client.span(f"buscar id {nombre_item}", "busqueda"):
+            r = client.get(f"grade/edit/tree/index.php?id={course_id}")
+            if r.status_code != 200: return None
+    
+            soup = client.parsear_html(r.text)
+            items = soup.find_all("tr", class_="item")
         
-        for item in items:
-            name_cell = item.find("td", class_="column-name")
-            if name_cell:
-                span = name_cell.find("span", class_="gradeitemheader")
-                if span and span.get_text(strip=True) == nombre_item:
-                    return item.get("id", "").replace("grade-item-", "")
+            for item in items:
+                name_cell = item.find("td", class_="column-name")
+                if name_cell:
+                    span = name_cell.find("span", class_="gradeitemheader")
+                    if span and span.get_text(strip=True) == nombre_item:
+                        return item.get("id", "").replace("grade-item-", "")
         return None
     except Exception as e:
         client._log(f"Error: {e}", "error")
     return None
 
+@flujo_instrumentado("actualizar_formulas", instantaneas=True, huella=_huella_curso_sin_padre)
 def actualizar_formulas(client, course_id, categorias_hijas, config_global=None):
     """Actualiza o elimina las fórmulas de cálculo de los elementos existentes"""
     client._log("Iniciando actualización/eliminación de fórmulas...")
@@ -1041,6 +2666,7 @@ def actualizar_formulas(client, course_id, categorias_hijas, config_global=None)
     
     client._update_progress(100, "Actualización de fórmulas completada.")
 
+@flujo_instrumentado("sincronizar", instantaneas=True, huella=_huella_estructura_completa)
 def sincronizar_todo(client, course_id, categoria_padre_nombre, categorias_hijas, config_global=None):
     """Sincronización inteligente: Crea elementos faltantes y actualiza fórmulas/pesos de los existentes."""
     client._log("Iniciando sincronización inteligente de estructura y pesos...")
@@ -1049,9 +2675,11 @@ def sincronizar_todo(client, course_id, categoria_padre_nombre, categorias_hijas
         config_global = {"aggregation": 10, "aggregateonlygraded": True, "grademax": 10.0, "gradepass": 5.0}
 
     ce_as_category = config_global.get("ce_as_category", False)
+    analisis = registrar_analisis_formulas(client, categorias_hijas)
+    formulas_pendientes = []
     
     # 1. Obtener estado actual de Aules
-    elementos_actuales = obtener_elementos_curso(client, course_id)
+    elementos_actuales = obtener_estructura_curso(client, course_id)
     if not elementos_actuales:
         client._log("No se pudo obtener la estructura actual de Aules.", "error")
         return
@@ -1060,9 +2688,9 @@ def sincronizar_todo(client, course_id, categoria_padre_nombre, categorias_hijas
     padre = encontrar_categoria_por_nombre(elementos_actuales, categoria_padre_nombre)
     if not padre:
         client._log(f"Creando categoría padre faltante: {categoria_padre_nombre}")
-        client.post_ajax("core_form_dynamic_form", json.loads(get_categoria_payload(client, course_id, categoria_padre_nombre, config_global=config_global)))
+        client.post_ajax("core_form_dynamic_form", get_categoria_payload(client, course_id, categoria_padre_nombre, config_global=config_global))
         # Esperar un poco a que Moodle procese la creación
-        time.sleep(2)
+        client.esperar(2)
         padre_id = obtener_id_categoria_completo(client, course_id, categoria_padre_nombre)
     else:
         padre_id = padre["id"]
@@ -1075,28 +2703,31 @@ def sincronizar_todo(client, course_id, categoria_padre_nombre, categorias_hijas
     # 3. Procesar categorías hijas (RAs)
     total_hijas = len(categorias_hijas)
     for i, cat_json in enumerate(categorias_hijas):
+        client.comprobar_cancelacion()
         nombre_hija = cat_json["nombre"]
         coef_hija = cat_json.get("aggregationcoef", 0.0)
         progress = (i / total_hijas) * 100
         client._update_progress(progress, f"Sincronizando {nombre_hija}...")
 
-        # Buscar si el RA existe
-        hija = encontrar_categoria_por_nombre(elementos_actuales, nombre_hija)
-        if not hija:
-            client._log(f"Creando RA faltante: {nombre_hija}")
-            client.post_ajax("core_form_dynamic_form", json.loads(get_categoria_payload(client, course_id, nombre_hija, padre_id, config_global)))
-            time.sleep(2)
-            hija_id = obtener_id_categoria_completo(client, course_id, nombre_hija)
-        else:
-            hija_id = hija["id"]
+        with client.span(f"sincronizar {nombre_hija}"):
+            # Buscar si el RA existe
+            hija = encontrar_categoria_por_nombre(elementos_actuales, nombre_hija)
+            if not hija:
+                client._log(f"Creando RA faltante: {nombre_hija}")
+                client.post_ajax("core_form_dynamic_form", get_categoria_payload(client, course_id, nombre_hija, padre_id, config_global))
+                client.esperar(2)
+                hija_id = obtener_id_categoria_completo(client, course_id, nombre_hija)
+            else:
+                hija_id = hija["id"]
         
-        if not hija_id: continue
+            if not hija_id: continue
 
-        # Actualizar configuración del RA (coeficientes)
-        modificar_gradepass_categoria(client, course_id, hija_id, nombre_hija, config_global, coef_hija)
+            # Actualizar configuración del RA (coeficientes)
+            modificar_gradepass_categoria(client, course_id, hija_id, nombre_hija, config_global, coef_hija)
 
         # 4. Procesar elementos (CEs) de esta hija
         for elemento_json in cat_json.get("elementos", []):
+            client.comprobar_cancelacion()
             if isinstance(elemento_json, dict):
                 e_nombre = elemento_json["nombre"]
                 e_formula = elemento_json.get("formula")
@@ -1105,62 +2736,95 @@ def sincronizar_todo(client, course_id, categoria_padre_nombre, categorias_hijas
             else:
                 e_nombre, e_formula, e_idnum, e_coef = elemento_json, None, "", 1.0
 
-            # Buscar si el CE existe en cualquier formato (item o categoría)
-            item_existente = next((e for e in elementos_actuales if e["tipo"] == "item" and e["nombre"] == e_nombre), None)
-            cat_existente = encontrar_categoria_por_nombre(elementos_actuales, e_nombre)
+            with client.span(f"sincronizar {e_nombre}"):
+                # Buscar si el CE existe en cualquier formato (item o categoría)
+                item_existente = next((e for e in elementos_actuales if e["tipo"] == "item" and e["nombre"] == e_nombre), None)
+                cat_existente = encontrar_categoria_por_nombre(elementos_actuales, e_nombre)
 
-            if ce_as_category:
-                # El usuario quiere que los CE sean CATEGORÍAS
-                if cat_existente:
-                    ce_id = cat_existente["id"]
-                    client._log(f"Actualizando CE (Categoría): {e_nombre}")
-                    modificar_gradepass_categoria(client, course_id, ce_id, e_nombre, config_global, e_coef, e_idnum)
-                    if e_formula: modificar_formula_categoria(client, course_id, ce_id, e_nombre, e_formula)
-                elif item_existente:
-                    client._log(f"AVISO: {e_nombre} existe como ITEM pero ce_as_category=True. Se creará la CATEGORÍA.", "error")
-                    client.post_ajax("core_form_dynamic_form", json.loads(get_categoria_payload(client, course_id, e_nombre, hija_id, config_global)))
-                    time.sleep(1)
-                    ce_id = obtener_id_categoria_completo(client, course_id, e_nombre)
-                    if ce_id:
-                        modificar_gradepass_categoria(client, course_id, ce_id, e_nombre, config_global, e_coef, e_idnum)
-                        if e_formula: modificar_formula_categoria(client, course_id, ce_id, e_nombre, e_formula)
-                else:
-                    client._log(f"Creando CE faltante (categoría): {e_nombre}")
-                    client.post_ajax("core_form_dynamic_form", json.loads(get_categoria_payload(client, course_id, e_nombre, hija_id, config_global)))
-                    time.sleep(1)
-                    ce_id = obtener_id_categoria_completo(client, course_id, e_nombre)
-                    if ce_id:
+                if ce_as_category:
+                    # El usuario quiere que los CE sean CATEGORÍAS
+                    if cat_existente:
+                        ce_id = cat_existente["id"]
+                        client._log(f"Actualizando CE (Categoría): {e_nombre}")
                         modificar_gradepass_categoria(client, course_id, ce_id, e_nombre, config_global, e_coef, e_idnum)
-                        if e_formula: modificar_formula_categoria(client, course_id, ce_id, e_nombre, e_formula)
-            else:
-                # El usuario quiere que los CE sean ITEMS INDIVIDUALES
-                if item_existente:
-                    item_id = item_existente["id"]
-                    client._log(f"Actualizando CE (Item): {e_nombre}")
-                    modificar_gradepass_item(client, course_id, item_id, e_nombre, config_global, e_idnum, e_coef)
-                    if e_formula: modificar_formula_item(client, course_id, item_id, e_nombre, e_formula)
-                elif cat_existente:
-                    client._log(f"AVISO: {e_nombre} existe como CATEGORÍA pero ce_as_category=False. Se creará el ITEM.", "error")
-                    client.post_ajax("core_form_dynamic_form", json.loads(get_item_payload(client, course_id, e_nombre, hija_id, config_global, e_idnum)))
-                    time.sleep(1)
-                    item_id = obtener_id_item_completo(client, course_id, e_nombre)
-                    if item_id:
-                        modificar_gradepass_item(client, course_id, item_id, e_nombre, config_global, e_idnum, e_coef)
-                        if e_formula: modificar_formula_item(client, course_id, item_id, e_nombre, e_formula)
+                        if e_formula: formulas_pendientes.append((e_nombre, ce_id, e_formula, True))
+                    elif item_existente:
+                        client._log(f"AVISO: {e_nombre} existe como ITEM pero ce_as_category=True. Se creará la CATEGORÍA.", "error")
+                        client.post_ajax("core_form_dynamic_form", get_categoria_payload(client, course_id, e_nombre, hija_id, config_global))
+                        client.esperar(1)
+                        ce_id = obtener_id_categoria_completo(client, course_id, e_nombre)
+                        if ce_id:
+                            modificar_gradepass_categoria(client, course_id, ce_id, e_nombre, config_global, e_coef, e_idnum)
+                            if e_formula: formulas_pendientes.append((e_nombre, ce_id, e_formula, True))
+                    else:
+                        client._log(f"Creando CE faltante (categoría): {e_nombre}")
+                        client.post_ajax("core_form_dynamic_form", get_categoria_payload(client, course_id, e_nombre, hija_id, config_global))
+                        client.esperar(1)
+                        ce_id = obtener_id_categoria_completo(client, course_id, e_nombre)
+                        if ce_id:
+                            modificar_gradepass_categoria(client, course_id, ce_id, e_nombre, config_global, e_coef, e_idnum)
+                            if e_formula: formulas_pendientes.append((e_nombre, ce_id, e_formula, True))
                 else:
-                    client._log(f"Creando CE faltante (item): {e_nombre}")
-                    client.post_ajax("core_form_dynamic_form", json.loads(get_item_payload(client, course_id, e_nombre, hija_id, config_global, e_idnum)))
-                    time.sleep(1)
-                    item_id = obtener_id_item_completo(client, course_id, e_nombre)
-                    if item_id:
+                    # El usuario quiere que los CE sean ITEMS INDIVIDUALES
+                    if item_existente:
+                        item_id = item_existente["id"]
+                        client._log(f"Actualizando CE (Item): {e_nombre}")
                         modificar_gradepass_item(client, course_id, item_id, e_nombre, config_global, e_idnum, e_coef)
-                        if e_formula: modificar_formula_item(client, course_id, item_id, e_nombre, e_formula)
-
+                        if e_formula: formulas_pendientes.append((e_nombre, item_id, e_formula, False))
+                    elif cat_existente:
+                        client._log(f"AVISO: {e_nombre} existe como CATEGORÍA pero ce_as_category=False. Se creará el ITEM.", "error")
+                        client.post_ajax("core_form_dynamic_form", get_item_payload(client, course_id, e_nombre, hija_id, config_global, e_idnum))
+                        client.esperar(1)
+                        item_id = obtener_id_item_completo(client, course_id, e_nombre)
+                        if item_id:
+                            modificar_gradepass_item(client, course_id, item_id, e_nombre, config_global, e_idnum, e_coef)
+                            if e_formula: formulas_pendientes.append((e_nombre, item_id, e_formula, False))
+                    else:
+                        client._log(f"Creando CE faltante (item): {e_nombre}")
+                        client.post_ajax("core_form_dynamic_form", get_item_payload(client, course_id, e_nombre, hija_id, config_global, e_idnum))
+                        client.esperar(1)
+                        item_id = obtener_id_item_completo(client, course_id, e_nombre)
+                        if item_id:
+                            modificar_gradepass_item(client, course_id, item_id, e_nombre, config_global, e_idnum, e_coef)
+                            if e_formula: formulas_pendientes.append((e_nombre, item_id, e_formula, False))
+
+    client.comprobar_cancelacion()
+    aplicar_formulas_diferidas(client, course_id, formulas_pendientes, analisis)
     client._update_progress(100, "Sincronización inteligente completada con éxito.")
 
-def eliminar_estructura(client, course_id, nombre_categoria_padre):
-    """Elimina una estructura completa a partir de una categoría padre"""
-    elementos = obtener_elementos_curso(client, course_id)
+@flujo_instrumentado("actualizar", instantaneas=True, huella=_huella_estructura_parcial)
+def actualizar_calculos(client, course_id, categoria_padre, categorias_hijas, config_global):
+    """Actualiza pesos y fórmulas de los elementos que ya existen bajo la categoría padre (opción 2 del menú)."""
+    elementos = obtener_estructura_curso(client, course_id)
+    padre = encontrar_categoria_por_nombre(elementos, categoria_padre)
+    if not padre: return
+
+    relacionados = encontrar_elementos_por_categoria(elementos, padre["id"])
+    for e in tqdm(relacionados, desc="Actualizando", disable=None):
+        client.comprobar_cancelacion()
+        if e["tipo"] == "category":
+            conf = next((c for c in categorias_hijas if c["nombre"] == e["nombre"]), {})
+            modificar_gradepass_categoria(client, course_id, e["id"], e["nombre"], config_global, conf.get("aggregationcoef", 0.0))
+            modificar_formula_categoria(client, course_id, e["id"], e["nombre"], conf.get("formula", ""))
+        else:
+            conf = None
+            for ch in categorias_hijas:
+                for ec in ch.get("elementos", []):
+                    if isinstance(ec, dict) and ec["nombre"] == e["nombre"]:
+                        conf = ec; break
+                if conf: break
+
+            if conf:
+                modificar_gradepass_item(client, course_id, e["id"], e["nombre"], config_global, conf.get("idnumber", ""), conf.get("aggregationcoef", 1.0))
+                modificar_formula_item(client, course_id, e["id"], e["nombre"], conf.get("formula", ""))
+
+@flujo_instrumentado("eliminar", instantaneas=True)
+def eliminar_estructura(client, course_id, nombre_categoria_padre, confirmar=True):
+    """
+    Elimina una estructura completa a partir de una categoría padre.
+    Con confirmar=False (modo desatendido) no se pregunta nunca por consola.
+    """
+    elementos = obtener_estructura_curso(client, course_id)
     if not elementos: return
 
     categoria_padre = encontrar_categoria_por_nombre(elementos, nombre_categoria_padre)
@@ -1182,7 +2846,7 @@ def eliminar_estructura(client, course_id, nombre_categoria_padre):
 
     # Nota: En modo GUI, la confirmación debería venir de la interfaz antes de llamar a esto.
     # Por ahora mantenemos compatibilidad básica si no hay GUI activa.
-    if not client.log_callback:
+    if confirmar and not client.log_callback:
         confirmacion = input(f"\n¿Eliminar {len(unicos)} elementos de '{nombre_categoria_padre}'? (s/n): ")
         if confirmacion.lower() != 's': return
     
@@ -1191,13 +2855,2367 @@ def eliminar_estructura(client, course_id, nombre_categoria_padre):
     cats = sorted([e for e in unicos if e["tipo"] == "category"], key=lambda x: x.get("nivel", 0), reverse=True)
     
     total = len(unicos)
+    fallidos = []
     for i, e in enumerate(items + cats):
+        client.comprobar_cancelacion()
         progress = (i / total) * 100
         client._update_progress(progress, f"Eliminando {e['nombre']}...")
-        eliminar_elemento(client, course_id, e, True)
+        with client.span(f"eliminar {e['nombre']}"):
+            if not eliminar_elemento(client, course_id, e, True):
+                fallidos.append(e["nombre"])
     
+    recordar_huella_aplicada(client, course_id, nombre_categoria_padre, None)
+    if fallidos:
+        client._log(f"No se pudieron eliminar {len(fallidos)} de {total} elementos de '{nombre_categoria_padre}': {', '.join(fallidos)}", "error")
+        client._update_progress(100, f"Eliminación de '{nombre_categoria_padre}' incompleta.")
+        return
     client._update_progress(100, f"Eliminación de '{nombre_categoria_padre}' completada.")
 
+# --- LECTURA Y CLONACIÓN DE ESTRUCTURAS EXISTENTES ---
+
+def _numero_formulario(valor, defecto=None):
+    """Número de un campo de formulario de Moodle (admite coma decimal)."""
+    try:
+        numero = float(str(valor).strip().replace(",", "."))
+    except (TypeError, ValueError):
+        return defecto
+    return int(numero) if numero.is_integer() else numero
+
+def leer_ajustes_elemento(client, course_id, elemento, con_formula=False):
+    """
+    Lee del formulario de edición de Moodle el idnumber, el peso y (en categorías) la agregación
+    y las notas de un nodo del árbol; con_formula añade la fórmula de cálculo.
+    """
+    numero = limpiar_id(elemento["id"])
+    es_categoria = elemento["tipo"] == "category"
+    pagina = "category.php" if es_categoria else "item.php"
+    r = client.get(f"grade/edit/tree/{pagina}?courseid={course_id}&id={numero}")
+    campos = _campos_formulario(client.parsear_html(r.text))
+    prefijo = "grade_item_" if es_categoria else ""
+    ajustes = {
+        "idnumber": campos.get(f"{prefijo}idnumber", ""),
+        "aggregationcoef": _numero_formulario(campos.get(f"{prefijo}aggregationcoef"), 0.0 if es_categoria else 1.0),
+        "grademax": _numero_formulario(campos.get(f"{prefijo}grademax")),
+        "gradepass": _numero_formulario(campos.get(f"{prefijo}gradepass")),
+    }
+    if es_categoria:
+        ajustes["aggregation"] = _numero_formulario(campos.get("aggregation"), 0)
+        ajustes["aggregateonlygraded"] = campos.get("aggregateonlygraded", "0") == "1"
+    if con_formula:
+        ajustes["formula"] = leer_formula_elemento(client, course_id, elemento)
+    return ajustes
+
+def leer_formula_elemento(client, course_id, elemento):
+    """Fórmula de cálculo de un nodo del árbol ('' si no tiene)."""
+    r = client.get(f"grade/edit/tree/calculation.php?courseid={course_id}&id={limpiar_id(elemento['id'])}")
+    return _campos_formulario(client.parsear_html(r.text)).get("calculation", "").strip()
+
+PATRON_IDNUMBER_CALCULO = re.compile(r"^(.*?)\s*\[\[(.+?)\]\]$")
+
+def leer_idnumbers_calculo(client, course_id, elemento):
+    """
+    idnumbers de todo el curso en una sola petición: la página de la fórmula de cualquier nodo
+    (calculation.php) lista el árbol con cada elemento como "Nombre [[idnumber]]", o con un campo
+    idnumbers[<id>] si no tiene. Devuelve {nombre: idnumber} ('' = sin idnumber).
+    """
+    r = client.get(f"grade/edit/tree/calculation.php?courseid={course_id}&id={limpiar_id(elemento['id'])}")
+    idnumbers = {}
+    for linea in client.parsear_html(r.text).find_all("li"):
+        texto = " ".join(t.strip() for t in linea.find_all(string=True, recursive=False) if t.strip())
+        coincidencia = PATRON_IDNUMBER_CALCULO.match(texto)
+        if coincidencia:
+            idnumbers[coincidencia.group(1).rstrip(" :")] = coincidencia.group(2)
+        elif texto and linea.find("input", attrs={"name": re.compile(r"^idnumbers\[")}, recursive=False):
+            idnumbers[texto.rstrip(" :")] = ""
+    return idnumbers
+
+def leer_estructura_curso(client, course_id, categoria_padre, concurrencia=8):
+    """
+    Convierte la estructura 'categoria_padre' tal como está en Aules al formato de datos_aules.json
+    (categoria_padre, categorias_hijas, configuracion_global). Lee el árbol una vez y, además, el
+    formulario de la categoría padre (agregación y notas) y la lista de idnumbers de la página de
+    fórmulas. Con una agregación ponderada (AGREGACIONES_CON_PESO) el peso de RA y CE sale de los
+    campos weight_<id> del árbol; solo se abren los formularios de lo que falte en esas páginas y la
+    fórmula de los CE que el árbol marca como calculados. Las lecturas van en paralelo con la misma
+    sesión. Devuelve None si la categoría no existe.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    elementos = obtener_estructura_curso(client, course_id, forzar=True)
+    padre = encontrar_categoria_por_nombre(elementos or [], categoria_padre)
+    if not padre:
+        client._log(f"No se encontró la categoría '{categoria_padre}' en el curso {course_id}", "error")
+        return None
+
+    def hijos(categoria_id):
+        return [e for e in elementos if e.get("categoria_padre_id", e.get("categoria_id")) == categoria_id and e is not padre]
+
+    ras = [e for e in hijos(padre["id"]) if e["tipo"] == "category"]
+    ces = {ra["id"]: hijos(ra["id"]) for ra in ras}
+    todos_ce = [ce for ra in ras for ce in ces[ra["id"]]]
+    ce_as_category = any(e["tipo"] == "category" for e in todos_ce)
+    if ce_as_category and any(e["tipo"] == "item" for e in todos_ce):
+        client._log("La estructura mezcla CE como items y como categorías; se exportan todos como categorías.", "error")
+    if todos_ce and not any("calculada" in ce for ce in todos_ce):
+        client._log("El árbol no marca los elementos calculados: no se exportan fórmulas.", "error")
+
+    ajustes_padre = leer_ajustes_elemento(client, course_id, padre)
+    con_peso = ajustes_padre["aggregation"] in AGREGACIONES_CON_PESO
+    idnumbers = leer_idnumbers_calculo(client, course_id, todos_ce[0]) if todos_ce else {}
+
+    # (elemento, abrir su formulario, abrir su fórmula): solo lo que no dan el árbol ni la lista de idnumbers
+    lecturas = [(ra, True, False) for ra in ras if not (con_peso and ra.get("peso") is not None)]
+    for ce in todos_ce:
+        falta_formulario = ce["nombre"] not in idnumbers or not (con_peso and ce.get("peso") is not None)
+        if falta_formulario or ce.get("calculada"):
+            lecturas.append((ce, falta_formulario, bool(ce.get("calculada"))))
+    cancelacion = getattr(client._local, "cancelacion", None) or threading.Event()
+
+    def leer(lectura):
+        elemento, formulario, formula = lectura
+        hijo = client.derivar()
+        hijo.asignar_cancelacion(cancelacion)
+        hijo.comprobar_cancelacion()
+        if formulario:
+            return leer_ajustes_elemento(hijo, course_id, elemento, formula)
+        return {"formula": leer_formula_elemento(hijo, course_id, elemento)}
+
+    client._log(f"Leyendo los ajustes de {len(lecturas)} de {len(ras) + len(todos_ce)} nodos de '{categoria_padre}'...")
+    with client.span(f"leer ajustes {categoria_padre}", "busqueda", total=len(lecturas)):
+        with ThreadPoolExecutor(max_workers=max(1, concurrencia)) as ejecutor:
+            try:
+                leidos = dict(zip((e["id"] for e, _, _ in lecturas), ejecutor.map(leer, lecturas)))
+            except KeyboardInterrupt:
+                cancelacion.set()  # las lecturas pendientes terminan al empezar
+                raise
+
+    def valores(elemento, coef_defecto):
+        """idnumber, aggregationcoef y fórmula de un nodo, del formulario si se abrió o del árbol y la lista."""
+        leido = leidos.get(elemento["id"], {})
+        datos = {"aggregationcoef": leido.get("aggregationcoef", elemento.get("peso", coef_defecto))}
+        if "idnumber" in leido or elemento["nombre"] in idnumbers:
+            datos["idnumber"] = leido.get("idnumber", idnumbers.get(elemento["nombre"]))
+        if "formula" in leido:
+            datos["formula"] = leido["formula"]
+        elif elemento.get("calculada") is False:
+            datos["formula"] = ""
+        anotar_en_cache(client, course_id, elemento["id"], **datos)
+        return datos
+
+    def elemento_json(ce):
+        datos = valores(ce, 1.0)
+        extra = {}
+        if datos.get("idnumber"):
+            extra["idnumber"] = datos["idnumber"]
+        if datos["aggregationcoef"] not in (None, 1, 1.0):
+            extra["aggregationcoef"] = datos["aggregationcoef"]
+        if datos.get("formula"):
+            extra["formula"] = datos["formula"]
+        return {"nombre": ce["nombre"], **extra} if extra else ce["nombre"]
+
+    configuracion_global = {
+        "aggregation": ajustes_padre["aggregation"],
+        "aggregateonlygraded": ajustes_padre["aggregateonlygraded"],
+        "grademax": ajustes_padre["grademax"] if ajustes_padre["grademax"] is not None else 10,
+        "gradepass": ajustes_padre["gradepass"] if ajustes_padre["gradepass"] is not None else 5,
+        "ce_as_category": ce_as_category
+    }
+    return {
+        "categoria_padre": padre["nombre"],
+        "categorias_hijas": [{"nombre": ra["nombre"],
+                              "aggregationcoef": valores(ra, 0.0)["aggregationcoef"],
+                              "elementos": [elemento_json(ce) for ce in ces[ra["id"]]]} for ra in ras],
+        "configuracion_global": configuracion_global
+    }
+
+@flujo_instrumentado("exportar")
+def exportar_estructura_json(client, course_id, categoria_padre, ruta, concurrencia=8):
+    """
+    Escribe en 'ruta' un datos_aules.json con la estructura actual del curso. Conserva la contraseña
+    del archivo que hubiera para el mismo usuario y deja una copia del anterior en '<ruta>.bak'.
+    No sobrescribe un archivo multicurso. Devuelve los datos escritos o None si no se pudo leer la
+    estructura o escribir el archivo.
+    """
+    if os.path.exists(ruta) and es_archivo_multicurso(ruta):
+        # Escribir un solo curso borraría el resto de secciones del archivo
+        client._log(f"{ruta} es un archivo multicurso; exporta a otro archivo", "error")
+        return None
+    datos = leer_estructura_curso(client, course_id, categoria_padre, concurrencia)
+    if not datos:
+        return None
+    anterior = {}
+    if os.path.exists(ruta):
+        try:
+            with open(ruta, encoding="utf-8") as f:
+                anterior = json.load(f)
+        except ValueError:
+            pass
+        shutil.copy2(ruta, ruta + ".bak")
+    data = {
+        "base_url": client.base_url,
+        "username": client.username or anterior.get("username", ""),
+        "password": anterior.get("password", "") if anterior.get("username") in (None, client.username) else "",
+        "course_id": int(course_id),
+        "configuracion_global": datos["configuracion_global"],
+        "categoria_padre": datos["categoria_padre"],
+        "categorias_hijas": datos["categorias_hijas"]
+    }
+    try:
+        for aviso in validar_configuracion(data, ruta).avisos:
+            client._log(f"Aviso: {aviso}")
+    except ErrorConfiguracion as e:
+        for error in e.errores:
+            client._log(f"La estructura exportada necesita revisión: {error}", "error")
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    with open(temporal, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(temporal, ruta)
+    total_ce = sum(len(ra["elementos"]) for ra in data["categorias_hijas"])
+    client._log(f"Estructura exportada a {ruta}: {len(data['categorias_hijas'])} RA y {total_ce} CE.")
+    return data
+
+@flujo_instrumentado("clonar")
+def clonar_estructura(client, origen_id, destinos, categoria_padre, concurrencia=4):
+    """
+    Copia la estructura 'categoria_padre' del curso origen, tal como está en Aules, a cada curso
+    destino: se lee una vez, se compila un único plan y se crea en los destinos en paralelo con la
+    sesión de 'client'. El progreso global es la media del de cada destino. Con Ctrl+C los destinos
+    en marcha paran en la siguiente operación y los que no han empezado ya no empiezan.
+    Devuelve {destino: "ok", "cancelado" o la descripción del problema}.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    destinos = list(dict.fromkeys(destinos))  # un curso repetido se clonaría dos veces a la vez
+    datos = leer_estructura_curso(client, origen_id, categoria_padre, concurrencia)
+    if not datos:
+        return {destino: "no se pudo leer el curso origen" for destino in destinos}
+    plan = obtener_plan_compilado(datos["categoria_padre"], datos["categorias_hijas"], datos["configuracion_global"])
+    registrar_analisis_formulas(client, datos["categorias_hijas"], plan["analisis"])
+    arbol = arbol_huellas(datos)
+    client._log(f"Clonando '{categoria_padre}' ({len(plan['pasos'])} nodos) del curso {origen_id} a {len(destinos)} cursos...")
+
+    cerrojo = threading.Lock()
+    progresos = dict.fromkeys(destinos, 0)
+    # La de la interfaz si el flujo viene de un trabajo; si no, una propia para Ctrl+C
+    cancelacion = getattr(client._local, "cancelacion", None) or threading.Event()
+
+    def notificar(destino, valor, mensaje):
+        with cerrojo:
+            progresos[destino] = valor
+            total = sum(progresos.values()) / len(progresos)
+        client._update_progress(total, f"[curso {destino}] {mensaje}")
+
+    def replicar(destino):
+        errores = []
+        def registrar(mensaje, nivel="info"):
+            if nivel == "error":
+                errores.append(mensaje)
+            client._log(f"[curso {destino}] {mensaje}", nivel)
+        hijo = client.derivar(log_callback=registrar, progress_callback=lambda v, m: notificar(destino, v, m))
+        hijo.asignar_cancelacion(cancelacion)
+        if encontrar_categoria_por_nombre(obtener_estructura_curso(hijo, destino, forzar=True) or [], datos["categoria_padre"]):
+            return f"ya existe '{datos['categoria_padre']}' (usa sincronizar)"
+        if INSTANTANEAS_AUTOMATICAS:
+            # La página del árbol recién leída sigue en la caché de respuestas: no cuesta otra petición
+            _instantanea_automatica(hijo, destino, "antes de clonar", forzar=False)
+        try:
+            with client.span(f"clonar en {destino}", "flujo"):
+                ejecutar_plan_compilado(hijo, destino, plan)
+        except BaseException:
+            recordar_huella_aplicada(client, destino, datos["categoria_padre"], None)
+            raise
+        finally:
+            if INSTANTANEAS_AUTOMATICAS:
+                _instantanea_automatica(hijo, destino, "después de clonar", forzar=False)
+        # El destino queda con la estructura leída del origen: la sincronización incremental parte de ella
+        recordar_huella_aplicada(client, destino, datos["categoria_padre"], arbol if not errores else None)
+        return "ok" if not errores else f"{len(errores)} errores: {errores[0]}"
+
+    def resultado(futuro):
+        if futuro.cancelled():
+            return "cancelado"
+        try:
+            return futuro.result()
+        except OperacionCancelada:
+            return "cancelado"
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrencia)) as ejecutor:
+        futuros = {destino: ejecutor.submit(replicar, destino) for destino in destinos}
+        try:
+            for futuro in futuros.values():
+                futuro.exception()
+        except KeyboardInterrupt:
+            cancelacion.set()
+            for futuro in futuros.values():
+                futuro.cancel()
+        resultados = {destino: resultado(futuro) for destino, futuro in futuros.items()}
+    for destino, estado in resultados.items():
+        client._log(f"Curso {destino}: {estado}", "info" if estado == "ok" else "error")
+    cancelado = "cancelado" in resultados.values()
+    client._update_progress(100, "Clonación cancelada." if cancelado else "Clonación completada.")
+    return resultados
+
+# --- AUDITORÍA DE DERIVA ENTRE CURSOS ---
+
+def auditar_curso(client, config):
+    """
+    Compara un curso con su configuración sin escribir nada en Aules: lee el árbol y la lista de
+    idnumbers de la página de fórmulas (leer_idnumbers_calculo), dos peticiones por curso. Del
+    texto de las fórmulas solo se sabe si el árbol marca el elemento como calculado, así que no se
+    usan las anotaciones de la caché (pueden estar obsoletas): lo que no se puede comprobar se
+    informa en "sin_verificar". Devuelve un diccionario serializable con lo que falta, sobra y difiere.
+    """
+    data = config.como_dict()
+    elementos = obtener_estructura_curso(client, config.course_id, forzar=True) or []
+    if client.cache_estructuras is not None:
+        try:
+            conocidas = client.cache_estructuras.propiedades(client.base_url, config.course_id)
+        except sqlite3.Error:
+            conocidas = {}
+        for e in elementos:
+            for clave, valor in conocidas.get(e["id"], {}).items():
+                if clave not in ("idnumber", "formula"):
+                    e.setdefault(clave, valor)
+    categoria = encontrar_categoria_por_nombre(elementos, data["categoria_padre"])
+    items = [e for e in encontrar_elementos_por_categoria(elementos, categoria["id"]) if e["tipo"] == "item"] if categoria else []
+    if items:
+        idnumbers = leer_idnumbers_calculo(client, config.course_id, items[0])
+        for e in elementos:
+            if e["nombre"] in idnumbers:
+                e["idnumber"] = idnumbers[e["nombre"]]
+    comparacion = comparar_estructura(elementos, data["categoria_padre"], data["categorias_hijas"],
+                                      data.get("configuracion_global"))
+    nombres = {e["id"]: e["nombre"] for e in elementos}
+    sobran = [nombres[i] for i, (estado, _) in comparacion["estados"].items() if estado == "sobra"]
+    difieren = [{"nombre": nombres[i], "motivo": motivo} for i, (estado, motivo) in comparacion["estados"].items()
+                if estado == "difiere"]
+    faltan = [{"nombre": nombre, "tipo": tipo, "padre": padre} for nombre, tipo, padre in comparacion["faltan"]]
+    sin_verificar = [{"nombre": nombres[i], "campos": campos} for i, campos in comparacion["sin_verificar"].items()]
+    return {"course_id": config.course_id, "categoria_padre": config.categoria_padre,
+            "estado": "ok" if not (sobran or difieren or faltan) else "deriva",
+            "nodos": len(comparacion["estados"]), "faltan": faltan, "sobran": sobran, "difieren": difieren,
+            "sin_verificar": sin_verificar}
+
+def auditar_cursos(configs, concurrencia=8, traza=None, log_callback=None):
+    """
+    Audita varios cursos a la vez (configuraciones_desatendidas): una sesión por Aules y usuario,
+    compartida entre hilos, y una lectura del árbol por curso. Devuelve la lista de resultados
+    de auditar_curso, en el orden de 'configs'; los cursos sin sesión o con error llevan estado "error".
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    clientes = {}
+    for config in configs:
+        clave = (config.base_url, config.username)
+        if clave not in clientes:
+            client = AulesClient(config.base_url, log_callback=log_callback, traza=traza)
+            clientes[clave] = client if client.login(config.username, config.password) else None
+
+    def auditar(config):
+        client = clientes[(config.base_url, config.username)]
+        if client is None:
+            return {"course_id": config.course_id, "categoria_padre": config.categoria_padre,
+                    "estado": "error", "error": "no se pudo iniciar sesión"}
+        try:
+            return auditar_curso(client.derivar(), config)
+        except Exception as e:
+            return {"course_id": config.course_id, "categoria_padre": config.categoria_padre,
+                    "estado": "error", "error": f"{type(e).__name__}: {e}"}
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrencia)) as ejecutor:
+        return list(ejecutor.map(auditar, configs))
+
+def formatear_auditoria(resultados):
+    """Tabla de auditar_cursos para la consola: una línea por curso y el detalle de cada deriva."""
+    lineas = [f"{'Curso':>8} {'Estado':<7} {'Nodos':>5} {'Faltan':>6} {'Sobran':>6} {'Difieren':>8}  Categoría padre", "-" * 78]
+    for r in resultados:
+        if r["estado"] == "error":
+            lineas.append(f"{r['course_id']:>8} {'error':<7} {'':>5} {'':>6} {'':>6} {'':>8}  {r['categoria_padre']} ({r['error']})")
+            continue
+        lineas.append(f"{r['course_id']:>8} {r['estado']:<7} {r['nodos']:>5} {len(r['faltan']):>6} {len(r['sobran']):>6} "
+                      f"{len(r['difieren']):>8}  {r['categoria_padre']}")
+        for f in r["faltan"]:
+            lineas.append(f"{'':>8}   falta {f['tipo']} '{f['nombre']}' en '{f['padre'] or '-'}'")
+        for nombre in r["sobran"]:
+            lineas.append(f"{'':>8}   sobra '{nombre}'")
+        for d in r["difieren"]:
+            lineas.append(f"{'':>8}   '{d['nombre']}': {d['motivo']}")
+        for v in r["sin_verificar"]:
+            lineas.append(f"{'':>8}   '{v['nombre']}': sin verificar {', '.join(v['campos'])}")
+    lineas.append("-" * 78)
+    con_deriva = sum(1 for r in resultados if r["estado"] != "ok")
+    lineas.append(f"{len(resultados) - con_deriva}/{len(resultados)} cursos coinciden con la configuración")
+    return "\n".join(lineas)
+
+# --- HISTORIAL DE INSTANTÁNEAS DE CURSOS ---
+
+# AULES_INSTANTANEAS=0 desactiva las instantáneas automáticas antes y después de cada flujo
+INSTANTANEAS_AUTOMATICAS = os.environ.get("AULES_INSTANTANEAS", "1") != "0"
+
+# Campos de cada nodo que se guardan y se comparan (además de id, tipo, nombre y padre)
+CAMPOS_INSTANTANEA = ("peso", "calculada", "idnumber", "aggregationcoef", "formula")
+
+def get_ruta_historial():
+    """Base de datos del historial de instantáneas (informes/instantaneas.sqlite)."""
+    return os.path.join(get_directorio_informes(), "instantaneas.sqlite")
+
+class HistorialInstantaneas:
+    """
+    Historial de la estructura de calificación de los cursos. Cada instantánea es una fila de
+    'instantaneas' que apunta por su huella (SHA-256 del contenido canónico) a un objeto de 'objetos',
+    guardado comprimido con zlib: una estructura que no ha cambiado entre ejecuciones se guarda una
+    sola vez, aunque haya cien instantáneas que la usen.
+    """
+
+    def __init__(self, ruta=None):
+        self.ruta = ruta or get_ruta_historial()
+        os.makedirs(os.path.dirname(os.path.abspath(self.ruta)), exist_ok=True)
+        with self._conectar() as conexion:
+            conexion.executescript("""
+                CREATE TABLE IF NOT EXISTS objetos (huella TEXT PRIMARY KEY, datos BLOB, tamano INTEGER);
+                CREATE TABLE IF NOT EXISTS instantaneas (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, base_url TEXT, course_id TEXT, fecha REAL,
+                    etiqueta TEXT, huella TEXT, nodos INTEGER);
+                CREATE INDEX IF NOT EXISTS instantaneas_curso ON instantaneas (base_url, course_id, fecha);
+            """)
+
+    def _conectar(self):
+        conexion = sqlite3.connect(self.ruta, timeout=10)
+        conexion.row_factory = sqlite3.Row
+        return contextlib.closing(conexion)
+
+    def guardar(self, base_url, course_id, nodos, etiqueta=""):
+        """Añade una instantánea del curso. Devuelve (id, nueva): nueva=False si el contenido ya estaba guardado."""
+        contenido = json.dumps(nodos, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        huella = hashlib.sha256(contenido).hexdigest()
+        with self._conectar() as conexion, conexion:
+            nueva = conexion.execute("INSERT OR IGNORE INTO objetos VALUES (?,?,?)",
+                                     (huella, zlib.compress(contenido, 9), len(contenido))).rowcount == 1
+            cursor = conexion.execute("INSERT INTO instantaneas (base_url, course_id, fecha, etiqueta, huella, nodos) "
+                                      "VALUES (?,?,?,?,?,?)",
+                                      (base_url, str(course_id), time.time(), etiqueta, huella, len(nodos)))
+            return cursor.lastrowid, nueva
+
+    def listar(self, base_url=None, course_id=None, hasta=None):
+        """Instantáneas (sin los nodos) en orden cronológico, filtradas por Aules, curso y fecha máxima."""
+        condiciones, valores = [], []
+        for columna, valor in (("base_url", base_url), ("course_id", course_id)):
+            if valor is not None:
+                condiciones.append(f"{columna}=?")
+                valores.append(str(valor))
+        if hasta is not None:
+            condiciones.append("fecha<=?")
+            valores.append(hasta)
+        donde = f" WHERE {' AND '.join(condiciones)}" if condiciones else ""
+        with self._conectar() as conexion:
+            filas = conexion.execute(f"SELECT * FROM instantaneas{donde} ORDER BY fecha, id", valores).fetchall()
+        return [dict(fila) for fila in filas]
+
+    def obtener(self, instantanea_id, con_nodos=True):
+        """Instantánea (con sus nodos descomprimidos si con_nodos=True), o None si no existe."""
+        columnas = "i.*, o.datos" if con_nodos else "i.*"
+        with self._conectar() as conexion:
+            fila = conexion.execute(f"SELECT {columnas} FROM instantaneas i JOIN objetos o ON o.huella=i.huella "
+                                    "WHERE i.id=?", (int(instantanea_id),)).fetchone()
+        if not fila:
+            return None
+        instantanea = {clave: fila[clave] for clave in fila.keys() if clave != "datos"}
+        if con_nodos:
+            instantanea["nodos"] = json.loads(zlib.decompress(fila["datos"]))
+        return instantanea
+
+    def ocupacion(self):
+        """(instantáneas, objetos distintos, bytes sin comprimir, bytes comprimidos) del historial."""
+        with self._conectar() as conexion:
+            total = conexion.execute("SELECT COUNT(*) FROM instantaneas").fetchone()[0]
+            objetos, bruto, comprimido = conexion.execute(
+                "SELECT COUNT(*), COALESCE(SUM(tamano), 0), COALESCE(SUM(LENGTH(datos)), 0) FROM objetos").fetchone()
+        return total, objetos, bruto, comprimido
+
+def nodos_instantanea(elementos, conocidas=None):
+    """
+    Nodos de una instantánea a partir de obtener_elementos_curso: id, tipo, nombre y padre de cada
+    nodo, más lo que se sepa de él (peso y calculada del árbol; idnumber, aggregationcoef y fórmula
+    anotados en la caché de estructuras).
+    """
+    conocidas = conocidas or {}
+    nodos = []
+    for e in elementos:
+        nodo = {"id": e["id"], "tipo": e["tipo"], "nombre": e["nombre"],
+                "padre": e.get("categoria_padre_id", e.get("categoria_id", ""))}
+        datos = {**conocidas.get(e["id"], {}), **e}
+        nodo.update((campo, datos[campo]) for campo in CAMPOS_INSTANTANEA if datos.get(campo) is not None)
+        nodos.append(nodo)
+    return nodos
+
+def guardar_instantanea(client, course_id, etiqueta="", historial=None, forzar=True):
+    """
+    Lee el árbol del curso y lo guarda en el historial. Devuelve el id de la instantánea o None.
+    Con forzar=True se lee siempre de Aules (una petición, que queda en las cachés para el flujo que
+    venga después); con forzar=False se usa la página en la caché de respuestas si sigue vigente:
+    cualquier escritura en el curso la invalida, así que solo se ahorra la lectura si nada ha cambiado.
+    """
+    if forzar:
+        elementos = obtener_estructura_curso(client, course_id, forzar=True)
+    else:
+        # No obtener_estructura_curso: la caché de estructuras no guarda el peso ni 'calculada'
+        elementos = obtener_elementos_curso(client, course_id)
+    if not elementos:
+        return None
+    conocidas = {}
+    if client.cache_estructuras is not None:
+        with contextlib.suppress(sqlite3.Error):
+            conocidas = client.cache_estructuras.propiedades(client.base_url, course_id)
+    historial = historial or HistorialInstantaneas()
+    instantanea_id, nueva = historial.guardar(client.base_url, course_id, nodos_instantanea(elementos, conocidas), etiqueta)
+    client._log(f"Instantánea {instantanea_id} del curso {course_id} ({etiqueta or 'manual'})"
+                f"{'' if nueva else ': sin cambios, se reutiliza la estructura ya guardada'}.")
+    return instantanea_id
+
+def _instantanea_automatica(client, course_id, etiqueta, forzar=True):
+    """guardar_instantanea de flujo_instrumentado: un fallo se avisa pero nunca interrumpe el flujo."""
+    try:
+        guardar_instantanea(client, course_id, etiqueta, forzar=forzar)
+    except OperacionCancelada:
+        pass
+    except Exception as e:
+        client._log(f"No se pudo guardar la instantánea '{etiqueta}' del curso {course_id}: {e}")
+
+def diferenciar_instantaneas(antes, despues):
+    """
+    Diferencias entre dos listas de nodos de instantánea, emparejados por su ID de Moodle (un nodo
+    renombrado aparece como modificado). Devuelve {anadidos, eliminados, modificados}; cada
+    modificado es (nodo antes, nodo después, {campo: (antes, después)}).
+    """
+    indice = {nodo["id"]: nodo for nodo in antes}
+    vistos = set()
+    diferencias = {"anadidos": [], "eliminados": [], "modificados": []}
+    for nodo in despues:
+        vistos.add(nodo["id"])
+        previo = indice.get(nodo["id"])
+        if previo is None:
+            diferencias["anadidos"].append(nodo)
+        elif previo != nodo:
+            campos = {campo: (previo.get(campo), nodo.get(campo)) for campo in set(previo) | set(nodo)
+                      if previo.get(campo) != nodo.get(campo)}
+            diferencias["modificados"].append((previo, nodo, campos))
+    diferencias["eliminados"] = [nodo for nodo in antes if nodo["id"] not in vistos]
+    return diferencias
+
+def comparar_instantaneas(historial, id_antes, id_despues):
+    """diferenciar_instantaneas de dos instantáneas del historial (sin descomprimir nada si su huella coincide)."""
+    filas = [historial.obtener(instantanea_id, con_nodos=False) for instantanea_id in (id_antes, id_despues)]
+    for instantanea_id, fila in zip((id_antes, id_despues), filas):
+        if fila is None:
+            raise ValueError(f"No existe la instantánea {instantanea_id}")
+    if filas[0]["huella"] == filas[1]["huella"]:
+        return {"anadidos": [], "eliminados": [], "modificados": []}
+    return diferenciar_instantaneas(historial.obtener(id_antes)["nodos"], historial.obtener(id_despues)["nodos"])
+
+def formatear_historial(instantaneas, ocupacion=None):
+    """Tabla legible del historial para --historial."""
+    lineas = [f"{'ID':>5} {'Fecha':<19} {'Curso':>8} {'Nodos':>6}  {'Huella':<12} Etiqueta", "-" * 70]
+    for i in instantaneas:
+        fecha = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(i["fecha"]))
+        lineas.append(f"{i['id']:>5} {fecha:<19} {i['course_id']:>8} {i['nodos']:>6}  {i['huella'][:12]:<12} {i['etiqueta']}")
+    if ocupacion:
+        total, objetos, bruto, comprimido = ocupacion
+        lineas.append(f"{total} instantáneas, {objetos} estructuras distintas: {bruto / 1024:.1f} KB "
+                      f"en {comprimido / 1024:.1f} KB comprimidos")
+    return "\n".join(lineas)
+
+def formatear_diferencias_instantaneas(diferencias):
+    """Resumen legible de diferenciar_instantaneas para --diferencias."""
+    lineas = []
+    for nodo in diferencias["anadidos"]:
+        lineas.append(f"+ {nodo['tipo']} '{nodo['nombre']}' ({nodo['id']})")
+    for nodo in diferencias["eliminados"]:
+        lineas.append(f"- {nodo['tipo']} '{nodo['nombre']}' ({nodo['id']})")
+    for _, nodo, campos in diferencias["modificados"]:
+        cambios = ", ".join(f"{campo}: {antes!r} -> {despues!r}" for campo, (antes, despues) in sorted(campos.items()))
+        lineas.append(f"~ {nodo['tipo']} '{nodo['nombre']}' ({nodo['id']}): {cambios}")
+    return "\n".join(lineas) or "Sin diferencias."
+
+def _coeficiente_nodo(nodo, con_peso):
+    """aggregationcoef de un nodo de instantánea: el peso del árbol solo vale en las agregaciones ponderadas."""
+    if con_peso and nodo.get("peso") is not None:
+        return nodo["peso"]
+    return nodo.get("aggregationcoef")
+
+def configuracion_desde_instantanea(nodos, categoria_padre, con_peso=False, completar=None):
+    """
+    categorias_hijas de 'categoria_padre' reconstruidas desde una instantánea, en el formato de
+    datos_aules.json. El peso sale de aggregationcoef (anotado en la caché) o, si con_peso=True
+    (agregación de AGREGACIONES_CON_PESO), del peso del árbol; idnumber y fórmula, de la caché.
+    Lo que la instantánea no sabe de un nodo se pide a completar(nodo, campos), que devuelve los
+    valores actuales (leer_ajustes_elemento) o None; así no se borra lo que no se guardó.
+    Devuelve None si la instantánea no tiene esa categoría.
+    """
+    padre = next((n for n in nodos if n["tipo"] == "category" and n["nombre"] == categoria_padre), None)
+    if padre is None:
+        return None
+
+    def valores(nodo, es_ce):
+        conocidos = {}
+        coef = _coeficiente_nodo(nodo, con_peso)
+        if coef is not None:
+            conocidos["aggregationcoef"] = coef
+        if es_ce:
+            if "idnumber" in nodo:
+                conocidos["idnumber"] = nodo["idnumber"]
+            if "formula" in nodo:
+                conocidos["formula"] = nodo["formula"]
+            elif nodo.get("calculada") is False:
+                conocidos["formula"] = ""
+        faltan = [campo for campo in (("aggregationcoef", "idnumber", "formula") if es_ce else ("aggregationcoef",))
+                  if campo not in conocidos]
+        actuales = (completar(nodo, faltan) if faltan and completar else None) or {}
+        return {**{campo: actuales[campo] for campo in faltan if campo in actuales}, **conocidos}
+
+    ras = [n for n in nodos if n["tipo"] == "category" and n["padre"] == padre["id"]]
+    categorias_hijas = []
+    for ra in ras:
+        elementos = []
+        for ce in (n for n in nodos if n["padre"] == ra["id"]):
+            datos = valores(ce, True)
+            extra = {clave: datos[clave] for clave in ("idnumber", "formula") if datos.get(clave)}
+            if datos.get("aggregationcoef") not in (None, 1, 1.0):
+                extra["aggregationcoef"] = datos["aggregationcoef"]
+            elementos.append({"nombre": ce["nombre"], **extra} if extra else ce["nombre"])
+        categorias_hijas.append({"nombre": ra["nombre"], "aggregationcoef": valores(ra, False).get("aggregationcoef", 0.0),
+                                 "elementos": elementos})
+    return categorias_hijas
+
+def instantanea_de_otro_curso(instantanea, base_url, course_id):
+    """Descripción del curso de la instantánea si no es el de base_url/course_id (None si lo es)."""
+    if (instantanea["base_url"].rstrip("/"), int(instantanea["course_id"])) == (base_url.rstrip("/"), int(course_id)):
+        return None
+    return f"la instantánea {instantanea['id']} es del curso {instantanea['course_id']} de {instantanea['base_url']}"
+
+def resolver_instantanea(historial, referencia, base_url=None, course_id=None, forzar=False):
+    """
+    ID de instantánea a partir de 'referencia': un ID, o una fecha ('AAAA-MM-DD' o 'AAAA-MM-DD HH:MM')
+    que elige la última instantánea del curso tomada hasta ese momento. Lanza ValueError si no hay o,
+    salvo con forzar=True, si el ID es de otro curso o servidor.
+    """
+    referencia = str(referencia).strip()
+    if referencia.isdigit():
+        instantanea = historial.obtener(referencia, con_nodos=False)
+        if instantanea is None:
+            raise ValueError(f"No existe la instantánea {referencia}")
+        otro = instantanea_de_otro_curso(instantanea, base_url, course_id) if base_url and course_id else None
+        if otro and not forzar:
+            raise ValueError(f"{otro}, no del curso {course_id}; usa --forzar para usarla igualmente")
+        return int(referencia)
+    for formato, margen in (("%Y-%m-%d %H:%M", 60), ("%Y-%m-%d", 86400)):
+        try:
+            hasta = time.mktime(time.strptime(referencia, formato)) + margen
+            break
+        except ValueError:
+            continue
+    else:
+        raise ValueError(f"'{referencia}' no es un ID de instantánea ni una fecha AAAA-MM-DD [HH:MM]")
+    candidatas = historial.listar(base_url, course_id, hasta)
+    if not candidatas:
+        raise ValueError(f"No hay instantáneas del curso {course_id} anteriores a {referencia}")
+    return candidatas[-1]["id"]
+
+def restaurar_instantanea(client, course_id, instantanea_id, categoria_padre, config_global=None, historial=None,
+                          forzar=False):
+    """
+    Devuelve 'categoria_padre' del curso al estado de una instantánea con sincronizar_todo: crea lo
+    que falte y restablece pesos, idnumber y fórmulas. Los campos que la instantánea no guardó de un
+    nodo (p. ej. el idnumber si nunca lo escribió el script) se leen de Aules, se dejan como están y
+    se avisa de cada uno. Lo que sobra respecto a la instantánea no se borra, solo se avisa.
+    Devuelve False si la instantánea no existe, no contiene la categoría o (salvo con forzar=True)
+    es de otro curso o servidor.
+    """
+    historial = historial or HistorialInstantaneas()
+    instantanea = historial.obtener(instantanea_id)
+    if instantanea is None:
+        client._log(f"No existe la instantánea {instantanea_id}", "error")
+        return False
+    otro = instantanea_de_otro_curso(instantanea, client.base_url, course_id)
+    if otro and not forzar:
+        client._log(f"No se restaura: {otro}, no del curso {course_id}.", "error")
+        return False
+    if otro:
+        client._log(f"Aviso: {otro}; se restaura en el curso {course_id} porque se ha forzado.")
+    actuales = obtener_estructura_curso(client, course_id, forzar=True) or []
+
+    def completar(nodo, campos):
+        elemento = next((e for e in actuales if e["tipo"] == nodo["tipo"] and e["nombre"] == nodo["nombre"]), None)
+        if elemento is None:
+            client._log(f"Aviso: la instantánea no guarda {', '.join(campos)} de '{nodo['nombre']}' y ya no está "
+                        "en Aules: se creará con los valores por defecto.")
+            return None
+        client._log(f"Aviso: la instantánea no guarda {', '.join(campos)} de '{nodo['nombre']}': "
+                    "no se restaura, se mantiene el valor actual.")
+        return leer_ajustes_elemento(client, course_id, elemento, con_formula="formula" in campos)
+
+    con_peso = (config_global or {}).get("aggregation") in AGREGACIONES_CON_PESO
+    categorias_hijas = configuracion_desde_instantanea(instantanea["nodos"], categoria_padre, con_peso, completar)
+    if categorias_hijas is None:
+        client._log(f"La instantánea {instantanea_id} no contiene '{categoria_padre}'", "error")
+        return False
+    client._log(f"Restaurando '{categoria_padre}' al estado de la instantánea {instantanea_id} "
+                f"({time.strftime('%Y-%m-%d %H:%M', time.localtime(instantanea['fecha']))}).")
+    sincronizar_todo(client, course_id, categoria_padre, categorias_hijas, config_global)
+    guardados = {n["nombre"] for n in instantanea["nodos"]}
+    elementos = obtener_estructura_curso(client, course_id) or []
+    padre = encontrar_categoria_por_nombre(elementos, categoria_padre)
+    for e in encontrar_elementos_por_categoria(elementos, padre["id"]) if padre else []:
+        if e["nombre"] not in guardados:
+            client._log(f"'{e['nombre']}' no estaba en la instantánea; no se elimina.")
+    return True
+
+# --- HUELLAS DE LA CONFIGURACIÓN (árbol de Merkle) ---
+
+def _huella(*partes):
+    """SHA-1 (hex) de una representación canónica de 'partes'."""
+    texto = json.dumps(partes, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha1(texto.encode("utf-8")).hexdigest()
+
+def arbol_huellas(data):
+    """
+    Árbol de huellas de una configuración (datos_aules.json como diccionario):
+      {huella, base, ras: {nombre: {huella, propia, ces: {nombre: {huella, ajustes, formula}}}}}
+    Cada CE tiene la huella de sus ajustes (idnumber, aggregationcoef) y la de su fórmula; cada RA,
+    la de su peso y la de sus CE; la raíz, la de la categoría padre y la configuración global ('base')
+    y la de todas las RA. Un RA con la misma huella que antes no ha cambiado en nada.
+    No incluye course_id ni credenciales: la misma estructura tiene la misma huella en cualquier curso.
+    """
+    ras = {}
+    for ra in data["categorias_hijas"]:
+        ces = {}
+        for elemento_info in ra.get("elementos", []):
+            nombre, formula, idnumber, coef = _normalizar_elemento(elemento_info)
+            ajustes, huella_formula = _huella(idnumber or "", float(coef)), _huella(formula or "")
+            ces[nombre] = {"huella": _huella(ajustes, huella_formula), "ajustes": ajustes, "formula": huella_formula}
+        propia = _huella(float(ra.get("aggregationcoef", 0.0)))
+        ras[ra["nombre"]] = {"huella": _huella(propia, {nombre: ce["huella"] for nombre, ce in ces.items()}),
+                             "propia": propia, "ces": ces}
+    base = _huella(data.get("categoria_padre"), data.get("configuracion_global"))
+    return {"huella": _huella(base, {nombre: ra["huella"] for nombre, ra in ras.items()}), "base": base, "ras": ras}
+
+def leer_huella_aplicada(client, course_id, categoria_padre):
+    """Árbol de huellas guardado para el curso (None si no hay caché o nunca se aplicó entero)."""
+    if client.cache_estructuras is None:
+        return None
+    try:
+        return client.cache_estructuras.huella_aplicada(client.base_url, course_id, categoria_padre)
+    except (sqlite3.Error, ValueError) as e:
+        client._log(f"No se pudo leer la huella aplicada del curso {course_id}: {e}", "error")
+        return None
+
+def recordar_huella_aplicada(client, course_id, categoria_padre, arbol):
+    """
+    Guarda (u olvida, con arbol=None) la huella aplicada al curso (sin efecto si no hay caché).
+    Con categoria_padre=None olvida las de todas las categorías padre del curso.
+    """
+    if client.cache_estructuras is None:
+        return
+    try:
+        client.cache_estructuras.recordar_huella(client.base_url, course_id, categoria_padre, arbol)
+    except sqlite3.Error as e:
+        client._log(f"No se pudo guardar la huella aplicada del curso {course_id}: {e}", "error")
+
+# --- MODO VIGILANCIA: APLICAR SOLO LO QUE CAMBIA EN EL JSON ---
+
+def diferenciar_arboles(anterior, nueva, arbol=None):
+    """
+    Cambios de la configuración 'nueva' (diccionario) respecto al árbol de huellas 'anterior'
+    (arbol_huellas de la versión ya aplicada). Devuelve:
+      - completa: True si cambia algo que afecta a todo (categoría padre, configuración global)
+      - crear: categorias_hijas con solo lo nuevo (RA nuevas enteras, CE nuevos de RA existentes)
+      - modificar: [(tipo "ra"/"ce", nombre, {aggregationcoef, idnumber})] de los nodos existentes
+      - formulas: [(nombre, formula)] de los CE existentes cuya fórmula cambia ('' = quitarla)
+      - eliminados: nombres que ya no están en el JSON (no se borran de Aules)
+    Solo se recorren los RA cuya huella ha cambiado: el coste depende del cambio, no del módulo.
+    """
+    cambios = {"completa": False, "crear": [], "modificar": [], "formulas": [], "eliminados": []}
+    arbol = arbol or arbol_huellas(nueva)
+    if anterior is None or anterior["base"] != arbol["base"]:
+        cambios["completa"] = True
+        return cambios
+    if anterior["huella"] == arbol["huella"]:
+        return cambios
+
+    for ra in nueva["categorias_hijas"]:
+        nombre_ra = ra["nombre"]
+        antes, despues = anterior["ras"].get(nombre_ra), arbol["ras"][nombre_ra]
+        if antes is None:
+            cambios["crear"].append(ra)
+            continue
+        if antes["huella"] == despues["huella"]:
+            continue
+        if antes["propia"] != despues["propia"]:
+            cambios["modificar"].append(("ra", nombre_ra, {"aggregationcoef": ra.get("aggregationcoef", 0.0)}))
+        nuevos = []
+        for elemento_info in ra.get("elementos", []):
+            nombre, formula, idnumber, coef = _normalizar_elemento(elemento_info)
+            ce_antes, ce = antes["ces"].get(nombre), despues["ces"][nombre]
+            if ce_antes is None:
+                nuevos.append(elemento_info)
+                continue
+            if ce_antes["huella"] == ce["huella"]:
+                continue
+            if ce_antes["ajustes"] != ce["ajustes"]:
+                cambios["modificar"].append(("ce", nombre, {"aggregationcoef": coef, "idnumber": idnumber}))
+            if ce_antes["formula"] != ce["formula"]:
+                cambios["formulas"].append((nombre, formula or ""))
+        if nuevos:
+            cambios["crear"].append({**ra, "elementos": nuevos})
+        cambios["eliminados"] += [nombre for nombre in antes["ces"] if nombre not in despues["ces"]]
+    cambios["eliminados"] += [nombre for nombre in anterior["ras"] if nombre not in arbol["ras"]]
+    return cambios
+
+def diferenciar_configuraciones(anterior, nueva):
+    """Como diferenciar_arboles, pero a partir de la versión anterior completa (diccionario o None)."""
+    return diferenciar_arboles(arbol_huellas(anterior) if anterior is not None else None, nueva)
+
+def hay_cambios(cambios):
+    """True si diferenciar_arboles indica algo que enviar a Aules (los nodos quitados solo se avisan)."""
+    return bool(cambios["completa"] or cambios["crear"] or cambios["modificar"] or cambios["formulas"])
+
+def resumir_cambios(cambios):
+    """Texto corto de diferenciar_configuraciones para el log."""
+    if cambios["completa"]:
+        return "cambio global (categoría padre o configuración): sincronización completa"
+    partes = []
+    nuevos = sum(len(ra.get("elementos", [])) for ra in cambios["crear"])
+    if cambios["crear"]:
+        partes.append(f"{len(cambios['crear'])} RA con nodos nuevos ({nuevos} CE)")
+    if cambios["modificar"]:
+        partes.append(f"{len(cambios['modificar'])} nodos modificados")
+    if cambios["formulas"]:
+        partes.append(f"{len(cambios['formulas'])} fórmulas")
+    if cambios["eliminados"]:
+        partes.append(f"{len(cambios['eliminados'])} quitados del JSON")
+    return ", ".join(partes) or "sin cambios"
+
+@flujo_instrumentado("vigilar", instantaneas=True)
+def aplicar_cambios(client, course_id, data, cambios):
+    """
+    Envía a Aules solo lo que indica diferenciar_configuraciones: crea los nodos nuevos (como
+    sincronizar_todo, pero solo con ellos), modifica los existentes y cambia sus fórmulas.
+    Los nodos quitados del JSON solo se avisan: borrarlos es cosa de la opción Eliminar.
+    """
+    config_global = data.get("configuracion_global", {})
+    categoria_padre = data["categoria_padre"]
+    if cambios["completa"]:
+        sincronizar_todo.__wrapped__(client, course_id, categoria_padre, data["categorias_hijas"], config_global)
+        return
+    for nombre in cambios["eliminados"]:
+        client._log(f"'{nombre}' ya no está en el JSON; no se elimina de Aules.")
+    if cambios["crear"]:
+        sincronizar_todo.__wrapped__(client, course_id, categoria_padre, cambios["crear"], config_global)
+
+    if not (cambios["modificar"] or cambios["formulas"]):
+        return
+    ce_as_category = config_global.get("ce_as_category", False)
+    elementos = obtener_estructura_curso(client, course_id) or []
+
+    def buscar(nombre, es_categoria):
+        if es_categoria:
+            return encontrar_categoria_por_nombre(elementos, nombre)
+        return next((e for e in elementos if e["tipo"] == "item" and e["nombre"] == nombre), None)
+
+    for tipo, nombre, valores in cambios["modificar"]:
+        client.comprobar_cancelacion()
+        es_categoria = tipo == "ra" or ce_as_category
+        elemento = buscar(nombre, es_categoria)
+        if not elemento:
+            client._log(f"No se encontró '{nombre}' en Aules; usa Sincronizar para crearlo.", "error")
+        elif tipo == "ra":
+            modificar_gradepass_categoria(client, course_id, elemento["id"], nombre, config_global, valores["aggregationcoef"])
+        elif es_categoria:
+            modificar_gradepass_categoria(client, course_id, elemento["id"], nombre, config_global,
+                                          valores["aggregationcoef"], valores["idnumber"])
+        else:
+            modificar_gradepass_item(client, course_id, elemento["id"], nombre, config_global,
+                                     valores["idnumber"], valores["aggregationcoef"])
+
+    pendientes = []
+    for nombre, formula in cambios["formulas"]:
+        elemento = buscar(nombre, ce_as_category)
+        if not elemento:
+            client._log(f"No se encontró '{nombre}' en Aules; usa Sincronizar para crearlo.", "error")
+        elif not formula:
+            # Quitar una fórmula no depende de ninguna otra
+            if ce_as_category:
+                modificar_formula_categoria(client, course_id, elemento["id"], nombre, "")
+            else:
+                modificar_formula_item(client, course_id, elemento["id"], nombre, "")
+        else:
+            pendientes.append((nombre, elemento["id"], formula, ce_as_category))
+    client.comprobar_cancelacion()
+    aplicar_formulas_diferidas(client, course_id, pendientes, analizar_formulas(data["categorias_hijas"]))
+
+def _cliente_con_errores(client):
+    """Cliente derivado para este mismo hilo y la lista donde se acumulan los errores que registre."""
+    errores = []
+    def registrar(mensaje, nivel="info"):
+        if nivel == "error":
+            errores.append(mensaje)
+        client._log(mensaje, nivel)
+    derivado = client.derivar(log_callback=registrar, progress_callback=client.progress_callback)
+    derivado._local = client._local  # mismo hilo: comparte la cancelación y el recuento de peticiones
+    return derivado, errores
+
+@flujo_instrumentado("sincronizar", instantaneas=True)
+def sincronizar_incremental(client, course_id, data, completa=False):
+    """
+    Sincroniza solo lo que ha cambiado en el JSON desde la última vez que se aplicó entero a este
+    curso (según la huella guardada en la caché local). Sin huella guardada, o con completa=True,
+    hace una sincronización completa. La huella solo se actualiza si el flujo termina sin errores.
+    Los cambios hechos a mano en Aules no se detectan: para corregirlos, usa la sincronización completa.
+    """
+    categoria_padre = data["categoria_padre"]
+    arbol = arbol_huellas(data)
+    anterior = None if completa else leer_huella_aplicada(client, course_id, categoria_padre)
+    cambios = diferenciar_arboles(anterior, data, arbol)
+    if anterior is None:
+        client._log("No hay huella aplicada para este curso: sincronización completa.")
+    else:
+        client._log(f"Cambios desde la última sincronización: {resumir_cambios(cambios)}")
+        if not hay_cambios(cambios):
+            for nombre in cambios["eliminados"]:
+                client._log(f"'{nombre}' ya no está en el JSON; no se elimina de Aules.")
+            recordar_huella_aplicada(client, course_id, categoria_padre, arbol)
+            return cambios
+
+    derivado, errores = _cliente_con_errores(client)
+    aplicar_cambios.__wrapped__(derivado, course_id, data, cambios)
+    if errores:
+        client._log("Hubo errores: la huella del curso no se actualiza y se reintentará la próxima vez.", "error")
+    else:
+        recordar_huella_aplicada(client, course_id, categoria_padre, arbol)
+    return cambios
+
+# Segundos entre comprobaciones del archivo y sin cambios antes de aplicar (varios guardados seguidos = uno)
+INTERVALO_VIGILANCIA = 0.5
+ESPERA_VIGILANCIA = 0.8
+
+def vigilar_configuracion(client, ruta, course_id=None, detener=None, intervalo=INTERVALO_VIGILANCIA,
+                          espera=ESPERA_VIGILANCIA, aplicada=None):
+    """
+    Vigila 'ruta' comprobando su fecha y tamaño y, cuando deja de cambiar durante 'espera' segundos,
+    aplica en Aules solo las diferencias con la última versión aplicada. La versión de partida es
+    'aplicada' o, si no se indica, la de la huella guardada del curso: al empezar se aplica con
+    sincronizar_incremental lo guardado mientras no se vigilaba. Si un envío falla, la versión de
+    partida no avanza y esos cambios se reintentan en el siguiente guardado. Un archivo no válido
+    (p. ej. a medio guardar) se ignora hasta el siguiente cambio. Termina cuando se activa 'detener'
+    (threading.Event).
+    """
+    detener = detener or threading.Event()
+
+    def leer():
+        with open(ruta, encoding="utf-8") as f:
+            data = json.load(f)
+        validar_configuracion(data, ruta)
+        return data
+
+    def firma():
+        try:
+            estado = os.stat(ruta)
+        except OSError:
+            return None
+        return (estado.st_mtime_ns, estado.st_size)
+
+    vista = firma()
+    if aplicada is None:
+        # Los guardados hechos antes de vigilar también cuentan
+        data = leer()
+        destino = course_id or data["course_id"]
+        derivado, errores = _cliente_con_errores(client)
+        sincronizar_incremental(derivado, destino, data)
+        if client.cache_estructuras is not None:
+            arbol_aplicado = leer_huella_aplicada(client, destino, data["categoria_padre"])
+        else:
+            arbol_aplicado = None if errores else arbol_huellas(data)
+        aplicada = data if arbol_aplicado is not None else None
+    else:
+        data, arbol_aplicado = aplicada, arbol_huellas(aplicada)
+    client._log(f"Vigilando {ruta}; los cambios se aplicarán al curso {course_id or data['course_id']}.")
+    while not detener.wait(intervalo):
+        actual = firma()
+        if actual == vista:
+            continue
+        # Esperar a que el editor termine de guardar
+        while not detener.wait(espera):
+            siguiente = firma()
+            if siguiente == actual:
+                break
+            actual = siguiente
+        vista = actual
+        try:
+            data = leer()
+        except (OSError, ValueError) as e:
+            errores = e.errores if isinstance(e, ErrorConfiguracion) else [str(e)]
+            for error in errores:
+                client._log(f"{ruta} no es válido, se ignora este cambio: {error}", "error")
+            continue
+        arbol = arbol_huellas(data)
+        cambios = diferenciar_arboles(arbol_aplicado, data, arbol)
+        client._log(f"Cambio detectado: {resumir_cambios(cambios)}")
+        if hay_cambios(cambios):
+            inicio = time.perf_counter()
+            destino = course_id or data["course_id"]
+            derivado, errores = _cliente_con_errores(client)
+            try:
+                aplicar_cambios(derivado, destino, data, cambios)
+            except OperacionCancelada:
+                break
+            except Exception as e:
+                client._log(f"Error al aplicar los cambios: {e}", "error")
+                continue
+            if errores:
+                client._log("Hubo errores: estos cambios se reintentarán en el siguiente guardado.", "error")
+                continue
+            client._log(f"Cambios aplicados en {time.perf_counter() - inicio:.1f}s.")
+            guardada = leer_huella_aplicada(client, destino, data["categoria_padre"])
+            if guardada and arbol_aplicado and guardada["huella"] == arbol_aplicado["huella"]:
+                # El curso estaba al día con la versión anterior: ahora lo está con esta
+                recordar_huella_aplicada(client, destino, data["categoria_padre"], arbol)
+        aplicada, arbol_aplicado = data, arbol
+    return aplicada
+
+# --- CARGA MASIVA DE NOTAS (grade/import/csv) ---
+
+# Campo de usuario con el que Moodle identifica al alumno de cada fila
+IDENTIFICADORES_ALUMNO = ("useremail", "username", "useridnumber", "userid")
+
+def leer_tabla_xlsx(ruta):
+    """Lee la primera hoja de un .xlsx (sin dependencias externas). Devuelve (cabecera, filas) como texto."""
+    ns = {"m": "http://schemas.openxmlformats.org/spreadsheetml/2006/main"}
+    with zipfile.ZipFile(ruta) as libro:
+        compartidas = []
+        if "xl/sharedStrings.xml" in libro.namelist():
+            raiz = ElementTree.fromstring(libro.read("xl/sharedStrings.xml"))
+            for si in raiz.findall("m:si", ns):
+                compartidas.append("".join(t.text or "" for t in si.iter(f"{{{ns['m']}}}t")))
+        hojas = sorted(n for n in libro.namelist() if n.startswith("xl/worksheets/sheet") and n.endswith(".xml"))
+        raiz = ElementTree.fromstring(libro.read(hojas[0]))
+
+    tabla = []
+    for fila in raiz.iter(f"{{{ns['m']}}}row"):
+        celdas = {}
+        for celda in fila.findall("m:c", ns):
+            letras = "".join(ch for ch in celda.get("r", "") if ch.isalpha())
+            columna = 0
+            for ch in letras:
+                columna = columna * 26 + (ord(ch.upper()) - 64)
+            tipo = celda.get("t")
+            valor = celda.find("m:v", ns)
+            if tipo == "s" and valor is not None:
+                texto = compartidas[int(valor.text)]
+            elif tipo == "inlineStr":
+                texto = "".join(t.text or "" for t in celda.iter(f"{{{ns['m']}}}t"))
+            else:
+                texto = valor.text if valor is not None and valor.text is not None else ""
+            celdas[columna - 1] = texto
+        if celdas:
+            tabla.append([celdas.get(i, "") for i in range(max(celdas) + 1)])
+    if not tabla:
+        return [], []
+    return tabla[0], tabla[1:]
+
+def leer_tabla(ruta):
+    """Lee un CSV (separador detectado) o XLSX. Devuelve (cabecera, filas)."""
+    if ruta.lower().endswith(".xlsx"):
+        return leer_tabla_xlsx(ruta)
+    with open(ruta, 'r', encoding='utf-8-sig', newline='') as f:
+        muestra = f.read(4096)
+        f.seek(0)
+        try:
+            dialecto = csv.Sniffer().sniff(muestra, delimiters=",;\t")
+        except csv.Error:
+            dialecto = csv.excel
+        filas = [fila for fila in csv.reader(f, dialecto) if any(c.strip() for c in fila)]
+    if not filas:
+        return [], []
+    return filas[0], filas[1:]
+
+def mapear_columnas_notas(cabecera, data, elementos):
+    """
+    Relaciona cada columna de notas (idnumber o nombre del CE) con el ID del item de Aules.
+    Devuelve ({indice_columna: id_item}, [avisos]).
+    """
+    nombre_por_clave = {}
+    for categoria_hija in data.get("categorias_hijas", []):
+        for elemento_info in categoria_hija.get("elementos", []):
+            nombre, _, idnumber, _ = _normalizar_elemento(elemento_info)
+            nombre_por_clave[nombre] = nombre
+            if idnumber:
+                nombre_por_clave[idnumber] = nombre
+    items = {e["nombre"]: e for e in elementos if e["tipo"] == "item"}
+    categorias = {e["nombre"] for e in elementos if e["tipo"] == "category"}
+
+    mapeo = {}
+    avisos = []
+    for i, columna in enumerate(cabecera[1:], start=1):
+        nombre = nombre_por_clave.get(columna.strip(), columna.strip())
+        if nombre in items:
+            mapeo[i] = limpiar_id(items[nombre].get("id_numerico") or items[nombre]["id"])
+        elif nombre in categorias:
+            avisos.append(f"Columna '{columna}': '{nombre}' es una categoría (ce_as_category) y no admite notas importadas")
+        else:
+            avisos.append(f"Columna '{columna}': no existe ningún item con ese idnumber o nombre en el curso")
+    return mapeo, avisos
+
+def validar_filas_notas(cabecera, filas, mapeo, grademax):
+    """
+    Separa las filas importables de las rechazadas (alumno vacío o repetido, notas no numéricas o fuera de rango).
+    Las filas válidas se devuelven con las notas normalizadas a punto decimal.
+    """
+    validas = []
+    rechazadas = []
+    vistos = set()
+    for numero, fila in enumerate(filas, start=2):
+        alumno = fila[0].strip() if fila else ""
+        fila = [alumno] + [c.strip() for c in fila[1:]]
+        motivo = None
+        if not alumno:
+            motivo = "Alumno vacío"
+        elif alumno in vistos:
+            motivo = "Alumno repetido"
+        else:
+            for i in mapeo:
+                valor = fila[i].strip() if i < len(fila) else ""
+                if not valor:
+                    continue
+                try:
+                    nota = float(valor.replace(",", "."))
+                except ValueError:
+                    motivo = f"Nota no numérica en '{cabecera[i]}': {valor}"
+                    break
+                if nota < 0 or nota > grademax:
+                    motivo = f"Nota fuera de rango (0-{grademax}) en '{cabecera[i]}': {valor}"
+                    break
+                # Moodle solo entiende el punto decimal
+                fila[i] = valor.replace(",", ".")
+        if motivo:
+            rechazadas.append({"fila": numero, "alumno": alumno, "motivo": motivo})
+        else:
+            vistos.add(alumno)
+            validas.append(fila)
+    return validas, rechazadas
+
+def trocear_filas(cabecera, filas, max_filas=200, max_bytes=256 * 1024):
+    """Divide las filas en lotes que no superen max_filas ni max_bytes de CSV."""
+    lotes = []
+    actual = []
+    tamano = len(",".join(cabecera))
+    for fila in filas:
+        tamano_fila = len(",".join(fila)) + 1
+        if actual and (len(actual) >= max_filas or tamano + tamano_fila > max_bytes):
+            lotes.append(actual)
+            actual = []
+            tamano = len(",".join(cabecera))
+        actual.append(fila)
+        tamano += tamano_fila
+    if actual:
+        lotes.append(actual)
+    return lotes
+
+def _campos_formulario(formulario):
+    """Valores actuales (inputs, casillas marcadas, áreas de texto y selects) de un formulario HTML de Moodle."""
+    campos = {}
+    for entrada in formulario.find_all("input"):
+        if entrada.get("name") and entrada.get("type", "text") in ("hidden", "text"):
+            campos[entrada["name"]] = entrada.get("value", "")
+        elif entrada.get("name") and entrada.get("type") == "checkbox" and entrada.has_attr("checked"):
+            campos[entrada["name"]] = entrada.get("value", "1")
+    for area in formulario.find_all("textarea"):
+        if area.get("name"):
+            campos[area["name"]] = area.get_text()
+    for select in formulario.find_all("select"):
+        if select.get("name"):
+            opcion = select.find("option", selected=True) or select.find("option")
+            campos[select["name"]] = opcion.get("value", "") if opcion else ""
+    return campos
+
+PATRON_REPOSITORIO_SUBIDA = re.compile(r'"id":"?(\d+)"?[^{}]*?"type":"upload"')
+PATRON_CONTEXTO_FILEPICKER = re.compile(r'"context":\{"id":"?(\d+)')
+
+def _subir_borrador(client, pagina, nombre, contenido):
+    """
+    Sube un archivo al área de borradores del usuario, como el selector de archivos del formulario
+    ('userfile'). Devuelve (formulario, itemid) o (None, mensaje de error).
+    """
+    soup = client.parsear_html(pagina)
+    entrada = soup.find("input", attrs={"name": "userfile"})
+    repositorio = PATRON_REPOSITORIO_SUBIDA.search(pagina)
+    contexto = PATRON_CONTEXTO_FILEPICKER.search(pagina)
+    if entrada is None or not entrada.get("value") or not repositorio or not contexto:
+        return None, "No se encontró el selector de archivos del importador CSV"
+    itemid = entrada["value"]
+    r = client.post("repository/repository_ajax.php?action=upload", operacion="other",
+                    data={"sesskey": client.sesskey, "repo_id": repositorio.group(1), "itemid": itemid,
+                          "ctx_id": contexto.group(1), "savepath": "/", "title": nombre, "overwrite": "1"},
+                    files={"repo_upload_file": (nombre, contenido, "text/csv")})
+    try:
+        respuesta = r.json()
+    except ValueError:
+        respuesta = {}
+    if r.status_code != 200 or respuesta.get("error"):
+        return None, f"Moodle no aceptó el archivo del lote: {respuesta.get('error') or f'HTTP {r.status_code}'}"
+    return entrada.find_parent("form"), itemid
+
+def _enviar_lote_notas(client, course_id, cabecera, lote, mapeo, identificador):
+    """
+    Sube un lote por el importador CSV de Moodle: el CSV va al área de borradores y el formulario
+    recibe su itemid en 'userfile', como al elegir un archivo en el navegador; después se envía el
+    mapeo de columnas. Devuelve la lista de errores del servidor.
+    """
+    salida = io.StringIO()
+    escritor = csv.writer(salida)
+    escritor.writerow(cabecera)
+    escritor.writerows(lote)
+
+    # Abrir el formulario no importa nada: no debe invalidar las cachés del curso
+    r = client.get(f"grade/import/csv/index.php?id={course_id}", operacion="other")
+    if r.status_code != 200:
+        return [f"Error HTTP {r.status_code} al abrir el importador CSV"]
+    formulario, itemid = _subir_borrador(client, r.text, "notas.csv", salida.getvalue().encode("utf-8"))
+    if formulario is None:
+        return [itemid]
+    datos = _campos_formulario(formulario)
+    datos.update({
+        "id": course_id,
+        "sesskey": client.sesskey,
+        "userfile": itemid,
+        "encoding": "UTF-8",
+        "separator": "comma",
+        "previewrows": "10",
+        "submitbutton": "Upload grades"
+    })
+    r = client.post("grade/import/csv/index.php", data=datos)
+    soup = client.parsear_html(r.text)
+    entrada_codigo = soup.find("input", attrs={"name": "importcode"})
+    if r.status_code != 200 or entrada_codigo is None:
+        return ["Moodle no aceptó el CSV del lote (no se mostró el formulario de mapeo)"]
+
+    campos = _campos_formulario(entrada_codigo.find_parent("form"))
+    campos["mapfrom"] = "0"
+    campos["mapto"] = identificador
+    for i in range(1, len(cabecera)):
+        campos[f"mapping_{i}"] = mapeo.get(i, "0")
+    campos["sesskey"] = client.sesskey
+    campos["submitbutton"] = "Upload grades"
+    r = client.post("grade/import/csv/index.php", data=campos)
+    soup = client.parsear_html(r.text)
+    errores = [nodo.get_text(" ", strip=True) for nodo in soup.select(".alert-danger, .notifyproblem, .errorbox")]
+    if r.status_code != 200:
+        errores.append(f"Error HTTP {r.status_code} al confirmar el lote")
+    return errores
+
+@flujo_instrumentado("importar_notas")
+def importar_calificaciones(client, course_id, ruta, data, identificador="useremail", max_filas=200):
+    """
+    Carga masiva de notas: lee un CSV/XLSX alumno x idnumber, relaciona las columnas con los items
+    creados por insertar_categorias_y_items y las envía por el importador CSV de Moodle en lotes.
+    Devuelve un informe con las filas importadas y rechazadas.
+    """
+    if identificador not in IDENTIFICADORES_ALUMNO:
+        raise ValueError(f"Identificador de alumno no válido: {identificador}")
+    cabecera, filas = leer_tabla(ruta)
+    informe = {"importadas": 0, "rechazadas": [], "avisos": [], "errores_servidor": [], "lotes": 0}
+    if not cabecera:
+        client._log("El fichero de notas está vacío.", "error")
+        return informe
+
+    elementos = obtener_estructura_curso(client, course_id)
+    mapeo, informe["avisos"] = mapear_columnas_notas(cabecera, data, elementos)
+    for aviso in informe["avisos"]:
+        client._log(aviso, "error")
+    if not mapeo:
+        client._log("Ninguna columna corresponde a un item del curso; no se importa nada.", "error")
+        return informe
+
+    grademax = float(data.get("configuracion_global", {}).get("grademax", 100))
+    validas, informe["rechazadas"] = validar_filas_notas(cabecera, filas, mapeo, grademax)
+    lotes = trocear_filas(cabecera, validas, max_filas)
+    informe["lotes"] = len(lotes)
+    client._log(f"Importando {len(validas)} alumnos x {len(mapeo)} columnas en {len(lotes)} lotes...")
+
+    for i, lote in enumerate(lotes):
+        client._update_progress(i / len(lotes) * 100, f"Importando lote {i + 1}/{len(lotes)}...")
+        with client.span(f"importar lote {i + 1}", filas=len(lote)):
+            errores = _enviar_lote_notas(client, course_id, cabecera, lote, mapeo, identificador)
+        if errores:
+            informe["errores_servidor"].extend(errores)
+            informe["rechazadas"].extend({"fila": None, "alumno": f[0], "motivo": "Lote rechazado por Moodle"} for f in lote)
+        else:
+            informe["importadas"] += len(lote)
+
+    for rechazo in informe["rechazadas"]:
+        client._log(f"Rechazada fila {rechazo['fila'] or '-'} ({rechazo['alumno']}): {rechazo['motivo']}", "error")
+    for error in informe["errores_servidor"]:
+        client._log(f"Moodle: {error}", "error")
+    try:
+        directorio = get_directorio_informes()
+        os.makedirs(directorio, exist_ok=True)
+        ruta_informe = os.path.join(directorio, f"importacion_notas_{time.strftime('%Y%m%d_%H%M%S')}.json")
+        with open(ruta_informe, 'w', encoding='utf-8') as f:
+            json.dump(informe, f, indent=2, ensure_ascii=False)
+        client._log(f"Informe de importación guardado en {ruta_informe}")
+    except Exception as e:
+        client._log(f"No se pudo guardar el informe de importación: {e}", "error")
+    client._update_progress(100, f"Importación completada: {informe['importadas']} alumnos importados, {len(informe['rechazadas'])} rechazados.")
+    return informe
+
+# --- EXPORTACIÓN DE NOTAS A ALMACÉN COLUMNAR ---
+
+# Sufijo con el que el exportador de Moodle marca las columnas de calificación: "CE1.1 (Real)"
+PATRON_COLUMNA_NOTA = re.compile(r"^(.*?)\s*\((Real|Percentage|Porcentaje|Letter|Letra)\)$")
+
+class AlmacenNotas:
+    """
+    Almacén columnar de las notas exportadas de un curso. En disco es un directorio con:
+      - meta.json: alumnos (clave y columnas de identidad) y columnas de nota (clave, cabecera)
+      - col_<n>.f64: valores de cada columna como dobles nativos (NaN = sin nota)
+    Las columnas se cargan con array('d').fromfile, sin analizar texto.
+    """
+
+    def __init__(self, directorio):
+        self.directorio = directorio
+        with open(os.path.join(directorio, "meta.json"), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.alumnos = [a["clave"] for a in self.meta["alumnos"]]
+        self.columnas = [c["clave"] for c in self.meta["columnas"]]
+        self._indice_alumno = {a: i for i, a in enumerate(self.alumnos)}
+        self._cache = {}
+
+    def columna(self, clave):
+        """Array de dobles (un valor por alumno, NaN si no tiene nota) de la columna indicada."""
+        if clave not in self._cache:
+            indice = self.columnas.index(clave)
+            valores = array.array('d')
+            with open(os.path.join(self.directorio, f"col_{indice}.f64"), 'rb') as f:
+                valores.fromfile(f, len(self.alumnos))
+            self._cache[clave] = valores
+        return self._cache[clave]
+
+    def fila(self, alumno):
+        """Notas de un alumno {columna: nota} (omitiendo las vacías)."""
+        i = self._indice_alumno[alumno]
+        return {c: self.columna(c)[i] for c in self.columnas if not math.isnan(self.columna(c)[i])}
+
+    def como_calificaciones(self):
+        """Formato {alumno: {columna: nota}} que aceptan MotorCalificaciones y las demás utilidades."""
+        return {a: self.fila(a) for a in self.alumnos}
+
+    @staticmethod
+    def escribir(directorio, alumnos, columnas, valores, origen=None):
+        """Escribe un almacén de forma atómica (directorio temporal + renombrado)."""
+        temporal = directorio.rstrip(os.sep) + ".tmp"
+        if os.path.isdir(temporal):
+            shutil.rmtree(temporal)
+        os.makedirs(temporal)
+        for i, columna in enumerate(valores):
+            with open(os.path.join(temporal, f"col_{i}.f64"), 'wb') as f:
+                columna.tofile(f)
+        with open(os.path.join(temporal, "meta.json"), 'w', encoding='utf-8') as f:
+            json.dump({"origen": origen or {}, "fecha": time.time(), "alumnos": alumnos, "columnas": columnas},
+                      f, ensure_ascii=False)
+        if os.path.isdir(directorio):
+            shutil.rmtree(directorio)
+        os.replace(temporal, directorio)
+        return directorio
+
+def _lineas_respuesta(r):
+    """Itera las líneas de texto de una respuesta en streaming."""
+    r.encoding = r.encoding or "utf-8"
+    for linea in r.iter_lines(decode_unicode=True):
+        if linea is not None:
+            yield linea.lstrip("\ufeff")
+
+def convertir_exportacion_columnar(lineas, data=None):
+    """
+    Analiza de forma incremental el CSV del exportador de Moodle (fila a fila) y lo convierte en
+    columnas de dobles. Las columnas de nota se identifican por el idnumber de datos_aules.json
+    cuando el nombre del item coincide; si no, por el nombre del item.
+    Devuelve (alumnos, columnas, valores).
+    """
+    idnumber_por_nombre = {}
+    for categoria_hija in (data or {}).get("categorias_hijas", []):
+        for elemento_info in categoria_hija.get("elementos", []):
+            nombre, _, idnumber, _ = _normalizar_elemento(elemento_info)
+            if idnumber:
+                idnumber_por_nombre[nombre] = idnumber
+
+    lector = csv.reader(lineas)
+    cabecera = next(lector, [])
+    indices_nota = []
+    columnas = []
+    for i, titulo in enumerate(cabecera):
+        m = PATRON_COLUMNA_NOTA.match(titulo.strip())
+        if m:
+            indices_nota.append(i)
+            columnas.append({"clave": idnumber_por_nombre.get(m.group(1), m.group(1)), "cabecera": titulo})
+    indices_identidad = [i for i in range(len(cabecera)) if i not in indices_nota]
+    # El alumno se identifica por el correo si existe; si no, por la primera columna
+    indice_clave = next((i for i in indices_identidad if "mail" in cabecera[i].lower() or "correo" in cabecera[i].lower()),
+                        indices_identidad[0] if indices_identidad else 0)
+
+    alumnos = []
+    valores = [array.array('d') for _ in indices_nota]
+    for fila in lector:
+        if not fila:
+            continue
+        alumnos.append({
+            "clave": fila[indice_clave] if indice_clave < len(fila) else "",
+            "identidad": {cabecera[i]: fila[i] for i in indices_identidad if i < len(fila)}
+        })
+        for columna, i in zip(valores, indices_nota):
+            texto = fila[i].strip().replace(",", ".") if i < len(fila) else ""
+            try:
+                columna.append(float(texto.rstrip("%").strip()))
+            except ValueError:
+                columna.append(math.nan)
+    return alumnos, columnas, valores
+
+def get_directorio_almacen_notas(course_id):
+    """Directorio del almacén columnar de notas de un curso (dentro de informes/notas)."""
+    return os.path.join(get_directorio_informes(), "notas", f"curso_{course_id}")
+
+@flujo_instrumentado("exportar_notas")
+def descargar_exportacion_notas(client, course_id, data=None, directorio=None):
+    """
+    Descarga en streaming la exportación de notas del curso (exportador de texto/CSV de Moodle),
+    la analiza fila a fila y la guarda como almacén columnar. Devuelve el directorio o None.
+    """
+    directorio = directorio or get_directorio_almacen_notas(course_id)
+    parametros = {
+        "id": course_id,
+        "sesskey": client.sesskey,
+        "export_feedback": 0,
+        "export_onlyactive": 1,
+        "displaytype": 1,
+        "decimalpoints": 2,
+        "separator": "comma",
+        "itemids": "-1"
+    }
+    client._log(f"Descargando exportación de notas del curso {course_id}...")
+    with client.span("descargar exportación", "paso"):
+        r = client.post("grade/export/txt/export.php", data=parametros, stream=True)
+        try:
+            if r.status_code != 200 or "html" in r.headers.get("Content-Type", ""):
+                client._log(f"Error al descargar la exportación de notas: HTTP {r.status_code}", "error")
+                return None
+            with client.span("convertir a columnas", "parse"):
+                alumnos, columnas, valores = convertir_exportacion_columnar(_lineas_respuesta(r), data)
+        finally:
+            r.close()
+    AlmacenNotas.escribir(directorio, alumnos, columnas, valores, {"course_id": course_id, "base_url": client.base_url})
+    client._log(f"Almacén de notas guardado en {directorio} ({len(alumnos)} alumnos x {len(columnas)} columnas).")
+    return directorio
+
+def cargar_almacenes_notas(directorio_base=None):
+    """Abre todos los almacenes de notas descargados ({course_id: AlmacenNotas}) para análisis entre cursos."""
+    directorio_base = directorio_base or os.path.join(get_directorio_informes(), "notas")
+    almacenes = {}
+    if os.path.isdir(directorio_base):
+        for nombre in sorted(os.listdir(directorio_base)):
+            ruta = os.path.join(directorio_base, nombre)
+            if nombre.startswith("curso_") and os.path.isfile(os.path.join(ruta, "meta.json")):
+                almacenes[nombre[len("curso_"):]] = AlmacenNotas(ruta)
+    return almacenes
+
+# --- PLANIFICACIÓN (dry-run) ---
+
+# Latencia media por operación (s) cuando no hay métricas registradas en informes/
+LATENCIAS_POR_DEFECTO = {"login": 0.8, "tree-fetch": 1.5, "create": 0.8, "modify": 0.6, "formula": 0.6, "delete": 0.6, "other": 0.6}
+
+# Peticiones que hace AulesClient.login con una sesión nueva (my/, formulario y envío)
+PETICIONES_LOGIN = 3
+
+def _normalizar_elemento(elemento_info):
+    """Devuelve (nombre, formula, idnumber, aggregationcoef) de un CE en formato simple o dict."""
+    if isinstance(elemento_info, dict):
+        return elemento_info["nombre"], elemento_info.get("formula"), elemento_info.get("idnumber", ""), elemento_info.get("aggregationcoef", 1.0)
+    return elemento_info, None, "", 1.0
+
+def _op(accion, tipo, nombre, peticiones, espera=0):
+    return {"accion": accion, "tipo": tipo, "nombre": nombre, "peticiones": peticiones, "espera": espera}
+
+def _ops_crear_categoria(nombre, espera_previa, formula=None):
+    """Operación equivalente a: crear categoría + obtener_id_categoria_completo + modificar (+ fórmula)."""
+    peticiones = {"create": 1, "tree-fetch": 1, "modify": 1}
+    if formula:
+        peticiones["formula"] = 1
+    return _op("crear", "category", nombre, peticiones, espera_previa + 2)
+
+def _ops_crear_item(nombre, formula=None):
+    """Operación equivalente a: crear item + esperar 1s + obtener_id_item_completo + modificar (+ fórmula)."""
+    peticiones = {"create": 1, "tree-fetch": 1, "modify": 1}
+    if formula:
+        peticiones["formula"] = 1
+    return _op("crear", "item", nombre, peticiones, 1)
+
+def planificar_operaciones(modo, categoria_padre, categorias_hijas, config_global=None, elementos_actuales=None):
+    """
+    Calcula, sin tocar Aules, las operaciones que harían insertar_categorias_y_items (modo 'crear')
+    o sincronizar_todo (modo 'sincronizar') y las peticiones HTTP de cada una.
+    elementos_actuales es una instantánea con el formato de obtener_elementos_curso (vacía si se omite).
+    """
+    config_global = config_global or {}
+    ce_as_category = config_global.get("ce_as_category", False)
+    elementos_actuales = elementos_actuales or []
+    operaciones = [_op("login", "sesion", "", {"login": PETICIONES_LOGIN})]
+
+    if modo == "crear":
+        operaciones.append(_ops_crear_categoria(categoria_padre, 0))
+        for categoria_hija in categorias_hijas:
+            operaciones.append(_ops_crear_categoria(categoria_hija["nombre"], 0))
+            for elemento_info in categoria_hija["elementos"]:
+                e_nombre, e_formula, _, _ = _normalizar_elemento(elemento_info)
+                if ce_as_category:
+                    operaciones.append(_ops_crear_categoria(e_nombre, 1, e_formula))
+                else:
+                    operaciones.append(_ops_crear_item(e_nombre, e_formula))
+    elif modo == "sincronizar":
+        operaciones.append(_op("leer", "curso", "", {"tree-fetch": 1}))
+        padre = encontrar_categoria_por_nombre(elementos_actuales, categoria_padre)
+        if padre:
+            operaciones.append(_op("modificar", "category", categoria_padre, {"modify": 1}))
+        else:
+            operaciones.append(_op("crear", "category", categoria_padre, {"create": 1, "tree-fetch": 1}, 2 + 2))
+        for cat_json in categorias_hijas:
+            nombre_hija = cat_json["nombre"]
+            if encontrar_categoria_por_nombre(elementos_actuales, nombre_hija):
+                operaciones.append(_op("modificar", "category", nombre_hija, {"modify": 1}))
+            else:
+                operaciones.append(_ops_crear_categoria(nombre_hija, 2))
+            for elemento_json in cat_json.get("elementos", []):
+                e_nombre, e_formula, _, _ = _normalizar_elemento(elemento_json)
+                item_existente = any(e["tipo"] == "item" and e["nombre"] == e_nombre for e in elementos_actuales)
+                cat_existente = encontrar_categoria_por_nombre(elementos_actuales, e_nombre)
+                existe = cat_existente if ce_as_category else item_existente
+                if existe:
+                    peticiones = {"modify": 1}
+                    if e_formula:
+                        peticiones["formula"] = 1
+                    operaciones.append(_op("modificar", "category" if ce_as_category else "item", e_nombre, peticiones))
+                elif ce_as_category:
+                    operaciones.append(_ops_crear_categoria(e_nombre, 1, e_formula))
+                else:
+                    operaciones.append(_ops_crear_item(e_nombre, e_formula))
+    else:
+        raise ValueError(f"Modo de planificación desconocido: {modo}")
+
+    return operaciones
+
+def cargar_latencias_registradas(directorio=None):
+    """Latencia media por operación a partir de los metricas_*.json de ejecuciones anteriores."""
+    directorio = directorio or get_directorio_informes()
+    totales = {}
+    if os.path.isdir(directorio):
+        for nombre in os.listdir(directorio):
+            if not (nombre.startswith("metricas_") and nombre.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(directorio, nombre), 'r', encoding='utf-8') as f:
+                    datos = json.load(f)
+            except Exception:
+                continue
+            for operacion, o in datos.get("operaciones", {}).items():
+                tiempo, cuenta = totales.get(operacion, (0.0, 0))
+                totales[operacion] = (tiempo + o.get("tiempo_total", 0.0), cuenta + o.get("peticiones", 0))
+    latencias = dict(LATENCIAS_POR_DEFECTO)
+    for operacion, (tiempo, cuenta) in totales.items():
+        if cuenta:
+            latencias[operacion] = tiempo / cuenta
+    return latencias
+
+def avisos_configuracion(categoria_padre, categorias_hijas):
+    """Detecta nombres que harían fallar o confundir las búsquedas por nombre antes de ejecutar nada."""
+    avisos = []
+    nombres = [categoria_padre] + [c["nombre"] for c in categorias_hijas]
+    for categoria_hija in categorias_hijas:
+        nombres.extend(_normalizar_elemento(e)[0] for e in categoria_hija.get("elementos", []))
+    vistos = set()
+    for nombre in nombres:
+        if nombre in vistos:
+            avisos.append(f"Nombre duplicado: '{nombre}'")
+        vistos.add(nombre)
+    unicos = sorted(vistos, key=len)
+    for i, corto in enumerate(unicos):
+        for largo in unicos[i + 1:]:
+            if corto and corto.lower() in largo.lower():
+                avisos.append(f"'{corto}' está contenido en '{largo}': la búsqueda de IDs por nombre puede confundirlos")
+    return avisos
+
+def resumir_plan(operaciones, latencias=None):
+    """Agrega un plan: peticiones por operación, esperas y tiempo estimado."""
+    latencias = latencias or cargar_latencias_registradas()
+    peticiones = {}
+    espera = 0
+    for op in operaciones:
+        espera += op["espera"]
+        for operacion, cuenta in op["peticiones"].items():
+            peticiones[operacion] = peticiones.get(operacion, 0) + cuenta
+    tiempo_red = sum(cuenta * latencias.get(op, LATENCIAS_POR_DEFECTO["other"]) for op, cuenta in peticiones.items())
+    return {
+        "operaciones": len(operaciones),
+        "peticiones": peticiones,
+        "total_peticiones": sum(peticiones.values()),
+        "espera": espera,
+        "tiempo_red_estimado": round(tiempo_red, 2),
+        "tiempo_total_estimado": round(tiempo_red + espera, 2)
+    }
+
+def formatear_plan(operaciones, resumen, avisos=()):
+    """Texto legible del plan para la consola."""
+    lineas = [f"{'Acción':<10} {'Tipo':<9} {'Pet.':>4} {'Espera':>6}  Nombre", "-" * 70]
+    for op in operaciones:
+        lineas.append(f"{op['accion']:<10} {op['tipo']:<9} {sum(op['peticiones'].values()):>4} {op['espera']:>5}s  {op['nombre']}")
+    lineas.append("-" * 70)
+    lineas.append(f"Operaciones: {resumen['operaciones']} | Peticiones HTTP: {resumen['total_peticiones']} "
+                  f"({', '.join(f'{k}={v}' for k, v in sorted(resumen['peticiones'].items()))})")
+    minutos, segundos = divmod(int(resumen["tiempo_total_estimado"]), 60)
+    lineas.append(f"Esperas: {resumen['espera']}s | Red estimada: {resumen['tiempo_red_estimado']}s | "
+                  f"Tiempo total estimado: {minutos}m {segundos:02d}s")
+    for aviso in avisos:
+        lineas.append(f"AVISO: {aviso}")
+    return "\n".join(lineas)
+
+def guardar_snapshot_curso(client, course_id, ruta):
+    """Guarda la estructura actual del curso (obtener_elementos_curso) para planificar sin conexión."""
+    elementos = obtener_estructura_curso(client, course_id, forzar=True)
+    with open(ruta, 'w', encoding='utf-8') as f:
+        json.dump({"course_id": course_id, "fecha": time.time(), "elementos": elementos}, f, indent=2, ensure_ascii=False)
+    return len(elementos)
+
+def cargar_snapshot_curso(ruta):
+    """Lee una instantánea guardada con guardar_snapshot_curso (acepta también una lista de elementos)."""
+    with open(ruta, 'r', encoding='utf-8') as f:
+        datos = json.load(f)
+    return datos["elementos"] if isinstance(datos, dict) else datos
+
+def planificar_desde_json(data, modo, ruta_snapshot=None):
+    """Plan completo (operaciones, resumen, avisos) de datos_aules.json sin conectarse a Aules."""
+    elementos = cargar_snapshot_curso(ruta_snapshot) if ruta_snapshot else []
+    operaciones = planificar_operaciones(modo, data["categoria_padre"], data["categorias_hijas"],
+                                         data.get("configuracion_global", {}), elementos)
+    avisos = avisos_configuracion(data["categoria_padre"], data["categorias_hijas"])
+    avisos += avisos_formulas(analizar_formulas(data["categorias_hijas"]))
+    return operaciones, resumir_plan(operaciones), avisos
+
+# --- MOTOR LOCAL DE CALIFICACIONES (simulación "what-if") ---
+
+# Códigos de agregación de Moodle soportados por el motor local
+AGREGACION_MEDIA = 0
+AGREGACION_MEDIANA = 2
+AGREGACION_MINIMA = 4
+AGREGACION_MAXIMA = 6
+AGREGACION_MODA = 8
+AGREGACION_MEDIA_PONDERADA = 10
+AGREGACION_MEDIA_PONDERADA_SIMPLE = 11
+AGREGACION_MEDIA_CREDITOS_EXTRA = 12
+AGREGACION_NATURAL = 13
+
+def _columna_binaria(a, b, fn):
+    """Aplica fn elemento a elemento a dos columnas (o escalares); None se propaga."""
+    if not isinstance(a, list) and not isinstance(b, list):
+        # Dos constantes (p. ej. (2+3) o -1): se resuelven a un escalar
+        return None if a is None or b is None else fn(a, b)
+    n = len(a) if isinstance(a, list) else len(b)
+    a = a if isinstance(a, list) else [a] * n
+    b = b if isinstance(b, list) else [b] * n
+    return [None if x is None or y is None else fn(x, y) for x, y in zip(a, b)]
+
+def _division(x, y):
+    return x / y if y else None
+
+def _funcion_formula(nombre, columnas, n):
+    """Funciones de cálculo de Moodle aplicadas por columnas: average, max, min, mod, pi, power, round, sum."""
+    if nombre == "pi":
+        return [math.pi] * n
+    columnas = [c if isinstance(c, list) else [c] * n for c in columnas]
+    filas = list(zip(*columnas))
+    def validos(fila):
+        return [v for v in fila if v is not None]
+    if nombre == "sum":
+        return [sum(validos(f)) for f in filas]
+    if nombre == "average":
+        return [sum(validos(f)) / len(validos(f)) if validos(f) else None for f in filas]
+    if nombre == "max":
+        return [max(validos(f)) if validos(f) else None for f in filas]
+    if nombre == "min":
+        return [min(validos(f)) if validos(f) else None for f in filas]
+    if nombre == "mod":
+        return [None if None in f or not f[1] else math.fmod(f[0], f[1]) for f in filas]
+    if nombre == "power":
+        return [None if None in f else f[0] ** f[1] for f in filas]
+    if nombre == "round":
+        return [None if f[0] is None else round(f[0], int(f[1]) if len(f) > 1 and f[1] is not None else 0) for f in filas]
+    raise ValueError(f"Función no soportada en fórmulas: {nombre}")
+
+def compilar_formula(formula):
+    """
+    Convierte una fórmula de Moodle (=[[ID1]]*0.5+round([[ID2]], 1)) en un árbol evaluable.
+    Devuelve (arbol, variables) donde variables mapea el nombre interno al idnumber.
+    """
+    variables = {}
+    def sustituir(m):
+        nombre = f"_v{len(variables)}"
+        variables[nombre] = m.group(1)
+        return nombre
+    expresion = PATRON_REFERENCIA.sub(sustituir, formula.strip().lstrip("=")).replace("^", "**")
+    return ast.parse(expresion, mode="eval").body, variables
+
+def evaluar_formula(arbol, valores, n):
+    """Evalúa por columnas (una posición por alumno) el árbol de compilar_formula."""
+    if isinstance(arbol, ast.Constant) and isinstance(arbol.value, (int, float)):
+        return float(arbol.value)
+    if isinstance(arbol, ast.Name):
+        return valores[arbol.id]
+    if isinstance(arbol, ast.UnaryOp) and isinstance(arbol.op, (ast.USub, ast.UAdd)):
+        operando = evaluar_formula(arbol.operand, valores, n)
+        signo = -1 if isinstance(arbol.op, ast.USub) else 1
+        return _columna_binaria(operando, signo, lambda x, y: x * y)
+    if isinstance(arbol, ast.BinOp):
+        operaciones = {
+            ast.Add: lambda x, y: x + y,
+            ast.Sub: lambda x, y: x - y,
+            ast.Mult: lambda x, y: x * y,
+            ast.Div: _division,
+            ast.Pow: lambda x, y: x ** y,
+        }
+        if type(arbol.op) in operaciones:
+            return _columna_binaria(evaluar_formula(arbol.left, valores, n), evaluar_formula(arbol.right, valores, n),
+                                    operaciones[type(arbol.op)])
+    if isinstance(arbol, ast.Call) and isinstance(arbol.func, ast.Name) and not arbol.keywords:
+        return _funcion_formula(arbol.func.id.lower(), [evaluar_formula(a, valores, n) for a in arbol.args], n)
+    raise ValueError("Expresión no soportada en la fórmula")
+
+def _agregar_fila(valores, pesos, maximos, aggregation):
+    """Agrega los valores normalizados (0..1) de los hijos de una categoría para un alumno."""
+    if aggregation == AGREGACION_MEDIA_PONDERADA:
+        total_peso = sum(p for v, p in zip(valores, pesos) if p > 0)
+        if not total_peso:
+            return None
+        return sum(v * p for v, p in zip(valores, pesos) if p > 0) / total_peso
+    if aggregation == AGREGACION_MEDIA_PONDERADA_SIMPLE:
+        total_peso = sum(maximos)
+        return sum(v * m for v, m in zip(valores, maximos)) / total_peso if total_peso else None
+    if aggregation == AGREGACION_MEDIA_CREDITOS_EXTRA:
+        # Como grade_category::aggregate_values: coef 0 = elemento normal, coef > 0 = crédito extra
+        # que suma coef * valor; sin elementos normales la nota es la suma de los créditos extra
+        normales, suma = 0, 0.0
+        for v, p in zip(valores, pesos):
+            if p == 0:
+                normales += 1
+                suma += v
+            elif p > 0:
+                suma += p * v
+        return min(1.0, max(0.0, suma / normales if normales else suma))
+    if aggregation == AGREGACION_NATURAL:
+        total_maximo = sum(maximos)
+        return min(1.0, sum(v * m for v, m in zip(valores, maximos)) / total_maximo) if total_maximo else None
+    if aggregation == AGREGACION_MEDIANA:
+        ordenados = sorted(valores)
+        mitad = len(ordenados) // 2
+        return ordenados[mitad] if len(ordenados) % 2 else (ordenados[mitad - 1] + ordenados[mitad]) / 2
+    if aggregation == AGREGACION_MINIMA:
+        return min(valores)
+    if aggregation == AGREGACION_MAXIMA:
+        return max(valores)
+    if aggregation == AGREGACION_MODA:
+        frecuencias = {}
+        for v in valores:
+            frecuencias[round(v, 5)] = frecuencias.get(round(v, 5), 0) + 1
+        mas_frecuente = max(frecuencias.values())
+        # Moodle devuelve el valor más alto entre los más frecuentes
+        return max(v for v, f in frecuencias.items() if f == mas_frecuente)
+    return sum(valores) / len(valores)
+
+class MotorCalificaciones:
+    """
+    Calcula localmente las notas finales de una clase a partir de la estructura de datos_aules.json,
+    imitando la agregación de Moodle (códigos 0, 2, 4, 6, 8, 10, 11, 12, 13), aggregationcoef,
+    aggregateonlygraded y las fórmulas [[idnumber]]. Cada nodo se calcula de una vez para todos los
+    alumnos (una columna por nodo), por lo que una simulación de 30 alumnos x 100 CE tarda milisegundos.
+    """
+
+    def __init__(self, data):
+        config = data.get("configuracion_global", {})
+        self.aggregation = int(config.get("aggregation", AGREGACION_MEDIA))
+        self.solo_calificados = bool(config.get("aggregateonlygraded", True))
+        self.grademax = float(config.get("grademax", 100))
+        self.grademin = 0.0
+        self.categoria_padre = data["categoria_padre"]
+        self.categorias_hijas = data["categorias_hijas"]
+        analisis = analizar_formulas(self.categorias_hijas)
+        self.orden_formulas = analisis["orden"]
+        self.formulas = {}
+        for categoria_hija in self.categorias_hijas:
+            for elemento_info in categoria_hija.get("elementos", []):
+                nombre, formula, _, _ = _normalizar_elemento(elemento_info)
+                if formula and nombre in self.orden_formulas:
+                    self.formulas[nombre] = compilar_formula(formula)
+
+    @staticmethod
+    def clave(elemento_info):
+        """Columna de calificaciones de un CE: su idnumber o, si no tiene, su nombre."""
+        nombre, _, idnumber, _ = _normalizar_elemento(elemento_info)
+        return idnumber or nombre
+
+    def _agregar(self, hijos, n):
+        """
+        hijos: lista de (columna_bruta, aggregationcoef). Devuelve la columna bruta de la categoría.
+        Con la media con créditos extra (12), aggregationcoef 0 es un hijo normal y > 0 un crédito extra, como en Moodle.
+        """
+        rango = self.grademax - self.grademin
+        resultado = []
+        for alumno in range(n):
+            valores, pesos, maximos = [], [], []
+            for columna, peso in hijos:
+                v = columna[alumno]
+                if v is None:
+                    if self.solo_calificados:
+                        continue
+                    v = self.grademin
+                valores.append(min(1.0, max(0.0, (v - self.grademin) / rango)))
+                pesos.append(peso)
+                maximos.append(rango)
+            normalizado = _agregar_fila(valores, pesos, maximos, self.aggregation) if valores else None
+            resultado.append(None if normalizado is None else self.grademin + normalizado * rango)
+        return resultado
+
+    def validar_pesos(self, pesos):
+        """Problemas de un {nombre: aggregationcoef} para calcular(): nombres de RA/CE que no existen o pesos no numéricos."""
+        if not isinstance(pesos, dict):
+            return ["debe ser un objeto {nombre: peso}"]
+        nombres = {categoria_hija["nombre"] for categoria_hija in self.categorias_hijas}
+        nombres |= {_normalizar_elemento(e)[0] for categoria_hija in self.categorias_hijas for e in categoria_hija.get("elementos", [])}
+        errores = [f"'{nombre}' no es ninguna RA ni CE de '{self.categoria_padre}'" for nombre in pesos if nombre not in nombres]
+        errores += [f"el peso de '{nombre}' debe ser un número" for nombre, peso in pesos.items() if not _es_numero(peso)]
+        return errores
+
+    def calcular(self, calificaciones, pesos=None):
+        """
+        calificaciones: {alumno: {idnumber_o_nombre: nota}} (también referencias externas como 1AVA).
+        pesos: {nombre: aggregationcoef} opcional para simular cambios de ponderación (lanza
+        ValueError si validar_pesos encuentra problemas).
+        Devuelve {"alumnos": [...], "nodos": {nombre: columna}, "total": columna}.
+        """
+        pesos = pesos or {}
+        errores = self.validar_pesos(pesos)
+        if errores:
+            raise ValueError("; ".join(errores))
+        alumnos = list(calificaciones)
+        n = len(alumnos)
+        columnas = {}
+        todas_las_claves = {k for notas in calificaciones.values() for k in notas}
+        for clave in todas_las_claves:
+            columnas[clave] = [calificaciones[a].get(clave) for a in alumnos]
+
+        # 1. Elementos calculados, en orden de dependencias
+        idnumber_por_nombre = {}
+        for categoria_hija in self.categorias_hijas:
+            for elemento_info in categoria_hija.get("elementos", []):
+                nombre, _, idnumber, _ = _normalizar_elemento(elemento_info)
+                idnumber_por_nombre[nombre] = idnumber or nombre
+        for nombre in self.orden_formulas:
+            arbol, variables = self.formulas[nombre]
+            valores = {}
+            for interno, referencia in variables.items():
+                columna = columnas.get(referencia, [None] * n)
+                valores[interno] = [0.0 if v is None else v for v in columna]
+            resultado = evaluar_formula(arbol, valores, n)
+            if not isinstance(resultado, list):
+                resultado = [resultado] * n
+            columnas[idnumber_por_nombre[nombre]] = [
+                None if v is None else min(self.grademax, max(self.grademin, v)) for v in resultado
+            ]
+
+        # 2. Categorías RA y categoría padre
+        nodos = {}
+        hijos_padre = []
+        for categoria_hija in self.categorias_hijas:
+            hijos = []
+            for elemento_info in categoria_hija.get("elementos", []):
+                nombre, _, _, coef = _normalizar_elemento(elemento_info)
+                columna = columnas.get(self.clave(elemento_info), [None] * n)
+                coef = float(pesos.get(nombre, coef))
+                nodos[nombre] = columna
+                hijos.append((columna, coef))
+            columna_hija = self._agregar(hijos, n)
+            nodos[categoria_hija["nombre"]] = columna_hija
+            coef_hija = float(pesos.get(categoria_hija["nombre"], categoria_hija.get("aggregationcoef", 0.0)))
+            hijos_padre.append((columna_hija, coef_hija))
+        total = self._agregar(hijos_padre, n)
+        nodos[self.categoria_padre] = total
+        return {"alumnos": alumnos, "nodos": nodos, "total": total}
+
+    def simular(self, calificaciones, pesos):
+        """Compara las notas finales actuales con las obtenidas aplicando los pesos indicados."""
+        antes = self.calcular(calificaciones)
+        despues = self.calcular(calificaciones, pesos)
+        return [
+            {"alumno": a, "antes": x, "despues": y,
+             "diferencia": None if x is None or y is None else round(y - x, 4)}
+            for a, x, y in zip(antes["alumnos"], antes["total"], despues["total"])
+        ]
+
+def cargar_calificaciones_csv(ruta, columna_alumno=None):
+    """
+    Lee un CSV de alumnos x idnumber (primera columna: alumno; resto: notas por idnumber o nombre de CE).
+    Devuelve {alumno: {columna: nota}} omitiendo celdas vacías o no numéricas.
+    """
+    with open(ruta, 'r', encoding='utf-8-sig', newline='') as f:
+        muestra = f.read(4096)
+        f.seek(0)
+        try:
+            dialecto = csv.Sniffer().sniff(muestra, delimiters=",;\t")
+        except csv.Error:
+            dialecto = csv.excel
+        lector = csv.DictReader(f, dialect=dialecto)
+        columna_alumno = columna_alumno or lector.fieldnames[0]
+        calificaciones = {}
+        for fila in lector:
+            notas = {}
+            for columna, valor in fila.items():
+                if columna == columna_alumno or columna is None or valor is None or not valor.strip():
+                    continue
+                try:
+                    notas[columna] = float(valor.replace(",", "."))
+                except ValueError:
+                    continue
+            calificaciones[fila[columna_alumno]] = notas
+    return calificaciones
+
+# --- TRABAJOS EN SEGUNDO PLANO ---
+
+class Trabajo:
+    """Una acción lanzada sobre un curso, con su estado, duración y peticiones realizadas."""
+
+    EN_COLA, EN_CURSO, COMPLETADO, CANCELADO, ERROR = "en cola", "en curso", "completado", "cancelado", "error"
+
+    def __init__(self, nombre, curso, client, funcion, args):
+        self.nombre = nombre
+        self.curso = curso
+        self.client = client
+        self.funcion = funcion
+        self.args = args
+        self.estado = self.EN_COLA
+        self.cancelacion = threading.Event()
+        self.inicio = None
+        self.fin = None
+        self.peticiones = 0
+        self.peticiones_inicio = 0
+        self.error = None
+
+    @property
+    def activo(self):
+        return self.estado in (self.EN_COLA, self.EN_CURSO)
+
+    @property
+    def duracion(self):
+        if self.inicio is None:
+            return 0.0
+        return (self.fin or time.time()) - self.inicio
+
+    def peticiones_realizadas(self):
+        """Peticiones del trabajo: las que lleva si está en curso (métricas de su cliente) o las que hizo."""
+        if self.inicio is not None and self.fin is None:
+            return self.client.metricas.peticiones_totales - self.peticiones_inicio
+        return self.peticiones
+
+    def describir(self):
+        """Línea de estado: acción, curso, tiempo transcurrido y peticiones por segundo."""
+        texto = f"[{self.estado}] {self.nombre} (curso {self.curso})"
+        if self.inicio is not None:
+            duracion, peticiones = self.duracion, self.peticiones_realizadas()
+            ritmo = peticiones / duracion if duracion > 0 else 0.0
+            texto += f" - {duracion:.1f}s, {peticiones} peticiones ({ritmo:.1f}/s)"
+        if self.error:
+            texto += f" - {self.error}"
+        return texto
+
+class GestorTrabajos:
+    """
+    Ejecuta las acciones en segundo plano con una cola por curso: los trabajos de un mismo curso
+    se hacen de uno en uno y en orden (nunca dos flujos a la vez sobre el mismo curso). Un trabajo
+    idéntico (misma acción y curso) que ya está en cola o en curso no se vuelve a encolar.
+    """
+
+    MAX_HISTORIAL = 50
+
+    def __init__(self, al_cambiar=None):
+        self.al_cambiar = al_cambiar
+        self.historial = []
+        self._colas = {}
+        self._cerrojo = threading.Lock()
+
+    def _notificar(self, trabajo):
+        if self.al_cambiar:
+            self.al_cambiar(trabajo)
+
+    def encolar(self, nombre, curso, client, funcion, *args):
+        """Añade un trabajo a la cola de su curso. Devuelve None si es un duplicado."""
+        with self._cerrojo:
+            if any(t.activo and t.nombre == nombre and t.curso == curso for t in self.historial):
+                return None
+            trabajo = Trabajo(nombre, curso, client, funcion, args)
+            self.historial.append(trabajo)
+            while len(self.historial) > self.MAX_HISTORIAL and not self.historial[0].activo:
+                self.historial.pop(0)
+            cola = self._colas.get(curso)
+            arrancar = cola is None
+            if arrancar:
+                cola = self._colas[curso] = []
+            cola.append(trabajo)
+        self._notificar(trabajo)
+        if arrancar:
+            threading.Thread(target=self._procesar_cola, args=(curso,), daemon=True).start()
+        return trabajo
+
+    def _procesar_cola(self, curso):
+        while True:
+            with self._cerrojo:
+                cola = self._colas[curso]
+                if not cola:
+                    del self._colas[curso]
+                    return
+                trabajo = cola.pop(0)
+            if trabajo.estado == Trabajo.EN_COLA:
+                self._ejecutar(trabajo)
+
+    def _ejecutar(self, trabajo):
+        client = trabajo.client
+        # Las métricas del cliente cuentan también las peticiones de sus hilos auxiliares
+        trabajo.peticiones_inicio = client.metricas.peticiones_totales
+        trabajo.estado, trabajo.inicio = Trabajo.EN_CURSO, time.time()
+        self._notificar(trabajo)
+        client.asignar_cancelacion(trabajo.cancelacion)
+        try:
+            trabajo.funcion(client, *trabajo.args)
+            trabajo.estado = Trabajo.CANCELADO if trabajo.cancelacion.is_set() else Trabajo.COMPLETADO
+        except OperacionCancelada:
+            trabajo.estado = Trabajo.CANCELADO
+        except Exception as e:
+            trabajo.estado, trabajo.error = Trabajo.ERROR, str(e)
+        finally:
+            client.asignar_cancelacion(None)
+            trabajo.peticiones = client.metricas.peticiones_totales - trabajo.peticiones_inicio
+            trabajo.fin = time.time()
+            self._notificar(trabajo)
+
+    def cancelar(self, trabajo):
+        """Pide detener un trabajo: si aún está en cola no llega a ejecutarse; si está en curso,
+        se detiene en la siguiente comprobación entre operaciones."""
+        trabajo.cancelacion.set()
+        with self._cerrojo:
+            if trabajo.estado == Trabajo.EN_COLA:
+                trabajo.estado = Trabajo.CANCELADO
+        self._notificar(trabajo)
+
+    def cancelar_todos(self):
+        for trabajo in list(self.historial):
+            if trabajo.activo:
+                self.cancelar(trabajo)
+
+    def activos(self):
+        return [t for t in self.historial if t.activo]
+
+# --- EJECUCIÓN MULTICURSO ---
+
+# Acciones que se pueden lanzar sobre cada sección de un archivo multicurso
+ACCIONES_MULTICURSO = ("crear", "sincronizar", "sincronizar_cambios", "actualizar", "eliminar")
+
+def _argumentos_accion(accion, config):
+    """Función y argumentos (sin el cliente) de una acción sobre la configuración de un curso."""
+    data = config.como_dict()
+    config_global = data.get("configuracion_global", {})
+    if accion == "crear":
+        return insertar_categorias_y_items, (config.course_id, data["categoria_padre"], data["categorias_hijas"], config_global)
+    if accion == "sincronizar":
+        return sincronizar_todo, (config.course_id, data["categoria_padre"], data["categorias_hijas"], config_global)
+    if accion == "sincronizar_cambios":
+        return sincronizar_incremental, (config.course_id, data)
+    if accion == "actualizar":
+        return actualizar_calculos, (config.course_id, data["categoria_padre"], data["categorias_hijas"], config_global)
+    return eliminar_estructura, (config.course_id, data["categoria_padre"])
+
+def ejecutar_multicurso(ruta, accion, traza=None, log_callback=None):
+    """
+    Aplica una acción a cada curso/módulo de un archivo multicurso, leyendo y ejecutando
+    las secciones de una en una. Reutiliza la sesión entre cursos del mismo Aules y usuario.
+    Devuelve {course_id: True/False}.
+    """
+    log = log_callback or (lambda mensaje, nivel="info": print(f"[{nivel.upper()}] {mensaje}"))
+    clientes, resultados = {}, {}
+    for config in iterar_configuraciones(ruta):
+        for aviso in config.avisos:
+            log(f"Aviso (curso {config.course_id}): {aviso}")
+        clave = (config.base_url, config.username)
+        if clave not in clientes:
+            client = AulesClient(config.base_url, log_callback=log_callback, traza=traza)
+            clientes[clave] = client if client.login(config.username, config.password) else None
+        client = clientes[clave]
+        if client is None:
+            resultados[config.course_id] = False
+            continue
+        client._log(f"=== Curso {config.course_id}: {accion} '{config.categoria_padre}' ===")
+        funcion, argumentos = _argumentos_accion(accion, config)
+        try:
+            funcion(client, *argumentos)
+            resultados[config.course_id] = True
+        except Exception as e:
+            client._log(f"Error en el curso {config.course_id}: {e}", "error")
+            resultados[config.course_id] = False
+    return resultados
+
+# --- EJECUCIÓN DESATENDIDA (cron / scripts) ---
+
+# Modos de --mode y la acción equivalente de _argumentos_accion
+MODOS_DESATENDIDOS = {"create": "crear", "sync": "sincronizar", "sync-changed": "sincronizar_cambios",
+                      "update": "actualizar", "delete": "eliminar"}
+
+# Códigos de salida del modo desatendido
+SALIDA_OK = 0
+SALIDA_FALLOS = 1          # algún curso terminó con errores
+SALIDA_CONFIGURACION = 2   # argumentos o archivo de configuración no válidos
+SALIDA_LOGIN = 3           # ningún curso pudo iniciar sesión
+SALIDA_CANCELADA = 130     # interrumpido con Ctrl+C / SIGINT
+
+def es_interactivo(args=None):
+    """True si se puede preguntar al usuario: hay terminal y no se ha pedido --no-interactivo."""
+    if getattr(args, "no_interactivo", False):
+        return False
+    try:
+        return sys.stdin.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+def configuraciones_desatendidas(ruta, cursos=()):
+    """
+    Configuraciones a procesar, validadas todas antes de empezar. Si el archivo describe un solo
+    curso, --curso lo aplica a cada ID indicado; si es multicurso, filtra sus secciones.
+    """
+    configs = list(iterar_configuraciones(ruta))
+    if not cursos:
+        return configs
+    if len(configs) == 1:
+        return [configs[0]._replace(course_id=curso) for curso in cursos]
+    seleccion = [c for c in configs if c.course_id in cursos]
+    faltan = sorted(set(cursos) - {c.course_id for c in seleccion})
+    if faltan:
+        raise ErrorConfiguracion([f"el curso {curso} no aparece en {ruta}" for curso in faltan])
+    return seleccion
+
+def _clave_reanudacion(config):
+    return f"{config.course_id}:{config.categoria_padre}"
+
+def get_ruta_reanudacion(ruta, modo):
+    """Archivo con los cursos ya terminados de una ejecución desatendida (para --reanudar)."""
+    huella = hashlib.sha1(os.path.abspath(ruta).encode("utf-8")).hexdigest()[:10]
+    return os.path.join(get_directorio_informes(), f"reanudar_{modo}_{huella}.json")
+
+def _simular_desatendido(accion, config, elementos):
+    """Resultado de --dry-run: lo que haría la acción sobre la estructura actual, sin escribir nada."""
+    data = config.como_dict()
+    config_global = data.get("configuracion_global", {})
+    if accion in ("crear", "sincronizar"):
+        operaciones = planificar_operaciones(accion, data["categoria_padre"], data["categorias_hijas"], config_global, elementos)
+        return {"resumen": resumir_plan(operaciones),
+                "avisos": avisos_configuracion(data["categoria_padre"], data["categorias_hijas"])}
+    padre = encontrar_categoria_por_nombre(elementos, data["categoria_padre"])
+    if not padre:
+        raise ValueError(f"No se encontró la categoría '{data['categoria_padre']}'")
+    relacionados = encontrar_elementos_por_categoria(elementos, padre["id"])
+    if accion == "eliminar":
+        return {"eliminaria": len({(e["tipo"], e["id"]) for e in relacionados + [padre]})}
+    comparacion = comparar_estructura(elementos, data["categoria_padre"], data["categorias_hijas"], config_global)
+    estados = [estado for estado, _ in comparacion["estados"].values()]
+    return {"actualizaria": len(relacionados), "difieren": estados.count("difiere"),
+            "sobran": estados.count("sobra"), "faltan": len(comparacion["faltan"])}
+
+def ejecutar_curso_desatendido(config, modo, dry_run=False, traza=None, log_callback=None, cancelacion=None):
+    """
+    Ejecuta un modo de --mode sobre un curso con su propio cliente y sesión.
+    Devuelve un diccionario serializable con el estado (ok, error, login, cancelado), la duración,
+    las peticiones HTTP y los errores registrados durante el flujo.
+    """
+    accion = MODOS_DESATENDIDOS[modo]
+    resultado = {"course_id": config.course_id, "categoria_padre": config.categoria_padre,
+                 "estado": "ok", "peticiones": 0, "errores": []}
+
+    def registrar(mensaje, nivel="info"):
+        if nivel == "error":
+            resultado["errores"].append(mensaje)
+        if log_callback:
+            log_callback(f"[curso {config.course_id}] {mensaje}", nivel)
+
+    inicio = time.perf_counter()
+    client = AulesClient(config.base_url, log_callback=registrar, traza=traza)
+    client.asignar_cancelacion(cancelacion)
+    try:
+        if dry_run and accion == "crear":
+            resultado["simulacion"] = _simular_desatendido(accion, config, [])
+        elif dry_run and accion == "sincronizar_cambios":
+            # Solo compara con la huella guardada en local: no hace falta conectar
+            anterior = leer_huella_aplicada(client, config.course_id, config.categoria_padre)
+            cambios = diferenciar_arboles(anterior, config.como_dict())
+            resultado["simulacion"] = {"cambios": resumir_cambios(cambios) if anterior else "sin huella: sincronización completa"}
+        elif not client.login(config.username, config.password):
+            resultado["estado"] = "login"
+        elif dry_run:
+            elementos = obtener_estructura_curso(client, config.course_id) or []
+            resultado["simulacion"] = _simular_desatendido(accion, config, elementos)
+        else:
+            funcion, argumentos = _argumentos_accion(accion, config)
+            if accion == "eliminar":
+                funcion(client, *argumentos, confirmar=False)
+            else:
+                funcion(client, *argumentos)
+    except OperacionCancelada:
+        resultado["estado"] = "cancelado"
+    except Exception as e:
+        registrar(f"{type(e).__name__}: {e}", "error")
+    if resultado["estado"] == "ok" and resultado["errores"]:
+        resultado["estado"] = "error"
+    resultado["peticiones"] = client.peticiones_hilo()
+    resultado["duracion"] = round(time.perf_counter() - inicio, 2)
+    return resultado
+
+def codigo_salida_desatendida(resultados):
+    """Código de salida del proceso a partir de los resultados por curso."""
+    estados = [r["estado"] for r in resultados if r["estado"] != "omitido"]
+    if "cancelado" in estados:
+        return SALIDA_CANCELADA
+    if estados and all(estado == "login" for estado in estados):
+        return SALIDA_LOGIN
+    if any(estado != "ok" for estado in estados):
+        return SALIDA_FALLOS
+    return SALIDA_OK
+
+def ejecutar_desatendido(ruta, modo, cursos=(), concurrencia=1, dry_run=False, reanudar=False,
+                         traza=None, log_callback=None):
+    """
+    Aplica un modo a todos los cursos de 'ruta' sin preguntar nada, con hasta 'concurrencia'
+    cursos en paralelo (cada uno con su cliente). Sin dry_run, los cursos terminados se anotan
+    en get_ruta_reanudacion para que --reanudar continúe una ejecución interrumpida.
+    Devuelve (código de salida, resultado serializable). Lanza ErrorConfiguracion.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    configs = configuraciones_desatendidas(ruta, cursos)
+    ruta_estado = get_ruta_reanudacion(ruta, modo)
+    completados = set()
+    if reanudar and not dry_run:
+        try:
+            with open(ruta_estado, encoding="utf-8") as f:
+                completados = set(json.load(f)["completados"])
+        except (OSError, ValueError, KeyError):
+            pass
+
+    cerrojo = threading.Lock()
+    cancelacion = threading.Event()
+
+    def procesar(config):
+        resultado = ejecutar_curso_desatendido(config, modo, dry_run, traza, log_callback, cancelacion)
+        if resultado["estado"] == "ok" and not dry_run:
+            with cerrojo:
+                completados.add(_clave_reanudacion(config))
+                os.makedirs(os.path.dirname(ruta_estado), exist_ok=True)
+                with open(ruta_estado, "w", encoding="utf-8") as f:
+                    json.dump({"modo": modo, "ruta": os.path.abspath(ruta), "completados": sorted(completados)}, f, indent=2)
+        return resultado
+
+    inicio = time.time()
+    resultados = [None] * len(configs)
+    pendientes = []
+    for i, config in enumerate(configs):
+        if _clave_reanudacion(config) in completados:
+            resultados[i] = {"course_id": config.course_id, "categoria_padre": config.categoria_padre,
+                             "estado": "omitido", "peticiones": 0, "errores": [], "duracion": 0}
+        else:
+            pendientes.append(i)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrencia)) as ejecutor:
+        futuros = {i: ejecutor.submit(procesar, configs[i]) for i in pendientes}
+        try:
+            for i, futuro in futuros.items():
+                resultados[i] = futuro.result()
+        except KeyboardInterrupt:
+            # Los flujos en marcha paran en la siguiente operación; los que no han empezado, no empiezan
+            cancelacion.set()
+            for futuro in futuros.values():
+                futuro.cancel()
+            for i, futuro in futuros.items():
+                if futuro.cancelled():
+                    resultados[i] = {"course_id": configs[i].course_id, "categoria_padre": configs[i].categoria_padre,
+                                     "estado": "cancelado", "peticiones": 0, "errores": [], "duracion": 0}
+                else:
+                    resultados[i] = futuro.result()
+
+    codigo = codigo_salida_desatendida(resultados)
+    if codigo == SALIDA_OK and not dry_run:
+        with contextlib.suppress(OSError):
+            os.remove(ruta_estado)
+    return codigo, {
+        "modo": modo, "ruta": os.path.abspath(ruta), "dry_run": dry_run, "codigo_salida": codigo,
+        "inicio": inicio, "duracion": round(time.time() - inicio, 2),
+        "totales": {estado: sum(1 for r in resultados if r["estado"] == estado)
+                    for estado in ("ok", "error", "login", "cancelado", "omitido")},
+        "cursos": resultados
+    }
+
+def formatear_resultado_desatendido(resultado):
+    """Resumen legible de ejecutar_desatendido para --formato texto."""
+    lineas = [f"{'Curso':>8} {'Estado':<10} {'Pet.':>5} {'Tiempo':>7}  Categoría padre", "-" * 70]
+    for r in resultado["cursos"]:
+        lineas.append(f"{r['course_id']:>8} {r['estado']:<10} {r['peticiones']:>5} {r['duracion']:>6}s  {r['categoria_padre']}")
+        for error in r["errores"][:3]:
+            lineas.append(f"{'':>8} ! {error}")
+        if "simulacion" in r:
+            lineas.append(f"{'':>8} dry-run: {json.dumps(r['simulacion'], ensure_ascii=False)}")
+    lineas.append("-" * 70)
+    lineas.append(", ".join(f"{estado}={total}" for estado, total in resultado["totales"].items() if total)
+                  + f" | {resultado['duracion']}s | código de salida {resultado['codigo_salida']}")
+    return "\n".join(lineas)
+
+# --- MEDICIÓN DEL ARRANQUE ---
+
+# Segundos máximos (mediana) hasta que la ventana de la GUI queda dibujada
+PRESUPUESTO_ARRANQUE = 1.0
+
+def medir_arranque(ejecutable=None, repeticiones=5, presupuesto=PRESUPUESTO_ARRANQUE):
+    """
+    Arranca la GUI 'repeticiones' veces y mide el tiempo real hasta que la ventana está lista.
+    Sin 'ejecutable' mide el modo script (python gui_aules.py); con él, el binario empaquetado
+    (PyInstaller/AppImage). La GUI anota la hora en el archivo de AULES_MEDIR_ARRANQUE y se cierra.
+    Devuelve un diccionario con los tiempos, la mediana y si se cumple el presupuesto.
+    """
+    if ejecutable:
+        comando = [os.path.abspath(ejecutable)]
+    else:
+        comando = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "gui_aules.py")]
+    tiempos = []
+    for i in range(repeticiones):
+        marca = os.path.join(get_directorio_informes(), f".arranque_{os.getpid()}_{i}")
+        os.makedirs(os.path.dirname(marca), exist_ok=True)
+        entorno = dict(os.environ, AULES_MEDIR_ARRANQUE=marca)
+        inicio = time.time()
+        subprocess.run(comando, env=entorno, timeout=60, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            with open(marca, encoding="utf-8") as f:
+                tiempos.append(float(f.read()) - inicio)
+            os.remove(marca)
+        except (OSError, ValueError):
+            raise RuntimeError(f"La GUI no llegó a mostrarse: {' '.join(comando)}")
+    mediana = sorted(tiempos)[len(tiempos) // 2]
+    return {"modo": "binario" if ejecutable else "script", "tiempos": [round(t, 3) for t in tiempos],
+            "mediana": round(mediana, 3), "presupuesto": presupuesto, "cumple": mediana <= presupuesto}
+
 def mostrar_menu(args=None):
     """Muestra el menú principal y obtiene la selección del usuario"""
     if args and args.mode:
@@ -1339,8 +5357,399 @@ Incluye prompt específico para crear JSON completos a partir de documentos con
     pydoc.pager(texto)
     input("\nPresiona Enter para volver al menú principal...")
 
-def run_cli():
-    """Función para el modo interactivo por consola."""
+def parse_args(argv=None):
+    """Argumentos de línea de comandos del modo consola."""
+    parser = argparse.ArgumentParser(description="Gestión de estructuras de calificación en Aules (Moodle)")
+    parser.add_argument("--trace", metavar="RUTA",
+                        help="Guarda una traza de la ejecución en formato Chrome trace-event (equivale a AULES_TRACE)")
+    parser.add_argument("--profile", action="store_true",
+                        help="Perfila la acción elegida (cProfile + tracemalloc) y guarda el informe en informes/")
+    parser.add_argument("--plan", choices=["crear", "sincronizar"],
+                        help="Dry-run: muestra las operaciones, peticiones y tiempo estimado sin tocar Aules")
+    parser.add_argument("--snapshot", metavar="RUTA",
+                        help="Instantánea del curso usada por --plan (si no se indica, se asume un curso vacío)")
+    parser.add_argument("--guardar-snapshot", metavar="RUTA",
+                        help="Inicia sesión, guarda la estructura actual del curso en RUTA y termina")
+    parser.add_argument("--calcular", metavar="CSV",
+                        help="Calcula localmente las notas finales de un CSV alumnos x idnumber sin conectar a Aules")
+    parser.add_argument("--pesos", metavar="JSON",
+                        help='Con --calcular, simula otros aggregationcoef. Ejemplo: \'{"RA1": 3, "CE1.2": 0.5}\'')
+    parser.add_argument("--importar-notas", metavar="FICHERO",
+                        help="Sube las notas de un CSV/XLSX (alumno x idnumber) con el importador CSV de Moodle")
+    parser.add_argument("--identificador", choices=IDENTIFICADORES_ALUMNO, default="useremail",
+                        help="Campo que identifica al alumno en la primera columna de --importar-notas")
+    parser.add_argument("--medir-arranque", nargs="?", const="", metavar="EJECUTABLE",
+                        help="Mide el arranque de la GUI (script o binario empaquetado) y falla si supera el presupuesto")
+    parser.add_argument("--presupuesto", type=float, default=PRESUPUESTO_ARRANQUE, metavar="SEGUNDOS",
+                        help=f"Presupuesto de --medir-arranque (por defecto {PRESUPUESTO_ARRANQUE} s)")
+    parser.add_argument("--solo-aviso", action="store_true",
+                        help="Con --medir-arranque, superar el presupuesto o no poder medir solo avisa (código 0), p. ej. en runners compartidos")
+    parser.add_argument("--multicurso", metavar="FICHERO",
+                        help="Aplica --accion a cada curso/módulo de un archivo multicurso, sección a sección")
+    parser.add_argument("--accion", choices=ACCIONES_MULTICURSO, default="sincronizar",
+                        help="Acción de --multicurso (por defecto: sincronizar)")
+    parser.add_argument("--exportar-notas", nargs="?", const="", metavar="DIRECTORIO",
+                        help="Descarga la exportación de notas del curso a un almacén columnar local (por defecto en informes/notas)")
+    desatendido = parser.add_argument_group("modo desatendido (cron, scripts)")
+    desatendido.add_argument("--mode", choices=list(MODOS_DESATENDIDOS),
+                             help="Ejecuta el modo sin menú ni preguntas y termina con un código de salida")
+    desatendido.add_argument("--config", metavar="RUTA",
+                             help="datos_aules.json (o archivo multicurso) a usar en lugar del de la ruta habitual")
+    desatendido.add_argument("--curso", type=int, action="append", default=[], metavar="ID",
+                             help="ID de curso: sustituye el del archivo, o filtra las secciones de un multicurso (repetible)")
+    desatendido.add_argument("--concurrencia", type=int, metavar="N",
+                             help="Trabajo en paralelo: cursos en --mode (por defecto 1) y --clonar-desde (4), "
+                                  "lecturas en --exportar-estructura y cursos en --auditar (8)")
+    desatendido.add_argument("--dry-run", action="store_true",
+                             help="Calcula lo que haría --mode sobre la estructura actual sin modificar Aules")
+    desatendido.add_argument("--reanudar", action="store_true",
+                             help="Omite los cursos que ya terminaron en la última ejecución interrumpida del mismo modo")
+    desatendido.add_argument("--formato", choices=["texto", "json"], default="texto",
+                             help="Formato del resultado en la salida estándar (los logs van a la salida de error)")
+    desatendido.add_argument("--confirmar", action="store_true",
+                             help="Necesario para --mode delete: confirma la eliminación sin preguntar")
+    desatendido.add_argument("--no-interactivo", action="store_true",
+                             help="No pregunta nunca por teclado (implícito si la entrada no es una terminal)")
+    desatendido.add_argument("--clonar-desde", type=int, metavar="ID",
+                             help="Copia la estructura de este curso, tal como está en Aules, a los cursos de --curso")
+    desatendido.add_argument("--categoria", metavar="NOMBRE",
+                             help="Categoría padre a clonar o exportar (por defecto, la de datos_aules.json)")
+    desatendido.add_argument("--auditar", action="store_true",
+                             help="Compara los cursos (--config, --curso) con la configuración sin modificar Aules")
+    desatendido.add_argument("--vigilar", action="store_true",
+                             help="Vigila datos_aules.json y aplica en Aules solo lo que cambia en cada guardado (Ctrl+C para salir)")
+    desatendido.add_argument("--instantanea", nargs="?", const="", metavar="ETIQUETA",
+                             help="Guarda la estructura actual del curso en el historial de instantáneas")
+    desatendido.add_argument("--historial", action="store_true",
+                             help="Lista las instantáneas guardadas del curso")
+    desatendido.add_argument("--diferencias", nargs="+", metavar="REF",
+                             help="Compara dos instantáneas (ID o fecha AAAA-MM-DD; 'actual' lee el curso ahora). "
+                                  "Con una sola, la compara con la última")
+    desatendido.add_argument("--restaurar", metavar="REF",
+                             help="Devuelve la categoría padre del curso al estado de una instantánea (ID o fecha)")
+    desatendido.add_argument("--forzar", action="store_true",
+                             help="Con --restaurar, admite una instantánea de otro curso o servidor")
+    desatendido.add_argument("--exportar-estructura", nargs="?", const="", metavar="RUTA",
+                             help="Escribe la estructura actual del curso (o del primer --curso) en RUTA o en datos_aules.json")
+    return parser.parse_args(argv)
+
+def run_clonar(args):
+    """Ejecuta --clonar-desde con las credenciales de datos_aules.json. Devuelve el código de salida."""
+    data = cargar_datos_json()
+    categoria = args.categoria or (data or {}).get("categoria_padre")
+    if not data or not args.curso or not categoria:
+        print("Error: --clonar-desde necesita datos_aules.json, al menos un --curso de destino y una categoría padre",
+              file=sys.stderr)
+        return SALIDA_CONFIGURACION
+    log = lambda mensaje, nivel="info": print(f"[{nivel.upper()}] {mensaje}", file=sys.stderr, flush=True)
+    client = AulesClient(data["base_url"], log_callback=log, traza=getattr(args, "trace", None))
+    if not client.login(data["username"], data["password"]):
+        return SALIDA_LOGIN
+    try:
+        resultados = clonar_estructura(client, args.clonar_desde, args.curso, categoria, max(1, args.concurrencia or 4))
+    except KeyboardInterrupt:
+        return SALIDA_CANCELADA
+    if "cancelado" in resultados.values():
+        codigo = SALIDA_CANCELADA
+    else:
+        codigo = SALIDA_OK if all(r == "ok" for r in resultados.values()) else SALIDA_FALLOS
+    if args.formato == "json":
+        print(json.dumps({"origen": args.clonar_desde, "categoria_padre": categoria, "codigo_salida": codigo,
+                          "cursos": {str(d): r for d, r in resultados.items()}}, indent=2, ensure_ascii=False))
+    else:
+        for destino, resultado in resultados.items():
+            print(f"{destino:>8}  {resultado}")
+    return codigo
+
+def run_exportar_estructura(args):
+    """Ejecuta --exportar-estructura con las credenciales de datos_aules.json. Devuelve el código de salida."""
+    data = cargar_datos_json()
+    categoria = args.categoria or (data or {}).get("categoria_padre")
+    if not data or not categoria:
+        print("Error: --exportar-estructura necesita datos_aules.json (URL y credenciales) y una categoría padre",
+              file=sys.stderr)
+        return SALIDA_CONFIGURACION
+    course_id = args.curso[0] if args.curso else data["course_id"]
+    ruta = args.exportar_estructura or get_json_path()
+    if os.path.exists(ruta) and es_archivo_multicurso(ruta):
+        print(f"Error: {ruta} es un archivo multicurso; indica otro archivo en --exportar-estructura", file=sys.stderr)
+        return SALIDA_CONFIGURACION
+    client = AulesClient(data["base_url"], traza=getattr(args, "trace", None))
+    if not client.login(data["username"], data["password"]):
+        return SALIDA_LOGIN
+    exportado = exportar_estructura_json(client, course_id, categoria, ruta, max(1, args.concurrencia or 8))
+    return SALIDA_OK if exportado else SALIDA_FALLOS
+
+def run_auditar(args):
+    """Ejecuta --auditar y escribe el informe (texto o JSON). Devuelve el código de salida."""
+    ruta = get_json_path()
+    log = lambda mensaje, nivel="info": print(f"[{nivel.upper()}] {mensaje}", file=sys.stderr, flush=True)
+    try:
+        configs = configuraciones_desatendidas(ruta, args.curso)
+    except (ErrorConfiguracion, OSError) as e:
+        errores = e.errores if isinstance(e, ErrorConfiguracion) else [str(e)]
+        print("\n".join(f"Error en {ruta}: {error}" for error in errores), file=sys.stderr)
+        return SALIDA_CONFIGURACION
+    resultados = auditar_cursos(configs, args.concurrencia or 8, getattr(args, "trace", None), log)
+    if args.formato == "json":
+        print(json.dumps({"ruta": os.path.abspath(ruta), "cursos": resultados}, indent=2, ensure_ascii=False))
+    else:
+        print(formatear_auditoria(resultados))
+    if resultados and all(r.get("error") == "no se pudo iniciar sesión" for r in resultados):
+        return SALIDA_LOGIN
+    return SALIDA_OK if all(r["estado"] == "ok" for r in resultados) else SALIDA_FALLOS
+
+def run_vigilar(args):
+    """Ejecuta --vigilar hasta Ctrl+C. Devuelve el código de salida."""
+    try:
+        config = cargar_configuracion()
+    except ErrorConfiguracion as e:
+        print("\n".join(f"Error en datos_aules.json: {error}" for error in e.errores), file=sys.stderr)
+        return SALIDA_CONFIGURACION
+    if not config:
+        print(f"Error: no se encontró {get_json_path()}", file=sys.stderr)
+        return SALIDA_CONFIGURACION
+    client = AulesClient(config.base_url, traza=getattr(args, "trace", None))
+    if not client.login(config.username, config.password):
+        return SALIDA_LOGIN
+    try:
+        vigilar_configuracion(client, get_json_path(), args.curso[0] if args.curso else None)
+    except KeyboardInterrupt:
+        print("\nVigilancia detenida.")
+    return SALIDA_OK
+
+def run_historial(args):
+    """Ejecuta --instantanea, --historial, --diferencias o --restaurar. Devuelve el código de salida."""
+    data = cargar_datos_json()
+    if not data:
+        print(f"Error: no se encontró {get_json_path()}", file=sys.stderr)
+        return SALIDA_CONFIGURACION
+    course_id = args.curso[0] if args.curso else data["course_id"]
+    historial = HistorialInstantaneas()
+    client = actual = None
+
+    def conectar():
+        nonlocal client
+        if client is None:
+            client = AulesClient(data["base_url"], traza=getattr(args, "trace", None),
+                                 log_callback=lambda mensaje, nivel="info": print(f"[{nivel.upper()}] {mensaje}", file=sys.stderr))
+            if not client.login(data["username"], data["password"]):
+                return None
+        return client
+
+    if args.historial:
+        print(formatear_historial(historial.listar(data["base_url"], course_id), historial.ocupacion()))
+        return SALIDA_OK
+    if args.instantanea is not None or (args.diferencias and "actual" in args.diferencias):
+        if conectar() is None:
+            return SALIDA_LOGIN
+        actual = guardar_instantanea(client, course_id, args.instantanea or "manual", historial)
+        if actual is None:
+            return SALIDA_FALLOS
+        if args.instantanea is not None:
+            return SALIDA_OK
+    try:
+        if args.diferencias:
+            referencias = args.diferencias[:2]
+            if len(referencias) == 1:
+                # La otra referencia es la última guardada; con 'actual', la anterior a la que se acaba de tomar
+                guardadas = [g for g in historial.listar(data["base_url"], course_id) if g["id"] != actual]
+                if not guardadas:
+                    raise ValueError(f"No hay instantáneas del curso {course_id} con las que comparar")
+                if referencias[0] == "actual":
+                    referencias.insert(0, guardadas[-1]["id"])
+                else:
+                    referencias.append(guardadas[-1]["id"])
+            # Comparar no escribe nada: se admiten instantáneas de cualquier curso
+            ids = [actual if referencia == "actual" else resolver_instantanea(historial, referencia, data["base_url"], course_id,
+                                                                              forzar=True)
+                   for referencia in referencias]
+            diferencias = comparar_instantaneas(historial, *ids)
+            if args.formato == "json":
+                print(json.dumps({"antes": ids[0], "despues": ids[1], **diferencias}, indent=2, ensure_ascii=False))
+            else:
+                print(f"Instantánea {ids[0]} -> {ids[1]}:")
+                print(formatear_diferencias_instantaneas(diferencias))
+            return SALIDA_OK
+        instantanea_id = resolver_instantanea(historial, args.restaurar, data["base_url"], course_id, args.forzar)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return SALIDA_CONFIGURACION
+    if conectar() is None:
+        return SALIDA_LOGIN
+    restaurada = restaurar_instantanea(client, course_id, instantanea_id, args.categoria or data["categoria_padre"],
+                                       data.get("configuracion_global"), historial, args.forzar)
+    return SALIDA_OK if restaurada else SALIDA_FALLOS
+
+def run_desatendido(args):
+    """Ejecuta --mode y escribe el resultado (texto o JSON) en la salida estándar. Devuelve el código de salida."""
+    ruta = get_json_path()
+    if args.mode == "delete" and not args.dry_run and not args.confirmar:
+        print("Error: --mode delete necesita --confirmar (o --dry-run)", file=sys.stderr)
+        return SALIDA_CONFIGURACION
+    log = lambda mensaje, nivel="info": print(f"[{nivel.upper()}] {mensaje}", file=sys.stderr, flush=True)
+    try:
+        codigo, resultado = ejecutar_desatendido(ruta, args.mode, args.curso, args.concurrencia or 1, args.dry_run,
+                                                 args.reanudar, getattr(args, "trace", None), log)
+    except (ErrorConfiguracion, OSError) as e:
+        codigo = SALIDA_CONFIGURACION
+        errores = e.errores if isinstance(e, ErrorConfiguracion) else [str(e)]
+        resultado = {"modo": args.mode, "ruta": os.path.abspath(ruta), "codigo_salida": codigo, "errores": errores}
+        if args.formato == "texto":
+            print("\n".join(f"Error en {ruta}: {error}" for error in errores), file=sys.stderr)
+            return codigo
+    if args.formato == "json":
+        print(json.dumps(resultado, indent=2, ensure_ascii=False))
+    else:
+        print(formatear_resultado_desatendido(resultado))
+    return codigo
+
+def run_cli(args=None):
+    """
+    Función para el modo interactivo por consola. Devuelve el código de salida del proceso
+    (None equivale a 0).
+    """
+    try:
+        return _ejecutar_cli(args)
+    except ErrorConfiguracion as e:
+        print("\n".join(f"Error en {get_json_path()}: {error}" for error in e.errores), file=sys.stderr)
+        return SALIDA_CONFIGURACION
+
+def _ejecutar_cli(args):
+    """Cuerpo de run_cli: cada opción de línea de comandos y, si no hay ninguna, el menú."""
+    traza = getattr(args, "trace", None)
+    perfil = getattr(args, "profile", False)
+
+    if getattr(args, "config", None):
+        fijar_json_path(args.config)
+
+    if getattr(args, "clonar_desde", None) is not None:
+        return run_clonar(args)
+
+    if getattr(args, "exportar_estructura", None) is not None:
+        return run_exportar_estructura(args)
+
+    if getattr(args, "auditar", False):
+        return run_auditar(args)
+
+    if getattr(args, "vigilar", False):
+        return run_vigilar(args)
+
+    if (getattr(args, "instantanea", None) is not None or getattr(args, "historial", False)
+            or getattr(args, "diferencias", None) or getattr(args, "restaurar", None)):
+        return run_historial(args)
+
+    if getattr(args, "mode", None):
+        return run_desatendido(args)
+
+    if getattr(args, "plan", None):
+        data = cargar_datos_json()
+        if not data:
+            print("Error: no se encontró datos_aules.json")
+            return SALIDA_CONFIGURACION
+        operaciones, resumen, avisos = planificar_desde_json(data, args.plan, args.snapshot)
+        print(formatear_plan(operaciones, resumen, avisos))
+        return SALIDA_OK
+
+    if getattr(args, "medir_arranque", None) is not None:
+        # En GitHub Actions la línea de aviso aparece como anotación del job
+        prefijo = "::warning::" if os.environ.get("GITHUB_ACTIONS") == "true" else "AVISO: "
+        try:
+            resultado = medir_arranque(args.medir_arranque or None, presupuesto=args.presupuesto)
+        except (RuntimeError, OSError, subprocess.SubprocessError) as e:
+            if getattr(args, "solo_aviso", False):
+                print(f"{prefijo}No se pudo medir el arranque: {e}")
+                return
+            print(f"Error: {e}")
+            sys.exit(2)
+        print(f"Arranque ({resultado['modo']}): mediana {resultado['mediana']:.3f}s "
+              f"{resultado['tiempos']} - presupuesto {resultado['presupuesto']:.2f}s")
+        if not resultado["cumple"]:
+            if getattr(args, "solo_aviso", False):
+                print(f"{prefijo}Presupuesto de arranque superado ({resultado['modo']}): "
+                      f"mediana {resultado['mediana']:.3f}s > {resultado['presupuesto']:.2f}s")
+                return
+            print("PRESUPUESTO DE ARRANQUE SUPERADO")
+            sys.exit(1)
+        return
+
+    if getattr(args, "multicurso", None):
+        try:
+            resultados = ejecutar_multicurso(args.multicurso, args.accion, traza)
+        except (ErrorConfiguracion, OSError) as e:
+            print(f"Error en {args.multicurso}: {e}", file=sys.stderr)
+            return SALIDA_CONFIGURACION
+        correctos = sum(1 for ok in resultados.values() if ok)
+        print(f"{correctos}/{len(resultados)} cursos procesados correctamente")
+        return SALIDA_OK if correctos == len(resultados) else SALIDA_FALLOS
+
+    if getattr(args, "calcular", None):
+        data = cargar_datos_json()
+        if not data:
+            print("Error: no se encontró datos_aules.json")
+            return SALIDA_CONFIGURACION
+        try:
+            pesos = json.loads(args.pesos) if args.pesos else {}
+        except ValueError as e:
+            print(f"Error: --pesos no es un JSON válido: {e}", file=sys.stderr)
+            return SALIDA_CONFIGURACION
+        motor = MotorCalificaciones(data)
+        errores = motor.validar_pesos(pesos)
+        if errores:
+            print("\n".join(f"Error en --pesos: {error}" for error in errores), file=sys.stderr)
+            return SALIDA_CONFIGURACION
+        try:
+            calificaciones = cargar_calificaciones_csv(args.calcular)
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"Error: no se pudo leer {args.calcular}: {e}", file=sys.stderr)
+            return SALIDA_CONFIGURACION
+        inicio = time.perf_counter()
+        filas = motor.simular(calificaciones, pesos)
+        duracion = (time.perf_counter() - inicio) * 1000
+        formato = lambda v: "-" if v is None else f"{v:.2f}"
+        print(f"{'Alumno':<30} {'Actual':>8} {'Simulada':>9} {'Dif.':>7}")
+        for fila in filas:
+            print(f"{fila['alumno'][:30]:<30} {formato(fila['antes']):>8} {formato(fila['despues']):>9} {formato(fila['diferencia']):>7}")
+        print(f"{len(filas)} alumnos calculados en {duracion:.1f} ms")
+        return SALIDA_OK
+
+    if getattr(args, "guardar_snapshot", None):
+        data = cargar_datos_json()
+        if not data:
+            print("Error: no se encontró datos_aules.json")
+            return SALIDA_CONFIGURACION
+        client = AulesClient(data["base_url"], traza=traza)
+        if not client.login(data["username"], data["password"]):
+            return SALIDA_LOGIN
+        total = guardar_snapshot_curso(client, data["course_id"], args.guardar_snapshot)
+        print(f"Instantánea con {total} elementos guardada en {args.guardar_snapshot}")
+        return SALIDA_OK
+
+    if getattr(args, "exportar_notas", None) is not None:
+        data = cargar_datos_json()
+        if not data:
+            print("Error: no se encontró datos_aules.json")
+            return SALIDA_CONFIGURACION
+        client = AulesClient(data["base_url"], traza=traza)
+        if not client.login(data["username"], data["password"]):
+            return SALIDA_LOGIN
+        directorio = descargar_exportacion_notas(client, data["course_id"], data, args.exportar_notas or None)
+        return SALIDA_OK if directorio else SALIDA_FALLOS
+
+    if getattr(args, "importar_notas", None):
+        data = cargar_datos_json()
+        if not data:
+            print("Error: no se encontró datos_aules.json")
+            return SALIDA_CONFIGURACION
+        client = AulesClient(data["base_url"], traza=traza)
+        if not client.login(data["username"], data["password"]):
+            return SALIDA_LOGIN
+        informe = importar_calificaciones(client, data["course_id"], args.importar_notas, data, args.identificador)
+        return SALIDA_FALLOS if informe["rechazadas"] or informe["errores_servidor"] or not informe["importadas"] else SALIDA_OK
+    if not es_interactivo(args):
+        print("Error: sin terminal no hay menú interactivo; usa --mode (ver --help)", file=sys.stderr)
+        return SALIDA_CONFIGURACION
+
     if is_appimage():
         print("=== GESTOR DE CALIFICACIONES AULES ===")
         print("Ejecutando en modo AppImage")
@@ -1357,12 +5766,16 @@ def run_cli():
         elif opcion == "5":
             break
 
-        data = cargar_datos_json()
+        try:
+            data = cargar_datos_json()
+        except ErrorConfiguracion as e:
+            print("\n".join(f"Error en datos_aules.json: {error}" for error in e.errores))
+            data = None
         if not data:
             input("Presiona Enter para continuar...")
             continue
 
-        client = AulesClient(data["base_url"])
+        client = AulesClient(data["base_url"], traza=traza)
         if not client.login(data["username"], data["password"]):
             input("Error de login. Presiona Enter...")
             continue
@@ -1372,36 +5785,23 @@ def run_cli():
         categorias_hijas = data["categorias_hijas"]
         config_global = data["configuracion_global"]
 
+        accion = None
         if opcion == "1":
-            insertar_categorias_y_items(client, course_id, categoria_padre, categorias_hijas, config_global)
+            accion, argumentos = insertar_categorias_y_items, (course_id, categoria_padre, categorias_hijas, config_global)
         elif opcion == "2":
-            elementos = obtener_elementos_curso(client, course_id)
-            padre = encontrar_categoria_por_nombre(elementos, categoria_padre)
-            if not padre: continue
-            
-            relacionados = encontrar_elementos_por_categoria(elementos, padre["id"])
-            for e in tqdm(relacionados, desc="Actualizando"):
-                if e["tipo"] == "category":
-                    conf = next((c for c in categorias_hijas if c["nombre"] == e["nombre"]), {})
-                    modificar_gradepass_categoria(client, course_id, e["id"], e["nombre"], config_global, conf.get("aggregationcoef", 0.0))
-                    modificar_formula_categoria(client, course_id, e["id"], e["nombre"], conf.get("formula", ""))
-                else:
-                    conf = None
-                    for ch in categorias_hijas:
-                        for ec in ch.get("elementos", []):
-                            if isinstance(ec, dict) and ec["nombre"] == e["nombre"]:
-                                conf = ec; break
-                        if conf: break
-                    
-                    if conf:
-                        modificar_gradepass_item(client, course_id, e["id"], e["nombre"], config_global, conf.get("idnumber", ""), conf.get("aggregationcoef", 1.0))
-                        modificar_formula_item(client, course_id, e["id"], e["nombre"], conf.get("formula", ""))
+            accion, argumentos = actualizar_calculos, (course_id, categoria_padre, categorias_hijas, config_global)
         elif opcion == "3":
             nombre_del = input("Introduce la categoría padre a eliminar: ")
             if nombre_del.strip():
-                eliminar_estructura(client, course_id, nombre_del)
+                accion, argumentos = eliminar_estructura, (course_id, nombre_del)
+
+        if accion and perfil:
+            _, ruta_perfil = perfilar(f"opcion{opcion}", accion, client, *argumentos)
+            print(f"Perfil guardado en {ruta_perfil}")
+        elif accion:
+            accion(client, *argumentos)
         
         input("\nProceso finalizado. Presiona Enter para continuar...")
 
 if __name__ == "__main__":
-    run_cli()
+    sys.exit(run_cli(parse_args()))
@@ -1,15 +1,34 @@
 import customtkinter as ctk
 import tkinter as tk
 from tkinter import messagebox
+from tkinter import ttk
 import time
 import threading
+import queue
 import json
 import os
-from calificaciones_aules import AulesClient, insertar_categorias_y_items, eliminar_estructura, actualizar_formulas, cargar_datos_json, sincronizar_todo, guardar_datos_json, get_json_path
+from calificaciones_aules import AulesClient, insertar_categorias_y_items, eliminar_estructura, actualizar_formulas, cargar_datos_json, sincronizar_todo, guardar_datos_json, get_json_path, Perfilador, cargar_configuracion, ErrorConfiguracion, GestorTrabajos, validar_configuracion, obtener_estructura_curso, comparar_estructura, MetricasPeticiones, editar_nodo_configuracion, guardar_ediciones_json
 
 # Versión de la Aplicación (Control de cambios)
 __version__ = "1.8.0"
 
+# Columnas editables del editor de estructura (además del nombre, columna #0)
+COLUMNAS_EDITOR = ("idnumber", "aggregationcoef", "formula")
+
+# Milisegundos sin ediciones antes de guardar datos_aules.json
+RETARDO_GUARDADO_MS = 800
+
+# Hijo ficticio que marca un nodo del editor cuyos hijos aún no se han creado
+MARCADOR_PENDIENTE = "__pendiente__"
+
+# Colores del explorador de Aules según la comparación con el JSON local
+COLORES_ESTADO_REMOTO = {"ok": None, "falta": "#d9534f", "sobra": "#f0ad4e", "difiere": "#5bc0de"}
+
+# Bomba de eventos: los hilos de trabajo encolan logs y progreso y el bucle de Tk los pinta por lotes
+INTERVALO_BOMBA_MS = 75
+MAX_EVENTOS_POR_CICLO = 2000
+MAX_LINEAS_CONSOLA = 5000
+
 # Configuración de apariencia
 ctk.set_appearance_mode("Dark")
 ctk.set_default_color_theme("blue")
@@ -28,11 +47,15 @@ class App(ctk.CTk):
         # Estado de la aplicación
         self.client = None
         self.is_busy = False
+        self.cola_eventos = queue.Queue()
+        self.lineas_consola = 0
+        self.gestor_trabajos = GestorTrabajos(al_cambiar=self.trabajo_cambiado)
+        self.refresco_programado = False
 
         # --- BARRA LATERAL ---
         self.sidebar_frame = ctk.CTkFrame(self, width=140, corner_radius=0)
         self.sidebar_frame.grid(row=0, column=0, sticky="nsew")
-        self.sidebar_frame.grid_rowconfigure(5, weight=1)
+        self.sidebar_frame.grid_rowconfigure(6, weight=1)
 
         self.logo_label = ctk.CTkLabel(self.sidebar_frame, text="AULES TOOL", font=ctk.CTkFont(size=20, weight="bold"))
         self.logo_label.grid(row=0, column=0, padx=20, pady=(20, 10))
@@ -57,26 +80,33 @@ class App(ctk.CTk):
                                          anchor="w", command=self.logs_button_event)
         self.logs_button.grid(row=4, column=0, sticky="ew")
 
+        self.remote_button = ctk.CTkButton(self.sidebar_frame, corner_radius=0, height=40, border_spacing=10, text="Curso en Aules",
+                                           fg_color="transparent", text_color=("gray10", "gray90"), hover_color=("gray70", "gray30"),
+                                           anchor="w", command=self.remote_button_event)
+        self.remote_button.grid(row=5, column=0, sticky="ew")
+
         self.appearance_mode_label = ctk.CTkLabel(self.sidebar_frame, text="Modo Visual:", anchor="w")
-        self.appearance_mode_label.grid(row=6, column=0, padx=20, pady=(10, 0))
+        self.appearance_mode_label.grid(row=7, column=0, padx=20, pady=(10, 0))
         self.appearance_mode_optionemenu = ctk.CTkOptionMenu(self.sidebar_frame, values=["Dark", "Light"],
                                                                        command=self.change_appearance_mode_event)
-        self.appearance_mode_optionemenu.grid(row=7, column=0, padx=20, pady=(10, 20))
+        self.appearance_mode_optionemenu.grid(row=8, column=0, padx=20, pady=(10, 20))
 
         # Etiqueta de Versión
         self.version_label = ctk.CTkLabel(self.sidebar_frame, text=f"v{__version__}", text_color="gray50", font=ctk.CTkFont(size=11))
-        self.version_label.grid(row=8, column=0, padx=20, pady=(0, 10))
+        self.version_label.grid(row=9, column=0, padx=20, pady=(0, 10))
 
         # --- FRAMES DE CONTENIDO ---
         self.home_frame = ctk.CTkFrame(self, corner_radius=0, fg_color="transparent")
         self.config_frame = ctk.CTkFrame(self, corner_radius=0, fg_color="transparent")
         self.json_frame = ctk.CTkFrame(self, corner_radius=0, fg_color="transparent")
         self.logs_frame = ctk.CTkFrame(self, corner_radius=0, fg_color="transparent")
+        self.remote_frame = ctk.CTkFrame(self, corner_radius=0, fg_color="transparent")
 
         self.init_home_view()
         self.init_config_view()
         self.init_json_view()
         self.init_logs_view()
+        self.init_remote_view()
 
         # Cargar datos iniciales desde JSON
         self.reload_all_data_event()
@@ -84,6 +114,8 @@ class App(ctk.CTk):
         # Seleccionar vista por defecto
         self.select_frame_by_name("home")
 
+        self.after(INTERVALO_BOMBA_MS, self.bombear_eventos)
+
     def init_home_view(self):
         self.home_frame.grid_columnconfigure(0, weight=1)
         self.title_label = ctk.CTkLabel(self.home_frame, text="Gestión de Cuaderno Aules", font=ctk.CTkFont(size=28, weight="bold"))
@@ -116,6 +148,17 @@ class App(ctk.CTk):
         self.status_text = ctk.CTkLabel(self.status_card, text="Desconectado de Aules", font=ctk.CTkFont(size=14))
         self.status_text.grid(row=0, column=1, pady=25)
 
+        # Trabajos en segundo plano
+        self.jobs_frame = ctk.CTkFrame(self.home_frame, fg_color="transparent")
+        self.jobs_frame.grid(row=4, column=0, padx=20, sticky="ew")
+        self.jobs_frame.grid_columnconfigure(0, weight=1)
+        ctk.CTkLabel(self.jobs_frame, text="Trabajos", font=ctk.CTkFont(size=16, weight="bold")).grid(row=0, column=0, sticky="w")
+        self.btn_cancelar = ctk.CTkButton(self.jobs_frame, text="Cancelar trabajos", width=160, fg_color="#ae3333", hover_color="#8b2828", command=self.cancelar_trabajos_event)
+        self.btn_cancelar.grid(row=0, column=1, sticky="e")
+        self.jobs_text = ctk.CTkTextbox(self.jobs_frame, height=140, font=("Courier", 11))
+        self.jobs_text.grid(row=1, column=0, columnspan=2, pady=(5, 0), sticky="ew")
+        self.jobs_text.configure(state="disabled")
+
     def init_config_view(self):
         self.config_frame.grid_columnconfigure(0, weight=1)
         ctk.CTkLabel(self.config_frame, text="Ajustes de Conexión", font=ctk.CTkFont(size=24, weight="bold")).grid(row=0, column=0, padx=20, pady=(40, 20), sticky="w")
@@ -138,20 +181,47 @@ class App(ctk.CTk):
         self.ce_as_category_switch = ctk.CTkSwitch(self.config_frame, text="Tratar CE como categoría (ce_as_category)", variable=self.ce_as_category_var)
         self.ce_as_category_switch.grid(row=7, column=0, padx=20, pady=(10, 20), sticky="w")
 
+        # Modo perfilado (diagnóstico de lentitud)
+        self.profile_var = ctk.BooleanVar(value=False)
+        self.profile_switch = ctk.CTkSwitch(self.config_frame, text="Modo perfilado (cProfile + memoria)", variable=self.profile_var)
+        self.profile_switch.grid(row=8, column=0, padx=20, pady=(0, 20), sticky="w")
+
         self.btn_connect = ctk.CTkButton(self.config_frame, text="Guardar y Conectar con Aules", height=45, width=450, command=self.connect_event)
-        self.btn_connect.grid(row=8, column=0, padx=20, pady=20, sticky="w")
+        self.btn_connect.grid(row=9, column=0, padx=20, pady=20, sticky="w")
 
     def init_json_view(self):
         self.json_frame.grid_columnconfigure(0, weight=1)
         self.json_frame.grid_rowconfigure(2, weight=1)
 
-        ctk.CTkLabel(self.json_frame, text="Configuración del Cuaderno (JSON)", font=ctk.CTkFont(size=22, weight="bold")).grid(row=0, column=0, padx=20, pady=(40, 10), sticky="w")
+        ctk.CTkLabel(self.json_frame, text="Estructura del Cuaderno (JSON)", font=ctk.CTkFont(size=22, weight="bold")).grid(row=0, column=0, padx=20, pady=(40, 10), sticky="w")
         
         self.json_path_label = ctk.CTkLabel(self.json_frame, text="Ruta: (sin datos cargados)", text_color="gray", font=ctk.CTkFont(size=11))
         self.json_path_label.grid(row=1, column=0, padx=20, pady=(0, 5), sticky="w")
         
-        self.json_text = ctk.CTkTextbox(self.json_frame, font=("Courier", 12), fg_color=("white", "gray10"))
-        self.json_text.grid(row=2, column=0, padx=20, pady=(0, 10), sticky="nsew")
+        # Editor de estructura: Treeview solo dibuja las filas visibles y los hijos se crean al expandir
+        self.editor_frame = ctk.CTkFrame(self.json_frame, fg_color="transparent")
+        self.editor_frame.grid(row=2, column=0, padx=20, pady=(0, 10), sticky="nsew")
+        self.editor_frame.grid_columnconfigure(0, weight=1)
+        self.editor_frame.grid_rowconfigure(0, weight=1)
+        self.editor_tree = ttk.Treeview(self.editor_frame, columns=COLUMNAS_EDITOR, show="tree headings")
+        self.editor_tree.heading("#0", text="Nombre")
+        self.editor_tree.heading("idnumber", text="idnumber")
+        self.editor_tree.heading("aggregationcoef", text="Peso")
+        self.editor_tree.heading("formula", text="Fórmula")
+        self.editor_tree.column("#0", width=320)
+        self.editor_tree.column("idnumber", width=120)
+        self.editor_tree.column("aggregationcoef", width=70, anchor="e")
+        self.editor_tree.column("formula", width=300)
+        self.editor_tree.grid(row=0, column=0, sticky="nsew")
+        editor_scroll = ttk.Scrollbar(self.editor_frame, orient="vertical", command=self.editor_tree.yview)
+        editor_scroll.grid(row=0, column=1, sticky="ns")
+        self.editor_tree.configure(yscrollcommand=editor_scroll.set)
+        self.editor_tree.bind("<<TreeviewOpen>>", self.expandir_nodo_editor)
+        self.editor_tree.bind("<Double-1>", self.editar_celda_editor)
+        self.datos_editor = None
+        self.rutas_editor = {}
+        self.guardado_pendiente = None
+        self.ediciones_pendientes = []
         
         self.btn_refresh_json = ctk.CTkButton(self.json_frame, text="Sincronizar Aplicación con Archivo JSON", height=40, command=self.reload_all_data_event)
         self.btn_refresh_json.grid(row=3, column=0, padx=20, pady=(0, 20), sticky="w")
@@ -168,13 +238,92 @@ class App(ctk.CTk):
         self.progressbar.grid(row=2, column=0, padx=20, pady=10, sticky="ew")
         self.progressbar.set(0)
 
+    def init_remote_view(self):
+        self.remote_frame.grid_columnconfigure(0, weight=1)
+        self.remote_frame.grid_rowconfigure(2, weight=1)
+
+        ctk.CTkLabel(self.remote_frame, text="Curso en Aules", font=ctk.CTkFont(size=22, weight="bold")).grid(row=0, column=0, padx=20, pady=(40, 10), sticky="w")
+        self.remote_status = ctk.CTkLabel(self.remote_frame, text="Sin cargar. Rojo: falta en Aules · Naranja: sobra · Azul: difiere del JSON",
+                                          text_color="gray", font=ctk.CTkFont(size=11))
+        self.remote_status.grid(row=1, column=0, padx=20, pady=(0, 5), sticky="w")
+
+        remote_tree_frame = ctk.CTkFrame(self.remote_frame, fg_color="transparent")
+        remote_tree_frame.grid(row=2, column=0, padx=20, pady=(0, 10), sticky="nsew")
+        remote_tree_frame.grid_columnconfigure(0, weight=1)
+        remote_tree_frame.grid_rowconfigure(0, weight=1)
+        self.remote_tree = ttk.Treeview(remote_tree_frame, columns=("tipo", "estado"), show="tree headings")
+        self.remote_tree.heading("#0", text="Nombre")
+        self.remote_tree.heading("tipo", text="Tipo")
+        self.remote_tree.heading("estado", text="Comparación con el JSON")
+        self.remote_tree.column("#0", width=340)
+        self.remote_tree.column("tipo", width=90)
+        self.remote_tree.column("estado", width=380)
+        self.remote_tree.grid(row=0, column=0, sticky="nsew")
+        remote_scroll = ttk.Scrollbar(remote_tree_frame, orient="vertical", command=self.remote_tree.yview)
+        remote_scroll.grid(row=0, column=1, sticky="ns")
+        self.remote_tree.configure(yscrollcommand=remote_scroll.set)
+        for estado, color in COLORES_ESTADO_REMOTO.items():
+            if color:
+                self.remote_tree.tag_configure(estado, foreground=color)
+        self.remote_tree.bind("<<TreeviewOpen>>", self.expandir_nodo_remoto)
+        self.remote_nodos = {}
+        self.remote_hijos = {}
+
+        self.btn_refresh_remote = ctk.CTkButton(self.remote_frame, text="Actualizar desde Aules", height=40, command=lambda: self.cargar_remoto(forzar=True))
+        self.btn_refresh_remote.grid(row=3, column=0, padx=20, pady=(0, 20), sticky="w")
+
     # --- LÓGICA DE CONTROL ---
 
     def log(self, message, level="info"):
+        """Encola una línea para la consola. Se puede llamar desde cualquier hilo."""
         timestamp = time.strftime('%H:%M:%S')
-        full_message = f"[{timestamp}] {message}\n"
-        self.log_text.insert("end", full_message)
-        self.log_text.see("end")
+        self.cola_eventos.put(("log", f"[{timestamp}] {message}\n"))
+
+    def progreso(self, valor, mensaje=""):
+        """progress_callback del cliente: encola el avance (0-100) y, si lo hay, el mensaje."""
+        self.cola_eventos.put(("progreso", valor / 100))
+        if mensaje:
+            self.log(mensaje, "info")
+
+    def en_hilo_principal(self, funcion, *args):
+        """Ejecuta una actualización de widgets en el hilo de Tk (desde un hilo de trabajo)."""
+        self.cola_eventos.put(("llamada", funcion, args))
+
+    def bombear_eventos(self):
+        """
+        Vacía la cola de eventos en el hilo de Tk: las líneas se insertan de una vez, del progreso
+        solo cuenta el último valor y la consola se recorta a MAX_LINEAS_CONSOLA líneas.
+        """
+        lineas, progreso, llamadas = [], None, []
+        try:
+            for _ in range(MAX_EVENTOS_POR_CICLO):
+                evento = self.cola_eventos.get_nowait()
+                if evento[0] == "log":
+                    lineas.append(evento[1])
+                elif evento[0] == "progreso":
+                    progreso = evento[1]
+                else:
+                    llamadas.append(evento[1:])
+        except queue.Empty:
+            pass
+
+        if lineas:
+            self.log_text.insert("end", "".join(lineas))
+            self.lineas_consola += len(lineas)
+            if self.lineas_consola > MAX_LINEAS_CONSOLA:
+                sobrantes = self.lineas_consola - MAX_LINEAS_CONSOLA
+                self.log_text.delete("1.0", f"{sobrantes + 1}.0")
+                self.lineas_consola = MAX_LINEAS_CONSOLA
+            self.log_text.see("end")
+        if progreso is not None:
+            self.progressbar.set(progreso)
+        for funcion, args in llamadas:
+            try:
+                funcion(*args)
+            except Exception as e:
+                self.log(f"Error al actualizar la interfaz: {e}", "error")
+
+        self.after(INTERVALO_BOMBA_MS, self.bombear_eventos)
 
     def select_frame_by_name(self, name):
         # Actualizar colores botones sidebar
@@ -198,22 +347,47 @@ class App(ctk.CTk):
         if name == "logs": self.logs_frame.grid(row=0, column=1, sticky="nsew")
         else: self.logs_frame.grid_forget()
 
+        self.remote_button.configure(fg_color=("gray75", "gray25") if name == "remote" else "transparent")
+        if name == "remote": self.remote_frame.grid(row=0, column=1, sticky="nsew")
+        else: self.remote_frame.grid_forget()
+
     def home_button_event(self): self.select_frame_by_name("home")
     def config_button_event(self): self.select_frame_by_name("config")
     def json_button_event(self): self.select_frame_by_name("json")
     def logs_button_event(self): self.select_frame_by_name("logs")
 
+    def remote_button_event(self):
+        self.select_frame_by_name("remote")
+        if not self.remote_nodos:
+            self.cargar_remoto()
+
     def change_appearance_mode_event(self, new_appearance_mode):
         ctk.set_appearance_mode(new_appearance_mode)
 
+    def cargar_datos(self):
+        """cargar_datos_json para las acciones: un archivo no válido se explica en el log y devuelve None."""
+        try:
+            return cargar_datos_json()
+        except ErrorConfiguracion as e:
+            for error in e.errores:
+                self.log(f"datos_aules.json: {error}", "error")
+            return None
+
     def reload_all_data_event(self):
         """Recarga TODO desde el JSON: Texto, Ajustes y Credenciales"""
         try:
-            data = cargar_datos_json()
+            try:
+                config = cargar_configuracion()
+            except ErrorConfiguracion as e:
+                for error in e.errores:
+                    self.log(f"datos_aules.json: {error}", "error")
+                return
+            data = config.como_dict() if config else None
             if data:
-                # 1. Actualizar Vista Previa de Texto y Ruta
-                self.json_text.delete("1.0", "end")
-                self.json_text.insert("1.0", json.dumps(data, indent=2, ensure_ascii=False))
+                for aviso in config.avisos:
+                    self.log(f"Aviso en datos_aules.json: {aviso}")
+                # 1. Actualizar Editor de Estructura y Ruta
+                self.cargar_editor(data)
                 self.json_path_label.configure(text=f"Ruta: {get_json_path()}")
                 
                 # 2. Actualizar Campos de Conexión
@@ -234,6 +408,229 @@ class App(ctk.CTk):
         except Exception as e:
             self.log(f"Error durante la sincronización: {e}", "error")
 
+    # --- EDITOR DE ESTRUCTURA ---
+
+    def cargar_editor(self, data):
+        """Vacía el editor y crea solo la categoría padre; RAs y CEs se crean al expandir."""
+        self.datos_editor = data
+        self.editor_tree.delete(*self.editor_tree.get_children())
+        self.rutas_editor = {}
+        raiz = self.editor_tree.insert("", "end", text=data.get("categoria_padre", ""), values=("", "", ""), open=False)
+        self.rutas_editor[raiz] = ("padre",)
+        if data.get("categorias_hijas"):
+            self.editor_tree.insert(raiz, "end", iid=f"{raiz}{MARCADOR_PENDIENTE}", text="...")
+
+    def nodo_editor(self, ruta):
+        """Objeto del JSON al que apunta una ruta del editor (el CE puede ser un texto suelto)."""
+        if ruta[0] == "padre":
+            return self.datos_editor
+        categoria = self.datos_editor["categorias_hijas"][ruta[1]]
+        return categoria if ruta[0] == "ra" else categoria["elementos"][ruta[2]]
+
+    def clave_editor(self, ruta):
+        """Clave por nombre (editar_nodo_configuracion) del nodo al que apunta una ruta del editor."""
+        if ruta[0] == "padre":
+            return ("padre",)
+        ra = self.datos_editor["categorias_hijas"][ruta[1]]["nombre"]
+        if ruta[0] == "ra":
+            return ("ra", ra)
+        nodo = self.nodo_editor(ruta)
+        return ("ce", ra, nodo if isinstance(nodo, str) else nodo["nombre"])
+
+    def valores_editor(self, ruta):
+        if ruta[0] == "padre":
+            return self.datos_editor.get("categoria_padre", ""), ("", "", "")
+        nodo = self.nodo_editor(ruta)
+        if isinstance(nodo, str):
+            return nodo, ("", 1.0, "")
+        coef_defecto = 0.0 if ruta[0] == "ra" else 1.0
+        return nodo["nombre"], (nodo.get("idnumber", ""), nodo.get("aggregationcoef", coef_defecto), nodo.get("formula") or "")
+
+    def expandir_nodo_editor(self, event=None):
+        """Crea los hijos del nodo abierto la primera vez que se expande."""
+        padre = self.editor_tree.focus()
+        pendiente = f"{padre}{MARCADOR_PENDIENTE}"
+        if not self.editor_tree.exists(pendiente):
+            return
+        self.editor_tree.delete(pendiente)
+        ruta = self.rutas_editor[padre]
+        if ruta[0] == "padre":
+            hijas = [("ra", i) for i in range(len(self.datos_editor.get("categorias_hijas", [])))]
+        else:
+            hijas = [("ce", ruta[1], j) for j in range(len(self.nodo_editor(ruta).get("elementos", [])))]
+        for ruta_hija in hijas:
+            nombre, valores = self.valores_editor(ruta_hija)
+            iid = self.editor_tree.insert(padre, "end", text=nombre, values=valores)
+            self.rutas_editor[iid] = ruta_hija
+            if ruta_hija[0] == "ra" and self.nodo_editor(ruta_hija).get("elementos"):
+                self.editor_tree.insert(iid, "end", iid=f"{iid}{MARCADOR_PENDIENTE}", text="...")
+
+    def editar_celda_editor(self, event):
+        """Doble clic: superpone un Entry sobre la celda y al confirmar actualiza solo ese nodo."""
+        iid = self.editor_tree.identify_row(event.y)
+        columna = self.editor_tree.identify_column(event.x)
+        if not iid or iid not in self.rutas_editor:
+            return
+        ruta = self.rutas_editor[iid]
+        campo = "nombre" if columna == "#0" else COLUMNAS_EDITOR[int(columna[1:]) - 1]
+        if ruta[0] == "padre" and campo != "nombre":
+            return
+        caja = self.editor_tree.bbox(iid, columna)
+        if not caja:
+            return
+        actual = self.editor_tree.item(iid, "text") if campo == "nombre" else self.editor_tree.set(iid, campo)
+        entrada = ttk.Entry(self.editor_tree)
+        entrada.insert(0, actual)
+        entrada.select_range(0, "end")
+        entrada.place(x=caja[0], y=caja[1], width=caja[2], height=caja[3])
+        entrada.focus_set()
+
+        cerrada = False
+
+        def cerrar(event=None, confirmar=True):
+            # Return destruye la caja y eso dispara FocusOut: solo cuenta el primer cierre
+            nonlocal cerrada
+            if cerrada:
+                return
+            cerrada = True
+            valor = entrada.get()
+            entrada.destroy()
+            if confirmar and valor != str(actual):
+                self.aplicar_edicion_editor(iid, ruta, campo, valor)
+        entrada.bind("<Return>", cerrar)
+        entrada.bind("<FocusOut>", cerrar)
+        entrada.bind("<Escape>", lambda event: cerrar(confirmar=False))
+
+    def aplicar_edicion_editor(self, iid, ruta, campo, valor):
+        """Aplica una edición al JSON en memoria, repinta esa fila y programa el guardado de ese nodo."""
+        if campo == "aggregationcoef":
+            try:
+                valor = float(valor.replace(",", "."))
+            except ValueError:
+                self.log(f"Peso no válido: '{valor}'", "error")
+                return
+        clave = self.clave_editor(ruta)
+        editar_nodo_configuracion(self.datos_editor, clave, campo, valor)
+        self.ediciones_pendientes.append((clave, campo, valor))
+        nombre, valores = self.valores_editor(ruta)
+        self.editor_tree.item(iid, text=nombre, values=valores)
+        if self.guardado_pendiente:
+            self.after_cancel(self.guardado_pendiente)
+        self.guardado_pendiente = self.after(RETARDO_GUARDADO_MS, self.guardar_editor)
+
+    def guardar_editor(self):
+        """Guarda los nodos editados (no el editor entero) y avisa de lo que la validación rechazaría."""
+        self.guardado_pendiente = None
+        ediciones, self.ediciones_pendientes = self.ediciones_pendientes, []
+        guardados, perdidas = guardar_ediciones_json(ediciones)
+        if guardados is None:
+            self.ediciones_pendientes = ediciones + self.ediciones_pendientes
+            self.log("No se pudo guardar datos_aules.json", "error")
+            return
+        for clave in perdidas:
+            self.log(f"'{clave[-1]}' ya no está en datos_aules.json; su edición no se ha guardado.", "error")
+        try:
+            validar_configuracion(guardados)
+            self.log("Cambios del editor guardados en datos_aules.json.", "success")
+        except ErrorConfiguracion as e:
+            for error in e.errores:
+                self.log(f"Guardado con errores: {error}", "error")
+
+    # --- EXPLORADOR DEL CURSO EN AULES ---
+
+    def cargar_remoto(self, forzar=False):
+        """Lee el árbol del curso en segundo plano (caché local salvo forzar=True) y lo compara con el JSON."""
+        if not self.client:
+            self.remote_status.configure(text="Conecta primero desde Ajustes para ver el curso.")
+            return
+        data = self.cargar_datos()
+        if not data:
+            return
+
+        def leer(client, course_id):
+            elementos = obtener_estructura_curso(client, course_id, forzar=forzar)
+            comparacion = comparar_estructura(elementos, data["categoria_padre"], data["categorias_hijas"], data.get("configuracion_global"))
+            self.en_hilo_principal(self.mostrar_remoto, elementos, comparacion)
+
+        if self.gestor_trabajos.encolar("explorar", data["course_id"], self.cliente_trabajo(), leer, data["course_id"]):
+            self.remote_status.configure(text="Cargando estructura del curso...")
+
+    def nodos_remotos(self, elementos, comparacion):
+        """Nodos del explorador (los de Aules y los que faltan) como id -> (padre, nombre, tipo, estado, motivo)."""
+        nodos = {}
+        for e in elementos:
+            padre = e.get("categoria_padre_id", "") if e["tipo"] == "category" else e.get("categoria_id", "")
+            estado, motivo = comparacion["estados"].get(e["id"], ("ok", ""))
+            nodos[e["id"]] = (padre, e["nombre"], e["tipo"], estado, motivo)
+        ids_por_nombre = {e["nombre"]: e["id"] for e in elementos if e["tipo"] == "category"}
+        for nombre, tipo, nombre_padre in comparacion["faltan"]:
+            ids_por_nombre.setdefault(nombre, f"falta:{nombre}")
+            padre = ids_por_nombre.get(nombre_padre, f"falta:{nombre_padre}") if nombre_padre else ""
+            nodos[f"falta:{nombre}"] = (padre, nombre, tipo, "falta", "no existe en Aules")
+        # Los nodos cuyo padre no se muestra cuelgan de la raíz
+        return {i: ((n[0] if n[0] in nodos else ""),) + n[1:] for i, n in nodos.items()}
+
+    def fila_remota(self, nodo):
+        _, nombre, tipo, estado, motivo = nodo
+        texto_estado = estado if not motivo else f"{estado}: {motivo}"
+        return {"text": nombre, "values": ("categoría" if tipo == "category" else "item", texto_estado),
+                "tags": (estado,) if COLORES_ESTADO_REMOTO.get(estado) else ()}
+
+    def insertar_fila_remota(self, iid):
+        nodo = self.remote_nodos[iid]
+        self.remote_tree.insert(nodo[0], "end", iid=iid, **self.fila_remota(nodo))
+        if self.remote_hijos.get(iid):
+            self.remote_tree.insert(iid, "end", iid=f"{iid}{MARCADOR_PENDIENTE}", text="...")
+
+    def mostrar_remoto(self, elementos, comparacion):
+        """
+        Aplica una lectura nueva tocando solo lo que ha cambiado: borra las filas que ya no existen,
+        actualiza las modificadas y crea las nuevas solo si su padre está desplegado.
+        """
+        anteriores = self.remote_nodos
+        self.remote_nodos = self.nodos_remotos(elementos, comparacion)
+        self.remote_hijos = {}
+        for iid, nodo in self.remote_nodos.items():
+            self.remote_hijos.setdefault(nodo[0], []).append(iid)
+
+        for iid in anteriores:
+            if iid not in self.remote_nodos and self.remote_tree.exists(iid):
+                self.remote_tree.delete(iid)
+        cambios = 0
+        for iid, nodo in self.remote_nodos.items():
+            padre = nodo[0]
+            if anteriores.get(iid) != nodo:
+                cambios += 1
+            visible = not padre or (self.remote_tree.exists(padre) and not self.remote_tree.exists(f"{padre}{MARCADOR_PENDIENTE}"))
+            if self.remote_tree.exists(iid):
+                if anteriores[iid][0] != padre:
+                    if not visible:
+                        # Su nuevo padre está plegado: la fila se creará al desplegarlo
+                        self.remote_tree.delete(iid)
+                        continue
+                    self.remote_tree.move(iid, padre, "end")
+                if anteriores[iid] != nodo:
+                    self.remote_tree.item(iid, **self.fila_remota(nodo))
+            elif visible:
+                self.insertar_fila_remota(iid)
+
+        resumen = {}
+        for nodo in self.remote_nodos.values():
+            resumen[nodo[3]] = resumen.get(nodo[3], 0) + 1
+        self.remote_status.configure(text=f"{len(elementos)} elementos en Aules, {cambios} filas actualizadas. " +
+                                     ", ".join(f"{estado}: {n}" for estado, n in sorted(resumen.items())))
+
+    def expandir_nodo_remoto(self, event=None):
+        """Crea las filas hijas la primera vez que se despliega un nodo."""
+        padre = self.remote_tree.focus()
+        pendiente = f"{padre}{MARCADOR_PENDIENTE}"
+        if not self.remote_tree.exists(pendiente):
+            return
+        self.remote_tree.delete(pendiente)
+        for iid in self.remote_hijos.get(padre, []):
+            if not self.remote_tree.exists(iid):
+                self.insertar_fila_remota(iid)
+
     def connect_event(self):
         user = self.user_entry.get()
         pwd = self.pwd_entry.get()
@@ -246,8 +643,15 @@ class App(ctk.CTk):
 
         # 1. Guardar cambios físicamente en el JSON antes de conectar
         try:
-            data = cargar_datos_json()
-            if not data:
+            try:
+                data = cargar_datos_json()
+            except ErrorConfiguracion as e:
+                # Existe pero no es válido: nunca se sustituye por la plantilla vacía
+                for error in e.errores:
+                    self.log(f"datos_aules.json: {error}", "error")
+                self.log("datos_aules.json no es válido: no se guardan los ajustes. Corrígelo y vuelve a conectar.", "error")
+                data = False
+            if data is None:
                 # Primer arranque: Crear estructura básica por defecto
                 data = {
                     "base_url": url,
@@ -264,7 +668,7 @@ class App(ctk.CTk):
                     "categoria_padre": "Nueva Categoría",
                     "categorias_hijas": []
                 }
-            else:
+            elif data:
                 # Actualizar datos existentes
                 data["username"] = user
                 data["password"] = pwd
@@ -273,7 +677,8 @@ class App(ctk.CTk):
                 data["configuracion_global"]["ce_as_category"] = ce_as_cat
             
             # Guardar físicamente
-            guardar_datos_json(data)
+            if data:
+                guardar_datos_json(data)
             
             # Refrescar la vista previa del JSON si existe el método (corregido a reload_all_data_event)
             self.reload_all_data_event()
@@ -282,44 +687,103 @@ class App(ctk.CTk):
 
         # 2. Proceder con el Login
         def task():
-            self.btn_connect.configure(state="disabled")
             self.log(f"Conectando a {url}...")
-            client = AulesClient(url, log_callback=self.log, progress_callback=lambda v, m: (self.progressbar.set(v/100), self.log(m, "info") if m else None))
+            client = AulesClient(url, log_callback=self.log, progress_callback=self.progreso)
             if client.login(user, pwd):
                 self.client = client
-                self.status_icon.configure(text_color="#44ae44")
-                self.status_text.configure(text=f"Conectado como {user}")
+                self.en_hilo_principal(lambda: self.status_icon.configure(text_color="#44ae44"))
+                self.en_hilo_principal(lambda: self.status_text.configure(text=f"Conectado como {user}"))
                 self.log("Ajustes guardados y conexión establecida.", "success")
-                self.home_button_event()
+                self.en_hilo_principal(self.home_button_event)
             else:
                 self.log("Error de conexión/credenciales.", "error")
-            self.btn_connect.configure(state="normal")
+            self.en_hilo_principal(lambda: self.btn_connect.configure(state="normal"))
 
+        self.btn_connect.configure(state="disabled")
         threading.Thread(target=task, daemon=True).start()
 
+    def cliente_trabajo(self):
+        """Cliente de un trabajo: la misma sesión, pero sus propias métricas (los trabajos de cursos distintos van en paralelo)."""
+        return self.client.derivar(progress_callback=self.client.progress_callback, metricas=MetricasPeticiones())
+
     def run_safe_action(self, action_fn, *args):
         if not self.client:
             messagebox.showwarning("Atención", "Conecta primero desde Ajustes")
             self.config_button_event()
             return
         
-        self.select_frame_by_name("logs")
-        def task():
+        perfilador = Perfilador(action_fn.__name__) if self.profile_var.get() else None
+
+        def task(client, *argumentos):
+            if perfilador:
+                perfilador.iniciar()
+                self.en_hilo_principal(self.iniciar_perfil_tk, perfilador)
             try:
-                action_fn(self.client, *args)
-            except Exception as e:
-                self.log(f"Error: {e}", "error")
-        
-        threading.Thread(target=task, daemon=True).start()
+                action_fn(client, *argumentos)
+            finally:
+                if perfilador:
+                    perfilador.detener()
+                    self.en_hilo_principal(self.finalizar_perfil, perfilador)
+
+        # Todas las acciones reciben el course_id como primer argumento
+        trabajo = self.gestor_trabajos.encolar(action_fn.__name__, args[0], self.cliente_trabajo(), task, *args)
+        if trabajo is None:
+            self.log(f"'{action_fn.__name__}' ya está en marcha o en cola para este curso; se ignora el clic.")
+            return
+        self.select_frame_by_name("logs")
+
+    def trabajo_cambiado(self, trabajo):
+        """Callback del gestor (desde cualquier hilo): deja constancia del final y repinta la lista."""
+        if not trabajo.activo:
+            self.log(trabajo.describir(), "error" if trabajo.estado == trabajo.ERROR else "info")
+        self.en_hilo_principal(self.refrescar_trabajos)
+
+    def refrescar_trabajos(self):
+        """Pinta el estado de los trabajos; mientras haya alguno activo se repite cada segundo."""
+        self.jobs_text.configure(state="normal")
+        self.jobs_text.delete("1.0", "end")
+        self.jobs_text.insert("1.0", "\n".join(t.describir() for t in reversed(self.gestor_trabajos.historial)))
+        self.jobs_text.configure(state="disabled")
+        if self.gestor_trabajos.activos() and not self.refresco_programado:
+            self.refresco_programado = True
+            self.after(1000, self._refresco_periodico)
+
+    def _refresco_periodico(self):
+        self.refresco_programado = False
+        self.refrescar_trabajos()
+
+    def cancelar_trabajos_event(self):
+        if self.gestor_trabajos.activos():
+            self.log("Cancelando trabajos: se detendrán al terminar la operación en curso.")
+            self.gestor_trabajos.cancelar_todos()
+
+    def iniciar_perfil_tk(self, perfilador):
+        """Perfila también el hilo principal (redibujado de Tk) mientras dura la acción."""
+        import cProfile
+        perfil_tk = cProfile.Profile()
+        try:
+            perfil_tk.enable()
+        except ValueError:
+            # Python 3.12+: un único perfilador activo que ya observa todos los hilos
+            return
+        perfilador.agregar_perfil("Hilo principal (Tk)", perfil_tk)
+
+    def finalizar_perfil(self, perfilador):
+        for perfil in perfilador.perfiles_extra.values():
+            perfil.disable()
+        try:
+            self.log(f"Perfil guardado en {perfilador.informe()}")
+        except Exception as e:
+            self.log(f"No se pudo guardar el perfil: {e}", "error")
 
     def crear_estructura_event(self):
-        data = cargar_datos_json()
+        data = self.cargar_datos()
         if data:
             data["configuracion_global"]["ce_as_category"] = self.ce_as_category_var.get()
             self.run_safe_action(insertar_categorias_y_items, data["course_id"], data["categoria_padre"], data["categorias_hijas"], data["configuracion_global"])
 
     def actualizar_formulas_event(self):
-        data = cargar_datos_json()
+        data = self.cargar_datos()
         if data:
             # Sincronización inteligente de estructura y pesos
             data["configuracion_global"]["ce_as_category"] = self.ce_as_category_var.get()
@@ -327,10 +791,17 @@ class App(ctk.CTk):
 
     def eliminar_estructura_event(self):
         if messagebox.askyesno("Confirmar", "¿Seguro que quieres borrar TODA la estructura de categorías?"):
-            data = cargar_datos_json()
+            data = self.cargar_datos()
             if data:
                 self.run_safe_action(eliminar_estructura, data["course_id"], data["categoria_padre"])
 
 if __name__ == "__main__":
     app = App()
+    if os.environ.get("AULES_MEDIR_ARRANQUE"):
+        # Benchmark de arranque (calificaciones_aules.py --medir-arranque): anota la hora y se cierra
+        def ventana_lista():
+            with open(os.environ["AULES_MEDIR_ARRANQUE"], "w", encoding="utf-8") as f:
+                f.write(repr(time.time()))
+            app.destroy()
+        app.after_idle(ventana_lista)
     app.mainloop()